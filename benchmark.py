@@ -0,0 +1,370 @@
+#!/usr/bin/python
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+
+Benchmark of MQ²_Web on synthetic datasets.
+
+A MapQTL or CSV dataset of the requested size is generated, then each
+step of the life of a session is timed: the upload, the detection of the
+plugin, the run of MQ², the result and marker pages and the creation of
+the zip archive of the experiment. The timings, their percentiles and the
+peak memory used are written as JSON so that builds can be compared.
+
+The sessions are created in the upload folder of the configuration file
+and removed once timed.
+"""
+
+import datetime
+import json
+import math
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import sys
+import time
+import zipfile
+from optparse import OptionParser
+from StringIO import StringIO
+
+from MQ2.mq2 import get_plugin_and_folder
+
+import mq2_web
+from mq2_archive import get_plugin
+from mq2_results import build_zip
+
+
+# Columns of the output of MapQTL following the LOD value, constant in
+# the generated datasets
+MAPQTL_HEADERS = ['Nr', 'Group', 'Position', 'Locus', 'LOD', '# Iter.',
+                  'mu_A', 'mu_H', 'mu_B', 'Variance', '% Expl.',
+                  'Additive', 'Dominance', 'GIC']
+MAPQTL_VALUES = ['1', ' 2.00000', ' 2.00000', ' 2.00000', ' 0.660000',
+                 '  1.0', ' 0.100000', '-0.100000', '0.900']
+
+
+def generate_map(n_markers, n_groups, rand):
+    """ Return a genetic map of the requested size, as a list of (marker,
+    linkage group, position) tuples.
+
+    @param n_markers the number of markers of the map.
+    @param n_groups the number of linkage groups of the map.
+    @param rand the random number generator to use.
+    """
+    genetic_map = []
+    for group in range(n_groups):
+        size = n_markers // n_groups
+        if group < n_markers % n_groups:
+            size += 1
+        position = 0.0
+        for cnt in range(size):
+            genetic_map.append(('M%05d' % len(genetic_map),
+                                'LG%02d' % (group + 1), position))
+            position += rand.uniform(0.5, 15)
+    return genetic_map
+
+
+def generate_lod_values(genetic_map, rand, peak_rate=0.3):
+    """ Return the LOD values of a trait on each marker of a map: a
+    noise below 1 with, on some of the linkage groups, a peak decreasing
+    with the distance to its marker.
+
+    @param genetic_map the map, see `generate_map`.
+    @param rand the random number generator to use.
+    @param peak_rate the probability of a peak on a linkage group.
+    """
+    peaks = {}
+    for marker, group, position in genetic_map:
+        if group not in peaks and rand.random() < peak_rate:
+            peaks[group] = None
+    groups = {}
+    for marker, group, position in genetic_map:
+        groups.setdefault(group, []).append(position)
+    for group in peaks:
+        peaks[group] = (rand.choice(groups[group]), rand.uniform(2, 8))
+    values = []
+    for marker, group, position in genetic_map:
+        value = rand.uniform(0, 1)
+        if peaks.get(group):
+            center, height = peaks[group]
+            value += height * math.exp(-abs(position - center) / 10.0)
+        values.append(value)
+    return values
+
+
+def generate_mapqtl(n_markers, n_groups, n_traits, n_sessions, rand):
+    """ Return a zip archive, as a string, containing the output of
+    MapQTL for each trait of each session.
+
+    @param n_markers the number of markers of the map.
+    @param n_groups the number of linkage groups of the map.
+    @param n_traits the number of traits of each session.
+    @param n_sessions the number of MapQTL sessions.
+    @param rand the random number generator to use.
+    """
+    genetic_map = generate_map(n_markers, n_groups, rand)
+    stream = StringIO()
+    archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+    for session in range(1, n_sessions + 1):
+        for trait in range(1, n_traits + 1):
+            lines = ['\t'.join(MAPQTL_HEADERS)]
+            values = generate_lod_values(genetic_map, rand)
+            for cnt, (marker, group, position) in enumerate(genetic_map):
+                lines.append('\t'.join(
+                    [str(cnt + 1), group, '%.3f' % position, marker,
+                     '%.2f' % values[cnt]] + MAPQTL_VALUES))
+            archive.writestr('Session %s (IM)_trait%03d.mqo' % (
+                session, trait), '\r\n'.join(lines) + '\r\n')
+    archive.close()
+    return stream.getvalue()
+
+
+def generate_csv(n_markers, n_groups, n_traits, rand):
+    """ Return a zip archive, as a string, containing a matrix of LOD
+    values as exported from R/qtl, read by the CSV plugin.
+
+    @param n_markers the number of markers of the map.
+    @param n_groups the number of linkage groups of the map.
+    @param n_traits the number of traits.
+    @param rand the random number generator to use.
+    """
+    genetic_map = generate_map(n_markers, n_groups, rand)
+    traits = [generate_lod_values(genetic_map, rand)
+              for trait in range(n_traits)]
+    lines = [','.join(['""', '"chr"', '"pos"'] + [
+        '"trait%03d"' % (trait + 1) for trait in range(n_traits)])]
+    for cnt, (marker, group, position) in enumerate(genetic_map):
+        lines.append(','.join(
+            ['"%s"' % marker, '"%s"' % group, '%.3f' % position]
+            + ['%.6f' % values[cnt] for values in traits]))
+    stream = StringIO()
+    archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+    archive.writestr('rqtl_out.csv', '\n'.join(lines) + '\n')
+    archive.close()
+    return stream.getvalue()
+
+
+def percentile(values, fraction):
+    """ Return a percentile of a list of values, by linear interpolation
+    between the closest ranks.
+
+    @param values the list of values, sorted.
+    @param fraction the percentile to return, between 0 and 1.
+    """
+    if not values:
+        return None
+    index = (len(values) - 1) * fraction
+    low = int(math.floor(index))
+    high = int(math.ceil(index))
+    return values[low] + (values[high] - values[low]) * (index - low)
+
+
+def summarize(timings):
+    """ Return the statistics of the timings of a step.
+
+    @param timings the list of durations measured, in seconds.
+    """
+    timings = sorted(timings)
+    total = sum(timings)
+    return {'count': len(timings),
+            'total': total,
+            'mean': total / len(timings),
+            'min': timings[0],
+            'p50': percentile(timings, 0.5),
+            'p90': percentile(timings, 0.9),
+            'p99': percentile(timings, 0.99),
+            'max': timings[-1],
+            'per_second': len(timings) / total if total else None}
+
+
+def get_peak_rss(who=resource.RUSAGE_SELF):
+    """ Return the peak resident memory of the process, in kB.
+
+    @param who `resource.RUSAGE_SELF` for the process itself or
+        `resource.RUSAGE_CHILDREN` for the largest of its child processes
+        which are finished, such as the ones parsing the input files of
+        the experiments.
+    """
+    peak = resource.getrusage(who).ru_maxrss
+    if sys.platform == 'darwin':
+        # Given in bytes on Mac OS X
+        peak = peak // 1024
+    return peak
+
+
+def timed(timings, name, function, *args, **kwargs):
+    """ Call a function and record how long it took.
+
+    @param timings the dictionary of the timings of each step.
+    @param name the name of the step.
+    @param function the function to call.
+    """
+    start = time.time()
+    output = function(*args, **kwargs)
+    timings.setdefault(name, []).append(time.time() - start)
+    return output
+
+
+def run_benchmark(data, session, lod_threshold=3, repeat=3, pages=20,
+                  rand=None):
+    """ Time the life of sessions created with the provided archive.
+
+    @param data the content of the archive to upload.
+    @param session the MapQTL session/run to use.
+    @param lod_threshold the LOD threshold to use.
+    @param repeat the number of sessions created.
+    @param pages the number of times the result and marker pages are
+        requested in each session.
+    @param rand the random number generator used to choose the markers.
+    @return a dictionary of the timings of each step.
+    """
+    rand = rand or random.Random()
+    client = mq2_web.APP.test_client()
+    timings = {}
+    for cnt in range(repeat):
+        output = timed(timings, 'upload', client.post, '/', data={
+            'mapqtl_input': (StringIO(data), 'benchmark.zip')})
+        match = re.search('/session/([^/]+)/$',
+                          output.headers.get('Location', ''))
+        if match is None:
+            raise ValueError('The archive could not be uploaded')
+        session_id = match.group(1)
+        upload_folder = mq2_web.get_session_folder(session_id)
+        try:
+            inputzip = os.path.join(upload_folder, 'input.zip')
+            folder = mq2_web.ARCHIVES.checkout(inputzip)[0]
+            try:
+                timed(timings, 'get_plugin_and_folder',
+                      get_plugin_and_folder, inputdir=folder)
+            finally:
+                shutil.rmtree(folder)
+
+            folder, infos = mq2_web.ARCHIVES.checkout(inputzip)
+            try:
+                exp_id = timed(timings, 'mq2_run', mq2_web.mq2_run,
+                               session_id, get_plugin(infos['plugin']),
+                               folder, lod_threshold=lod_threshold,
+                               session=session)
+            finally:
+                if os.path.exists(folder):
+                    shutil.rmtree(folder)
+
+            exp_folder = os.path.join(upload_folder, exp_id)
+            markers = [row.split(',')[0] for row in open(
+                os.path.join(exp_folder, 'map.csv')).readlines()[1:]]
+            for page in range(pages):
+                timed(timings, 'results', client.get,
+                      '/session/%s/%s/' % (session_id, exp_id))
+                timed(timings, 'marker_detail', client.get,
+                      '/session/%s/%s/marker/%s' % (
+                          session_id, exp_id, rand.choice(markers)))
+            timed(timings, 'build_zip', build_zip, exp_folder, exp_id)
+            timed(timings, 'retrieve', client.get,
+                  '/retrieve/%s/%s/%s.zip' % (session_id, exp_id, exp_id))
+        finally:
+            shutil.rmtree(upload_folder, ignore_errors=True)
+            mq2_web.CATALOG.remove_session(session_id)
+    return timings
+
+
+def parse_arguments():
+    """ Parse the command line arguments.
+    """
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage)
+    parser.add_option('--plugin', dest='plugin', default='mapqtl',
+                      help="Format of the dataset generated: mapqtl or "
+                      "csv (default: %default)")
+    parser.add_option('--markers', dest='markers', type='int',
+                      default=500, help="Number of markers of the map "
+                      "(default: %default)")
+    parser.add_option('--groups', dest='groups', type='int', default=10,
+                      help="Number of linkage groups (default: %default)")
+    parser.add_option('--traits', dest='traits', type='int', default=20,
+                      help="Number of traits (default: %default)")
+    parser.add_option('--sessions', dest='sessions', type='int', default=1,
+                      help="Number of MapQTL sessions (default: %default)")
+    parser.add_option('--lod', dest='lod_threshold', type='float',
+                      default=3, help="LOD threshold (default: %default)")
+    parser.add_option('--repeat', dest='repeat', type='int', default=3,
+                      help="Number of sessions created (default: %default)")
+    parser.add_option('--pages', dest='pages', type='int', default=20,
+                      help="Number of result and marker pages requested in "
+                      "each session (default: %default)")
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+                      help="Seed of the random dataset (default: %default)")
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help="File in which to write the results as JSON, "
+                      "they are printed otherwise")
+    return parser.parse_args()
+
+
+def main():
+    """ Main function.
+    Generate the dataset, run the benchmark and report its results.
+    """
+    options = parse_arguments()[0]
+    rand = random.Random(options.seed)
+    if options.plugin == 'mapqtl':
+        data = generate_mapqtl(options.markers, options.groups,
+                               options.traits, options.sessions, rand)
+        session = 1
+    elif options.plugin == 'csv':
+        data = generate_csv(options.markers, options.groups,
+                            options.traits, rand)
+        session = None
+    else:
+        print 'Unknown plugin: %s' % options.plugin
+        return 1
+
+    timings = run_benchmark(data, session,
+                            lod_threshold=options.lod_threshold,
+                            repeat=options.repeat, pages=options.pages,
+                            rand=rand)
+    results = {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': dict(vars(options), archive_size=len(data)),
+        'timings': dict((name, summarize(values))
+                        for name, values in timings.items()),
+        'peak_rss_kb': get_peak_rss(),
+        'children_peak_rss_kb': get_peak_rss(resource.RUSAGE_CHILDREN),
+    }
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        stream = open(options.output, 'w')
+        try:
+            stream.write(output)
+        finally:
+            stream.close()
+    else:
+        print output
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -24,109 +24,319 @@
  MA 02110-1301, USA.
 
 Script to clean the upload folder from the session folders.
+
+The sessions which have not been accessed for a number of days are
+removed, then, if a quota is set, the least recently used sessions are
+removed until the upload folder fits in it. The upload folder is read in
+a single pass and the sessions are removed in parallel. In daemon mode
+the cleaning is repeated at a regular interval, with a low CPU and I/O
+priority.
 """
 
 
+import collections
 import ConfigParser
 import datetime
 import logging
 import os
 import shutil
+import subprocess
 import time
 
+from multiprocessing.pool import ThreadPool
 from optparse import OptionParser
 
+from mq2_archive import BlobStore
+from mq2_catalog import Catalog
+from mq2_layout import list_folder, list_sessions
+
 
+# Default number of days after which sessions not accessed are removed
 LIMIT = 7
+# Default number of sessions removed in parallel
+JOBS = 4
+# Default time (in seconds) between two cleanings in daemon mode
+INTERVAL = 3600
 logging.basicConfig()
 LOG = logging.getLogger('clean_uploads')
 
+# A session folder, when it was last accessed (as a timestamp), the
+# space it takes on the disk and its files having other links, as a
+# dictionary giving, for their (device, inode), their size, the number of
+# links in the session and their total number of links
+Session = collections.namedtuple(
+    'Session', ['last_access', 'size', 'session_id', 'path', 'shared'])
+
+
+def parse_date(value):
+    """ Return the timestamp of a date as stored in the catalog or None
+    if it cannot be parsed.
 
-## {{{ http://code.activestate.com/recipes/577135/ (r2)
-def _datetime_from_str(time_str):
-    """Return (<scope>, <datetime.datetime() instance>) for the given
-    datetime string.
-    
-    >>> _datetime_from_str("2009")
-    ('year', datetime.datetime(2009, 1, 1, 0, 0))
-    >>> _datetime_from_str("2009-12")
-    ('month', datetime.datetime(2009, 12, 1, 0, 0))
-    >>> _datetime_from_str("2009-12-25")
-    ('day', datetime.datetime(2009, 12, 25, 0, 0))
-    >>> _datetime_from_str("2009-12-25 13")
-    ('hour', datetime.datetime(2009, 12, 25, 13, 0))
-    >>> _datetime_from_str("2009-12-25 13:05")
-    ('minute', datetime.datetime(2009, 12, 25, 13, 5))
-    >>> _datetime_from_str("2009-12-25 13:05:14")
-    ('second', datetime.datetime(2009, 12, 25, 13, 5, 14))
-    >>> _datetime_from_str("2009-12-25 13:05:14.453728")
-    ('microsecond', datetime.datetime(2009, 12, 25, 13, 5, 14, 453728))
+    @param value the date, ie: `2013-01-25 13:05:14.453728`.
     """
-    formats = [
-        # <scope>, <format>
-        ("year", "%Y"),
-        ("month", "%Y-%m"),
-        ("day", "%Y-%m-%d"),
-        ("hour", "%Y-%m-%d %H"),
-        ("minute", "%Y-%m-%d %H:%M"),
-        ("second", "%Y-%m-%d %H:%M:%S"),
-        # ".<microsecond>" at end is manually handled below
-        ("microsecond", "%Y-%m-%d %H:%M:%S"),
-    ]
-    for scope, form in formats:
-        if scope == "microsecond":
-            # Special handling for microsecond part. AFAIK there isn't a
-            # strftime code for this.
-            if time_str.count('.') != 1:
-                continue
-            time_str, microseconds_str = time_str.split('.')
-            try:
-                microsecond = int((microseconds_str + '000000')[:6])
-            except ValueError:
+    if not value:
+        return None
+    try:
+        date = datetime.datetime.strptime(value.split('.')[0],
+                                          '%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        return None
+    return time.mktime(date.timetuple())
+
+
+def scan_tree(folder):
+    """ Return the time of the last modification of the files of a
+    folder, the space they take on the disk and its files having other
+    links, as stored in `Session.shared`.
+    Files having several links in the folder are only counted once.
+
+    @param folder the folder to scan.
+    """
+    last_modified = os.lstat(folder).st_mtime
+    size = 0
+    files = {}
+    folders = [folder]
+    while folders:
+        for entry in list_folder(folders.pop()):
+            stat = entry.stat()
+            last_modified = max(last_modified, stat.st_mtime)
+            if entry.is_dir():
+                folders.append(entry.path)
                 continue
-        try:
-            # This comment here is the modern way. The subsequent two
-            # lines are for Python 2.4 support.
-            #t = datetime.datetime.strptime(time_str, form)
-            t_tuple = time.strptime(time_str, form)
-            date_obj = datetime.datetime(*t_tuple[:6])
-        except ValueError:
-            pass
+            key = (stat.st_dev, stat.st_ino)
+            if key in files:
+                files[key][1] += 1
+            else:
+                files[key] = [stat.st_size, 1, stat.st_nlink]
+                size += stat.st_size
+    shared = dict((key, tuple(infos)) for key, infos in files.items()
+                  if infos[2] > infos[1])
+    return (last_modified, size, shared)
+
+
+def scan_sessions(folder, last_accesses, with_size=False):
+    """ Return the sessions of the upload folder, in the sharded layout
+    or still in the upload folder itself.
+    The last access to a session is taken from the catalog, the last
+    modification of its files is used for the sessions missing from it.
+
+    @param folder the upload folder.
+    @param last_accesses the date of the last access of each session, as
+        returned by `Catalog.get_last_accesses`.
+    @param with_size whether to compute the size of each session.
+    @return the list of `Session`, the least recently used first.
+    """
+    sessions = []
+    for entry in list_sessions(folder):
+        last_access = parse_date(last_accesses.get(entry.name))
+        size = 0
+        shared = {}
+        if last_access is None or with_size:
+            last_modified, size, shared = scan_tree(entry.path)
+            if last_access is None:
+                last_access = last_modified
+        sessions.append(
+            Session(last_access, size, entry.name, entry.path, shared))
+    return sorted(sessions)
+
+
+def release_session(session, links):
+    """ Return the space freed on the disk by the removal of a session.
+    A file shared with other sessions is only freed along with the last
+    of them, once at most one link is left: the one of the blob store,
+    which `BlobStore.clean` then removes.
+
+    @param session the `Session` removed.
+    @param links the number of links each shared file has in the
+        sessions and outside of them, as a list indexed by its (device,
+        inode), it is updated.
+    """
+    freed = session.size
+    for key, (size, count, nlink) in session.shared.items():
+        links[key][0] -= count
+        if links[key][0] > 0 or links[key][1] > 1:
+            freed -= size
+    return freed
+
+
+def select_sessions(sessions, now, days=None, quota=None, keep=()):
+    """ Return the sessions to remove: those not accessed for more than
+    the given number of days then, if the remaining ones do not fit in
+    the quota, the least recently used ones.
+
+    @param sessions the list of `Session`, the least recently used
+        first.
+    @param now the current time, as a timestamp.
+    @param days the number of days after which the sessions not accessed
+        are removed.
+    @param quota the space (in bytes) the sessions may take.
+    @param keep the identifiers of the sessions never to remove.
+    """
+    to_clean = []
+    remaining = []
+    for session in sessions:
+        if session.session_id not in keep and days is not None \
+                and now - session.last_access > days * 24 * 3600:
+            LOG.info('Session %s is above limit' % session.session_id)
+            to_clean.append(session)
         else:
-            if scope == "microsecond":
-                date_obj = date_obj.replace(microsecond=microsecond)
-            return scope, date_obj
-    else:
-        raise ValueError("could not determine date from %r: does not "
-            "match any of the accepted patterns ('%s')"
-            % (time_str, "', '".join(s for s, p, f in formats)))
-## end of http://code.activestate.com/recipes/577135/ }}}
+            remaining.append(session)
+    if quota is not None:
+        # The files shared by several sessions are counted once, and
+        # only freed with the last session linking to them
+        links = {}
+        for session in sessions:
+            for key, (size, count, nlink) in session.shared.items():
+                links.setdefault(key, [0, nlink])[0] += count
+        for infos in links.values():
+            infos[1] -= infos[0]
+        for session in to_clean:
+            release_session(session, links)
+        total = 0
+        counted = set()
+        for session in remaining:
+            total += session.size - sum(
+                size for key, (size, count, nlink) in session.shared.items()
+                if key in counted)
+            counted.update(session.shared)
+        for session in remaining:
+            if total <= quota:
+                break
+            if session.session_id in keep:
+                continue
+            LOG.info('Session %s is removed to fit in the quota' % (
+                session.session_id))
+            to_clean.append(session)
+            total -= release_session(session, links)
+    return to_clean
+
+
+def remove_sessions(sessions, catalog, jobs=JOBS):
+    """ Remove sessions from the disk and from the catalog, in parallel.
+
+    @param sessions the list of `Session` to remove.
+    @param catalog the catalog of the sessions.
+    @param jobs the number of sessions removed at the same time.
+    """
+    def remove(session):
+        shutil.rmtree(session.path, ignore_errors=True)
+        catalog.remove_session(session.session_id)
+
+    if not sessions:
+        return
+    pool = ThreadPool(max(jobs, 1))
+    try:
+        pool.map(remove, sessions)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def lower_priority():
+    """ Give the process the lowest CPU priority and, when `ionice` is
+    available, the idle I/O priority, so that the cleaning does not slow
+    down the web-application.
+    """
+    os.nice(19)
+    try:
+        subprocess.call(['ionice', '-c', '3', '-p', str(os.getpid())])
+    except OSError:
+        LOG.info('ionice is not available, the I/O priority is unchanged')
+
+
+def _get_option(config, option, default=None):
+    """ Return the value of an option of the mq2 section of the
+    configuration file or the provided default if it is not set.
+    """
+    try:
+        return config.get('mq2', option)
+    except (ConfigParser.NoSectionError, ConfigParser.NoOptionError):
+        return default
+
+
+def clean(config, days=LIMIT, quota=None, jobs=JOBS, test=False):
+    """ Remove the sessions not accessed for too long and those beyond
+    the quota, then the archives no longer used.
+
+    @param config the configuration of the web-application.
+    @param days the number of days after which the sessions not accessed
+        are removed.
+    @param quota the space (in bytes) the sessions may take.
+    @param jobs the number of sessions removed at the same time.
+    @param test whether to only print the sessions to remove.
+    @return the list of `Session` removed, or to remove in test mode.
+    """
+    folder = config.get('mq2', 'upload_folder')
+    LOG.info('Folder: %s' % folder)
+    catalog = Catalog(_get_option(config, 'catalog',
+                                  os.path.join(folder, 'catalog.sqlite')))
+    sessions = scan_sessions(folder, catalog.get_last_accesses(),
+                             with_size=quota is not None)
+    to_clean = select_sessions(
+        sessions, time.time(), days=days, quota=quota,
+        keep=[_get_option(config, 'sample_session')])
+
+    if not to_clean:
+        LOG.info('No old sessions, nothing to remove')
+    if test:
+        for session in to_clean:
+            print 'To remove: %s' % session.path
+        print '%s sessions to remove' % len(to_clean)
+        return to_clean
+
+    remove_sessions(to_clean, catalog, jobs=jobs)
+    blob_folder = _get_option(config, 'blob_folder',
+                              os.path.join(folder, '.blobs'))
+    LOG.info('%s archives no longer used removed' % (
+        BlobStore(blob_folder).clean()))
+    return to_clean
 
 
 def parse_arguments():
     """ Parse the command line arguments.
     """
-    usage = "usage: %prog [options] path/to/config/file"
+    usage = "usage: %prog [options]"
     parser = OptionParser(usage)
-    parser.add_option("-v", '--verbose', 
+    parser.add_option("-v", '--verbose',
                   action="store_true", dest="verbose", default=False,
                   help="Increase the verbosity of the output")
-    parser.add_option("-t", '--test', 
+    parser.add_option("-t", '--test',
                   action="store_true", dest="test", default=False,
                   help="Increase the verbosity and just perform a test "\
                   "run without touching any files.")
+    parser.add_option('--days', dest='days', type='float', default=None,
+                  help="Remove the sessions not accessed for this number "
+                  "of days (default: keep_days in the configuration "
+                  "file or %s)" % LIMIT)
+    parser.add_option('--quota', dest='quota', type='int', default=None,
+                  help="Remove the least recently used sessions until "
+                  "they take less than this space, in MB (default: "
+                  "upload_quota in the configuration file, if set)")
+    parser.add_option('-j', '--jobs', dest='jobs', type='int', default=None,
+                  help="Number of sessions removed in parallel (default: "
+                  "%s)" % JOBS)
+    parser.add_option('--daemon', action="store_true", dest="daemon",
+                  default=False, help="Clean the upload folder "
+                  "continuously, with a low CPU and I/O priority")
+    parser.add_option('--interval', dest='interval', type='int',
+                  default=None, help="Time between two cleanings in "
+                  "daemon mode, in seconds (default: clean_interval in "
+                  "the configuration file or %s)" % INTERVAL)
+    parser.add_option('--low-priority', action="store_true",
+                  dest="low_priority", default=False,
+                  help="Run with a low CPU and I/O priority")
     return parser.parse_args()
 
 
 def main():
     """ Main function.
-    Browse the given folder, determine based on the name how old the
-    last analysis is and whether the folder is older than X days or not.
+    Read the configuration file and clean the upload folder, once or
+    continuously in daemon mode.
     """
     options = parse_arguments()[0]
 
     # Do all the checks regarding the input provided
-    if options.verbose:
+    if options.verbose or options.test:
         LOG.setLevel(logging.DEBUG)
     config_file = os.path.join(os.path.dirname(
         os.path.abspath(__file__)), 'mq2.cfg')
@@ -136,56 +346,36 @@ def main():
 
     config = ConfigParser.ConfigParser()
     config.readfp(open(config_file))
-    folder = config.get('mq2', 'upload_folder')
-
-    LOG.info('Folder: %s' % folder)
-    today = datetime.datetime.today()
-    to_clean = []
-    for filename in os.listdir(folder):
-        # This is the folder with all the sessions
-        if os.path.isdir(os.path.join(folder, filename)):
-            string = '%s-%s-%s' % (filename[:4], filename[4:6],
-                filename[6:8])
-            session_date = _datetime_from_str(string)[1]
-            delta = today - session_date
-            if delta.days > LIMIT:
-                LOG.info('Session %s is above limit' % filename)
-                to_keep = False
-                for sub_filename in os.listdir(os.path.join(folder,
-                    filename)):
-                    # This is the folder with all the experiment within
-                    # a session
-                    if os.path.isdir(os.path.join(folder, filename,
-                        sub_filename)):
-                        string = '%s-%s-%s' % (sub_filename[:4],
-                            sub_filename[4:6], sub_filename[6:8])
-                        exp_date = _datetime_from_str(string)[1]
-                        delta = today - exp_date
-                        if delta.days < LIMIT:
-                            LOG.info('Experiment %s is to keep' % (
-                                sub_filename))
-                            to_keep = True
-                            break
-                if not to_keep:
-                    LOG.info('Session %s is to be cleaned' % filename)
-                    to_clean.append(os.path.join(folder, filename))
-
-    sample_session = os.path.join(folder,
-        config.get('mq2', 'sample_session'))
-    if sample_session in to_clean:
-        LOG.info('Save the sample session: %s' % sample_session)
-        to_clean.remove(sample_session)
+    days = options.days
+    if days is None:
+        days = float(_get_option(config, 'keep_days', LIMIT))
+    quota = options.quota
+    if quota is None and _get_option(config, 'upload_quota'):
+        quota = int(_get_option(config, 'upload_quota'))
+    if quota is not None:
+        quota = quota * 1024 * 1024
+    jobs = options.jobs or int(_get_option(config, 'clean_jobs', JOBS))
+    interval = options.interval or int(
+        _get_option(config, 'clean_interval', INTERVAL))
 
-    if not to_clean:
-        LOG.info('No old sessions, nothing to remove')
-
-    for filename in to_clean:
-        if not options.test:
-            shutil.rmtree(filename)
+    if options.daemon or options.low_priority:
+        lower_priority()
+    while True:
+        start = time.time()
+        try:
+            removed = clean(config, days=days, quota=quota, jobs=jobs,
+                            test=options.test)
+        except Exception, err:
+            if not options.daemon:
+                raise
+            LOG.error('Could not clean the upload folder: %s' % err)
         else:
-            print 'To remove: %s' % filename
-    if options.test:
-        print '%s sessions to remove' % len(to_clean)
+            if not options.test:
+                LOG.info('%s sessions removed in %.1f seconds' % (
+                    len(removed), time.time() - start))
+        if not options.daemon:
+            break
+        time.sleep(interval)
 
 if __name__ == '__main__':
     main()
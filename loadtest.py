@@ -0,0 +1,447 @@
+#!/usr/bin/python
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+
+Load test of MQ²_Web.
+
+A number of simulated users browse the web-application concurrently,
+each one picking its next action in a mix of front page visits, uploads,
+submissions of experiments, result pages, marker pages and downloads.
+The requests are either sent directly to the application, in the
+process, or through HTTP to a local WSGI server started for the test.
+The number of requests per second, the latency percentiles and the error
+rate of each action are reported as JSON.
+
+It runs offline, using the demo dataset or a generated one, and removes
+the sessions it created once finished.
+"""
+
+import datetime
+import httplib
+import json
+import mimetools
+import os
+import random
+import re
+import shutil
+import sys
+import threading
+import time
+from optparse import OptionParser
+from StringIO import StringIO
+
+from werkzeug.serving import make_server
+
+import mq2_web
+from benchmark import generate_mapqtl, generate_csv, percentile
+
+
+DEMO_DATASET = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'static', 'Demoset_mapqtl.zip')
+# Default weight of each action in the mix of requests
+ACTIONS = (('index', 10),
+           ('upload', 2),
+           ('submit', 5),
+           ('results', 35),
+           ('marker', 35),
+           ('download', 13))
+# LOD thresholds of the experiments submitted
+LOD_THRESHOLDS = ('2', '2.5', '3', '3.5', '4', '4.5', '5')
+
+
+class InProcessClient(object):
+    """ Send the requests directly to the application. """
+
+    def __init__(self):
+        self.client = mq2_web.APP.test_client()
+
+    def get(self, url):
+        """ Send a GET request and return the status, the location
+        header and the length of the response.
+
+        @param url the path to request.
+        """
+        output = self.client.get(url)
+        return (output.status_code, output.headers.get('Location'),
+                len(output.data))
+
+    def post(self, url, data, filename=None, content=None):
+        """ Send a POST request and return the status, the location
+        header and the length of the response.
+
+        @param url the path to request.
+        @param data the fields of the form.
+        @param filename the name of the field of the file to upload.
+        @param content the content of the file to upload.
+        """
+        data = dict(data)
+        if filename:
+            data[filename] = (StringIO(content), 'input.zip')
+        output = self.client.post(url, data=data)
+        return (output.status_code, output.headers.get('Location'),
+                len(output.data))
+
+
+class HTTPClient(object):
+    """ Send the requests through HTTP, without following redirects. """
+
+    def __init__(self, host, port):
+        """ Constructor.
+
+        @param host the host of the server.
+        @param port the port of the server.
+        """
+        self.host = host
+        self.port = port
+
+    def request(self, method, url, body=None, headers=None):
+        """ Send a request and return the status, the location header and
+        the length of the response.
+        """
+        conn = httplib.HTTPConnection(self.host, self.port, timeout=300)
+        try:
+            conn.request(method, url, body, headers or {})
+            response = conn.getresponse()
+            return (response.status, response.getheader('Location'),
+                    len(response.read()))
+        finally:
+            conn.close()
+
+    def get(self, url):
+        """ Send a GET request, see `InProcessClient.get`. """
+        return self.request('GET', url)
+
+    def post(self, url, data, filename=None, content=None):
+        """ Send a POST request as a multipart form, see
+        `InProcessClient.post`.
+        """
+        boundary = mimetools.choose_boundary()
+        parts = []
+        for key, value in data.items():
+            parts.append('--%s\r\nContent-Disposition: form-data; '
+                         'name="%s"\r\n\r\n%s\r\n' % (boundary, key, value))
+        if filename:
+            parts.append('--%s\r\nContent-Disposition: form-data; '
+                         'name="%s"; filename="input.zip"\r\n'
+                         'Content-Type: application/zip\r\n\r\n%s\r\n'
+                         % (boundary, filename, content))
+        parts.append('--%s--\r\n' % boundary)
+        return self.request('POST', url, ''.join(parts), {
+            'Content-Type': 'multipart/form-data; boundary=%s' % boundary})
+
+
+class LoadTest(object):
+    """ Simulated users browsing the web-application concurrently. """
+
+    def __init__(self, client_factory, dataset, session, actions=ACTIONS,
+                 seed=None):
+        """ Constructor.
+
+        @param client_factory the function returning a new client, each
+            user having its own.
+        @param dataset the content of the archive uploaded.
+        @param session the MapQTL session/run of the dataset.
+        @param actions the list of (action, weight) of the mix.
+        @param seed the seed of the random choices of the users.
+        """
+        self.client_factory = client_factory
+        self.dataset = dataset
+        self.session = session
+        self.actions = [action for action, weight in actions if weight > 0]
+        self.weights = [weight for action, weight in actions if weight > 0]
+        self.rand = random.Random(seed)
+        self.session_ids = []
+        self.experiments = []
+        self.markers = {}
+        self.timings = {}
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def record(self, action, duration, error):
+        """ Record the outcome of an action.
+
+        @param action the name of the action.
+        @param duration how long the action took, in seconds.
+        @param error whether the action failed.
+        """
+        with self._lock:
+            self.timings.setdefault(action, []).append(duration)
+            if error:
+                self.errors[action] = self.errors.get(action, 0) + 1
+
+    def upload(self, client):
+        """ Upload the dataset and return the identifier of the session
+        created, None if the upload failed.
+
+        @param client the client to use.
+        """
+        status, location, length = client.post(
+            '/', {}, filename='mapqtl_input', content=self.dataset)
+        match = re.search('/session/([^/]+)/$', location or '')
+        if status != 302 or match is None:
+            return None
+        with self._lock:
+            self.session_ids.append(match.group(1))
+        return match.group(1)
+
+    def add_experiment(self, session_id, exp_id):
+        """ Make an experiment available to the result, marker and
+        download actions.
+
+        @param session_id the session identifier.
+        @param exp_id the experiment identifier.
+        """
+        stream = open(os.path.join(mq2_web.get_session_folder(session_id),
+                                   exp_id, 'map.csv'))
+        try:
+            markers = [row.split(',')[0] for row in stream.readlines()[1:]]
+        finally:
+            stream.close()
+        with self._lock:
+            self.experiments.append((session_id, exp_id))
+            self.markers[exp_id] = markers
+
+    def prepare(self):
+        """ Create the session and the experiment the users start
+        from.
+        """
+        session_id = self.upload(self.client_factory())
+        if session_id is None:
+            raise ValueError('The dataset could not be uploaded')
+        exp_id = mq2_web.run_experiment(
+            session_id, '%s_s%s_t3' % (mq2_web.generate_exp_id(),
+                                       self.session), '3', self.session)
+        self.add_experiment(session_id, exp_id)
+
+    def run_action(self, client, rand, action):
+        """ Run one action and return whether it succeeded.
+
+        @param client the client to use.
+        @param rand the random number generator of the user.
+        @param action the name of the action.
+        """
+        with self._lock:
+            session_id, exp_id = rand.choice(self.experiments)
+            sessions = list(self.session_ids)
+        if action == 'index':
+            return client.get('/')[0] == 200
+        elif action == 'upload':
+            return self.upload(client) is not None
+        elif action == 'submit':
+            data = {'lod_threshold': rand.choice(LOD_THRESHOLDS)}
+            if self.session is not None:
+                data['session'] = self.session
+            return client.post('/session/%s/' % rand.choice(sessions),
+                               data)[0] == 200
+        elif action == 'results':
+            # The page is only shown once its plot data is loaded
+            return client.get('/session/%s/%s/' % (session_id, exp_id)
+                              )[0] == 200 \
+                and client.get('/session/%s/%s/plot.json' % (
+                    session_id, exp_id))[0] == 200
+        elif action == 'marker':
+            return client.get('/session/%s/%s/marker/%s' % (
+                session_id, exp_id, rand.choice(self.markers[exp_id])
+            ))[0] == 200
+        elif action == 'download':
+            return client.get('/retrieve/%s/%s/%s.zip' % (
+                session_id, exp_id, exp_id))[0] == 200
+        raise ValueError('Unknown action: %s' % action)
+
+    def user(self, seed, deadline):
+        """ Run the actions of a user until the deadline.
+
+        @param seed the seed of the random choices of the user.
+        @param deadline when to stop, as a timestamp.
+        """
+        client = self.client_factory()
+        rand = random.Random(seed)
+        total = sum(self.weights)
+        while time.time() < deadline:
+            value = rand.uniform(0, total)
+            for action, weight in zip(self.actions, self.weights):
+                value -= weight
+                if value <= 0:
+                    break
+            start = time.time()
+            try:
+                error = not self.run_action(client, rand, action)
+            except Exception:
+                error = True
+            self.record(action, time.time() - start, error)
+
+    def run(self, users, duration):
+        """ Run the load test and return its report.
+
+        @param users the number of concurrent users.
+        @param duration how long to run the test, in seconds.
+        """
+        self.prepare()
+        deadline = time.time() + duration
+        threads = [threading.Thread(target=self.user,
+                                    args=(self.rand.random(), deadline))
+                   for cnt in range(users)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.report(time.time() - start)
+
+    def report(self, elapsed):
+        """ Return the number of requests per second, the latency
+        percentiles and the error rate of each action and overall.
+
+        @param elapsed how long the test took, in seconds.
+        """
+        def summarize(timings, errors):
+            timings = sorted(timings)
+            return {'requests': len(timings),
+                    'errors': errors,
+                    'error_rate': float(errors) / len(timings),
+                    'per_second': len(timings) / elapsed,
+                    'p50': percentile(timings, 0.5),
+                    'p90': percentile(timings, 0.9),
+                    'p99': percentile(timings, 0.99),
+                    'max': timings[-1]}
+
+        output = {'elapsed': elapsed, 'actions': {}}
+        for action, timings in self.timings.items():
+            output['actions'][action] = summarize(
+                timings, self.errors.get(action, 0))
+        timings = [value for values in self.timings.values()
+                   for value in values]
+        if timings:
+            output['total'] = summarize(timings, sum(self.errors.values()))
+        return output
+
+    def clean(self):
+        """ Remove the sessions created during the test. """
+        for session_id in self.session_ids:
+            shutil.rmtree(mq2_web.get_session_folder(session_id),
+                          ignore_errors=True)
+            mq2_web.CATALOG.remove_session(session_id)
+
+
+def parse_arguments():
+    """ Parse the command line arguments.
+    """
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage)
+    parser.add_option('--users', dest='users', type='int', default=50,
+                      help="Number of concurrent users (default: %default)")
+    parser.add_option('--duration', dest='duration', type='float',
+                      default=30, help="Duration of the test, in seconds "
+                      "(default: %default)")
+    parser.add_option('--http', dest='http', action='store_true',
+                      default=False, help="Send the requests through a "
+                      "local WSGI server rather than to the application "
+                      "directly")
+    parser.add_option('--dataset', dest='dataset', default='demo',
+                      help="Dataset uploaded: demo, mapqtl or csv, the "
+                      "last two being generated (default: %default)")
+    parser.add_option('--markers', dest='markers', type='int', default=500,
+                      help="Number of markers of the generated dataset "
+                      "(default: %default)")
+    parser.add_option('--traits', dest='traits', type='int', default=20,
+                      help="Number of traits of the generated dataset "
+                      "(default: %default)")
+    parser.add_option('--mix', dest='mix', default=None,
+                      help="Weight of each action, ie: "
+                      "index=10,upload=2,submit=5,results=35,marker=35,"
+                      "download=13")
+    parser.add_option('--seed', dest='seed', type='int', default=0,
+                      help="Seed of the random choices (default: %default)")
+    parser.add_option('-o', '--output', dest='output', default=None,
+                      help="File in which to write the results as JSON, "
+                      "they are printed otherwise")
+    return parser.parse_args()
+
+
+def main():
+    """ Main function.
+    Start the server if needed, run the load test and report its results.
+    """
+    options = parse_arguments()[0]
+    rand = random.Random(options.seed)
+    if options.dataset == 'demo':
+        stream = open(DEMO_DATASET, 'rb')
+        try:
+            dataset = stream.read()
+        finally:
+            stream.close()
+        session = '2'
+    elif options.dataset == 'mapqtl':
+        dataset = generate_mapqtl(options.markers, 10, options.traits, 1,
+                                  rand)
+        session = '1'
+    elif options.dataset == 'csv':
+        dataset = generate_csv(options.markers, 10, options.traits, rand)
+        session = None
+    else:
+        print 'Unknown dataset: %s' % options.dataset
+        return 1
+    actions = ACTIONS
+    if options.mix:
+        actions = [(item.split('=')[0].strip(), int(item.split('=')[1]))
+                   for item in options.mix.split(',')]
+
+    # The simulated users do not go through the forms first
+    mq2_web.APP.config['CSRF_ENABLED'] = False
+    server = None
+    client_factory = InProcessClient
+    if options.http:
+        server = make_server('127.0.0.1', 0, mq2_web.APP, threaded=True)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        client_factory = lambda: HTTPClient('127.0.0.1', server.server_port)
+
+    test = LoadTest(client_factory, dataset, session, actions=actions,
+                    seed=options.seed)
+    try:
+        results = test.run(options.users, options.duration)
+    finally:
+        if server is not None:
+            server.shutdown()
+        mq2_web.JOBS.close()
+        test.clean()
+    results.update({
+        'date': datetime.datetime.now().isoformat(),
+        'parameters': dict(vars(options), archive_size=len(dataset)),
+    })
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if options.output:
+        stream = open(options.output, 'w')
+        try:
+            stream.write(output)
+        finally:
+            stream.close()
+    else:
+        print output
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,161 @@
+#!/usr/bin/python
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+
+Script moving the sessions of the upload folder to the sharded layout.
+
+The sessions created before the sharding are directly in the upload
+folder, they are moved one at a time, by batches, while the
+web-application keeps serving them: it finds a session at its old place
+until it is moved. Sessions with jobs still queued or running are left
+for a later run.
+"""
+
+
+import ConfigParser
+import logging
+import os
+import time
+
+from optparse import OptionParser
+
+from mq2_jobs import get_job_ids, read_job_status, QUEUED, RUNNING
+from mq2_layout import is_shard, list_folder, migrate_session
+
+
+# Default number of sessions moved between two pauses
+BATCH = 100
+# Default time (in seconds) of the pause between two batches
+PAUSE = 1
+logging.basicConfig()
+LOG = logging.getLogger('migrate_uploads')
+
+
+def list_legacy_sessions(folder):
+    """ Return the identifiers of the sessions still directly in the
+    upload folder.
+
+    @param folder the upload folder.
+    """
+    return sorted(
+        entry.name for entry in list_folder(folder)
+        if not entry.name.startswith('.') and not is_shard(entry.name)
+        and entry.is_dir())
+
+
+def has_pending_jobs(folder):
+    """ Return whether a session has jobs still queued or running.
+
+    @param folder the folder of the session.
+    """
+    for job_id in get_job_ids(folder):
+        infos = read_job_status(folder, job_id)
+        if infos and infos['status'] in (QUEUED, RUNNING):
+            return True
+    return False
+
+
+def migrate(folder, batch=BATCH, pause=PAUSE, test=False):
+    """ Move the sessions still directly in the upload folder to the
+    sharded layout.
+
+    @param folder the upload folder.
+    @param batch the number of sessions moved between two pauses.
+    @param pause the time (in seconds) of the pause between two batches.
+    @param test whether to only print the sessions to move.
+    @return the identifiers of the sessions moved, or to move in test
+        mode.
+    """
+    moved = []
+    for session_id in list_legacy_sessions(folder):
+        if has_pending_jobs(os.path.join(folder, session_id)):
+            LOG.info('Session %s has jobs running, it is left' % session_id)
+            continue
+        if test:
+            print 'To move: %s' % session_id
+            moved.append(session_id)
+            continue
+        try:
+            if migrate_session(folder, session_id):
+                moved.append(session_id)
+        except OSError, err:
+            LOG.error('Could not move the session %s: %s' % (
+                session_id, err))
+            continue
+        if batch and pause and len(moved) % batch == 0:
+            time.sleep(pause)
+    return moved
+
+
+def parse_arguments():
+    """ Parse the command line arguments.
+    """
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage)
+    parser.add_option("-v", '--verbose',
+                  action="store_true", dest="verbose", default=False,
+                  help="Increase the verbosity of the output")
+    parser.add_option("-t", '--test',
+                  action="store_true", dest="test", default=False,
+                  help="Increase the verbosity and just perform a test "\
+                  "run without touching any files.")
+    parser.add_option('--batch', dest='batch', type='int', default=BATCH,
+                  help="Number of sessions moved between two pauses "
+                  "(default: %s)" % BATCH)
+    parser.add_option('--pause', dest='pause', type='float', default=PAUSE,
+                  help="Time between two batches, in seconds (default: "
+                  "%s)" % PAUSE)
+    return parser.parse_args()
+
+
+def main():
+    """ Main function.
+    Read the configuration file and move the sessions of the upload
+    folder.
+    """
+    options = parse_arguments()[0]
+
+    if options.verbose or options.test:
+        LOG.setLevel(logging.DEBUG)
+    config_file = os.path.join(os.path.dirname(
+        os.path.abspath(__file__)), 'mq2.cfg')
+    if not os.path.exists(config_file):
+        print 'The provided config file does not exist: %s' % config_file
+        return
+
+    config = ConfigParser.ConfigParser()
+    config.readfp(open(config_file))
+    folder = config.get('mq2', 'upload_folder')
+    LOG.info('Folder: %s' % folder)
+    start = time.time()
+    moved = migrate(folder, batch=options.batch, pause=options.pause,
+                    test=options.test)
+    if not options.test:
+        LOG.info('%s sessions moved in %.1f seconds' % (
+            len(moved), time.time() - start))
+    LOG.info('%s sessions left in the upload folder' % (
+        len(list_legacy_sessions(folder))))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,723 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+
+Handling of the input archives uploaded to MQ².
+
+The archives are checked and hashed while they are uploaded, then stored
+once in a blob store, keyed by the SHA-256 of their content, the sessions
+refer to them through hard links.
+What an archive contains is read from its central directory, which is
+enough to find the plugin and the sessions of MapQTL archives. The
+archives are otherwise extracted once in a cache folder, together with
+the plugin able to process them and the list of sessions they contain.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+
+from straight.plugin import load
+
+from MQ2 import extract_zip, MQ2Exception
+from MQ2.mq2 import get_plugin_and_folder
+from MQ2.plugin_interface import PluginInterface
+from MQ2.plugins.mapqtl_plugin import MapQTLPlugin
+
+from mq2_jobs import FileLock
+from mq2_metrics import METRICS
+
+
+CHUNK_SIZE = 1024 * 1024
+# The umask of the process, to give the stored archives the permissions
+# of a regular file
+UMASK = os.umask(0)
+os.umask(UMASK)
+# Metrics of the cache of the extracted archives
+CACHE_REQUESTS = METRICS.counter(
+    'mq2_archive_cache_requests_total',
+    'Lookups of the archives in the cache of the extracted archives',
+    ('result',))
+EXTRACTION_TIME = METRICS.histogram(
+    'mq2_archive_extraction_seconds',
+    'Time spent extracting the archives in the cache')
+# Signature and format of the header preceding each file of a zip archive
+LOCAL_HEADER = 'PK\x03\x04'
+LOCAL_HEADER_FORMAT = '<4sHHHHHLLLHH'
+LOCAL_HEADER_SIZE = struct.calcsize(LOCAL_HEADER_FORMAT)
+# Extensions of the files the plugins can work on
+INPUT_EXTENSIONS = ('.mqo', '.csv', '.xls', '.xlsx')
+# Age (in seconds) after which an upload left unfinished is removed
+TMP_FILE_AGE = 24 * 3600
+
+
+class InvalidArchive(MQ2Exception):
+    """ Exception raised when the archive uploaded cannot be processed
+    by MQ².
+    """
+    pass
+
+
+class ArchiveTooLarge(InvalidArchive):
+    """ Exception raised when the archive uploaded, or its content, is
+    larger than allowed.
+    """
+    pass
+
+
+def get_plugin(name):
+    """ Return the MQ² plugin having the specified name.
+
+    @param name the name of the plugin to return.
+    """
+    for plugin in load('MQ2.plugins', subclasses=PluginInterface):
+        if plugin.name == name:
+            return plugin
+    raise MQ2Exception('No plugin found with the name: %s' % name)
+
+
+def is_input_file(filename):
+    """ Return whether the file of an archive may be used by one of the
+    plugins, based on its name.
+
+    @param filename the name of the file in the archive.
+    """
+    return os.path.splitext(filename)[1].lower() in INPUT_EXTENSIONS \
+        and not os.path.basename(filename).startswith('.')
+
+
+def list_archive(inputzip):
+    """ Return the files of a zip archive, as `zipfile.ZipInfo`, read
+    from its central directory without extracting it.
+    As `extract_zip` does, the first file of a folder which has no entry
+    of its own in the archive is left out.
+
+    @param inputzip the path to the archive.
+    """
+    zfile = zipfile.ZipFile(inputzip)
+    try:
+        infos = zfile.infolist()
+    finally:
+        zfile.close()
+    folders = set()
+    output = []
+    for info in infos:
+        folder = os.path.dirname(info.filename)
+        if folder and folder not in folders:
+            folders.add(folder)
+            continue
+        if not info.filename.endswith('/'):
+            output.append(info)
+    return output
+
+
+def get_mapqtl_sessions(filenames):
+    """ Return the sorted list of MapQTL sessions found in a list of
+    files, the MapQTL output files being named `Session <N> ... .mqo`.
+
+    @param filenames the name of the files.
+    """
+    sessions = set()
+    for filename in filenames:
+        filename = os.path.basename(filename)
+        if filename.startswith('Session ') and filename.endswith('.mqo'):
+            sessions.add(filename.split()[1])
+    return sorted(sessions)
+
+
+def describe_archive(inputzip):
+    """ Return the plugin able to process an archive and the sessions it
+    contains, found using only the name of its files.
+    This is possible for MapQTL output, CSV and Excel files have to be
+    read to tell whether they can be processed.
+
+    @param inputzip the path to the archive.
+    @return a dictionary with the `plugin` name and the `sessions` or
+        None if the archive has to be extracted to find them.
+    """
+    filenames = [info.filename for info in list_archive(inputzip)]
+    sessions = get_mapqtl_sessions(filenames)
+    others = [filename for filename in filenames
+              if is_input_file(filename)
+              and not os.path.splitext(filename)[1].lower() == '.mqo']
+    if others:
+        return None
+    if not sessions:
+        raise MQ2Exception('Invalid dataset: your input cannot not be '
+                           'processed by any of the current plugins.')
+    return {'plugin': MapQTLPlugin.name,
+            'sessions': sessions}
+
+
+def link_tree(source, target, ignore=None):
+    """ Copy a folder using hard links to the original files when
+    possible, the files are copied otherwise.
+
+    @param source the folder to copy.
+    @param target the folder to create, it may already exist.
+    @param ignore a function returning whether a file should not be
+        copied, given its name.
+    """
+    for root, dirs, files in os.walk(source):
+        folder = os.path.normpath(
+            os.path.join(target, os.path.relpath(root, source)))
+        if not os.path.exists(folder):
+            os.mkdir(folder)
+        for filename in files:
+            if ignore and ignore(filename):
+                continue
+            try:
+                os.link(os.path.join(root, filename),
+                        os.path.join(folder, filename))
+            except OSError:
+                shutil.copy2(os.path.join(root, filename),
+                             os.path.join(folder, filename))
+
+
+def write_digest(filename, digest):
+    """ Store the SHA-256 of a file next to it, in a ``.sha256`` file.
+
+    @param filename the path to the file hashed.
+    @param digest the SHA-256 of this file.
+    """
+    try:
+        stream = open('%s.sha256' % filename, 'w')
+        stream.write(digest)
+        stream.close()
+    except IOError:
+        # Not being able to store the digest only costs time
+        pass
+
+
+def archive_digest(filename, store=True):
+    """ Return the SHA-256 of the content of the specified file.
+    The digest is stored next to the file, in a ``.sha256`` file, so
+    that it is only computed once.
+
+    @param filename the path to the file to hash.
+    @param store whether to store the digest next to the file when it
+        is computed, it is not for the files which must not be written
+        next to.
+    """
+    digest_file = '%s.sha256' % filename
+    if os.path.exists(digest_file) and \
+            os.path.getmtime(digest_file) >= os.path.getmtime(filename):
+        stream = open(digest_file)
+        try:
+            return stream.read().strip()
+        finally:
+            stream.close()
+
+    sha = hashlib.sha256()
+    stream = open(filename, 'rb')
+    try:
+        chunk = stream.read(CHUNK_SIZE)
+        while chunk:
+            sha.update(chunk)
+            chunk = stream.read(CHUNK_SIZE)
+    finally:
+        stream.close()
+    digest = sha.hexdigest()
+    if store:
+        write_digest(filename, digest)
+    return digest
+
+
+class ArchiveWriter(object):
+    """ File-like object in which an archive is written as it is
+    uploaded.
+
+    The archive is hashed while it is written and the header of each of
+    its files is inspected so that an upload which is not a zip archive,
+    whose content is too large or which contains no file the plugins can
+    work on, is rejected as soon as possible rather than once it is fully
+    stored.
+    """
+
+    def __init__(self, folder, max_size=None, max_content_size=None):
+        """ Constructor.
+
+        @param folder the folder in which to write the archive.
+        @param max_size the maximum size (in bytes) of the archive.
+        @param max_content_size the maximum size (in bytes) of the
+            archive once extracted.
+        """
+        self.max_size = max_size
+        self.max_content_size = max_content_size
+        self.size = 0
+        self.content_size = 0
+        self.sha = hashlib.sha256()
+        handle, self.name = tempfile.mkstemp(prefix='.tmp-', dir=folder)
+        # mkstemp only gives access to the owner of the file
+        os.chmod(self.name, 0o666 & ~UMASK)
+        self.stream = os.fdopen(handle, 'w+b')
+        self._buffer = ''
+        self._skip = 0
+        self._entries = 0
+        self._input_files = 0
+        self._inspect = True
+
+    def __getattr__(self, name):
+        """ Give access to the methods of the underlying file. """
+        return getattr(self.stream, name)
+
+    def write(self, data):
+        """ Write a chunk of the archive.
+
+        @param data the content to write.
+        """
+        try:
+            self.size += len(data)
+            if self.max_size and self.size > self.max_size:
+                raise ArchiveTooLarge(
+                    'The file uploaded is larger than %s MB.' % (
+                        self.max_size / (1024 * 1024)))
+            if self._inspect:
+                self._read_headers(data)
+        except InvalidArchive:
+            self.discard()
+            raise
+        self.sha.update(data)
+        self.stream.write(data)
+
+    def _read_headers(self, data):
+        """ Read the headers of the files of the archive in the chunk
+        written, the data of these files is skipped.
+        Once the headers of all the files are read, the archive is
+        rejected if none of them is a file the plugins can work on.
+        The inspection stops at the first header which does not give the
+        size of the file, the content of the archive is then checked
+        using its central directory, once uploaded.
+
+        @param data the chunk of the archive written.
+        """
+        self._buffer += data
+        while True:
+            if self._skip:
+                skipped = min(self._skip, len(self._buffer))
+                self._buffer = self._buffer[skipped:]
+                self._skip -= skipped
+                if self._skip:
+                    return
+            if len(self._buffer) < LOCAL_HEADER_SIZE:
+                if self._entries == 0 and self._buffer \
+                        and not LOCAL_HEADER.startswith(self._buffer[:4]):
+                    raise InvalidArchive(
+                        'The file uploaded is not a zip archive.')
+                return
+            (signature, version, flags, method, mtime, mdate, crc,
+             compressed_size, size, name_length, extra_length) = \
+                struct.unpack(LOCAL_HEADER_FORMAT,
+                              self._buffer[:LOCAL_HEADER_SIZE])
+            if signature != LOCAL_HEADER:
+                if self._entries == 0:
+                    raise InvalidArchive(
+                        'The file uploaded is not a zip archive.')
+                # Central directory: all the files were seen
+                if not self._input_files:
+                    raise InvalidArchive(
+                        'The archive uploaded does not contain any MapQTL, '
+                        'CSV or Excel file.')
+                break
+            header_size = LOCAL_HEADER_SIZE + name_length + extra_length
+            if len(self._buffer) < header_size:
+                return
+            if is_input_file(self._buffer[
+                    LOCAL_HEADER_SIZE:LOCAL_HEADER_SIZE + name_length]):
+                self._input_files += 1
+            if flags & 0x08 or size == 0xffffffff:
+                # Sizes given after the data or in a zip64 extra field
+                break
+            self._entries += 1
+            self.content_size += size
+            self._check_content_size()
+            self._skip = compressed_size
+            self._buffer = self._buffer[header_size:]
+        self._inspect = False
+        self._buffer = ''
+
+    def _check_content_size(self):
+        """ Check that the size of the content of the archive is below
+        the maximum allowed.
+        """
+        if self.max_content_size \
+                and self.content_size > self.max_content_size:
+            raise ArchiveTooLarge(
+                'The content of the archive uploaded is larger than %s MB.'
+                % (self.max_content_size / (1024 * 1024)))
+
+    def finish(self):
+        """ Close the archive once it is fully written and check its
+        central directory: the archive must contain files the plugins
+        can work on, and must not be too large once extracted.
+
+        @return the SHA-256 of the archive.
+        """
+        self.stream.close()
+        try:
+            try:
+                infos = list_archive(self.name)
+            except (zipfile.BadZipfile, IOError):
+                raise InvalidArchive(
+                    'The file uploaded is not a zip archive.')
+            self.content_size = sum(info.file_size for info in infos)
+            self._check_content_size()
+            if not [info for info in infos if is_input_file(info.filename)]:
+                raise InvalidArchive(
+                    'The archive uploaded does not contain any MapQTL, CSV '
+                    'or Excel file.')
+        except InvalidArchive:
+            self.discard()
+            raise
+        return self.sha.hexdigest()
+
+    def discard(self):
+        """ Remove the archive written. """
+        self.stream.close()
+        if os.path.exists(self.name):
+            os.unlink(self.name)
+
+
+class BlobStore(object):
+    """ Content-addressed store of the uploaded archives.
+
+    Each archive is stored once, named after its SHA-256, and the
+    sessions uploading it get a hard link to it. An archive whose only
+    link is the one of the store is no longer used by any session.
+    """
+
+    def __init__(self, folder):
+        """ Constructor.
+
+        @param folder the folder in which the archives are stored.
+        """
+        self.folder = folder
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+    def get_path(self, digest):
+        """ Return the path of an archive in the store.
+
+        @param digest the SHA-256 of the archive.
+        """
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def get_writer(self, max_size=None, max_content_size=None):
+        """ Return a file-like object in which to write an archive to
+        store.
+
+        @param max_size the maximum size (in bytes) of the archive.
+        @param max_content_size the maximum size (in bytes) of the
+            archive once extracted.
+        """
+        return ArchiveWriter(self.folder, max_size=max_size,
+                             max_content_size=max_content_size)
+
+    def add(self, stream):
+        """ Check and store an archive.
+
+        @param stream the `ArchiveWriter` in which the archive was
+            written, or any file-like object from which to read it.
+        @return the SHA-256 of the archive.
+        """
+        writer = stream
+        if not isinstance(stream, ArchiveWriter):
+            writer = self.get_writer()
+            chunk = stream.read(CHUNK_SIZE)
+            while chunk:
+                writer.write(chunk)
+                chunk = stream.read(CHUNK_SIZE)
+        digest = writer.finish()
+
+        blob = self.get_path(digest)
+        if not os.path.exists(os.path.dirname(blob)):
+            try:
+                os.mkdir(os.path.dirname(blob))
+            except OSError:
+                # Created concurrently
+                pass
+        if os.path.exists(blob):
+            os.unlink(writer.name)
+        else:
+            os.rename(writer.name, blob)
+        return digest
+
+    def link(self, digest, target):
+        """ Make a stored archive available at the target path.
+
+        @param digest the SHA-256 of the archive.
+        @param target the path at which the session expects the archive.
+        """
+        blob = self.get_path(digest)
+        try:
+            os.link(blob, target)
+        except OSError:
+            shutil.copy2(blob, target)
+        write_digest(target, digest)
+
+    def clean(self):
+        """ Remove the archives which are no longer used by any session
+        as well as the uploads left unfinished.
+        @return the number of archives removed.
+        """
+        cnt = 0
+        for root, dirs, files in os.walk(self.folder):
+            for filename in files:
+                path = os.path.join(root, filename)
+                stat = os.stat(path)
+                if filename.startswith('.'):
+                    if time.time() - stat.st_mtime > TMP_FILE_AGE:
+                        os.unlink(path)
+                elif stat.st_nlink == 1:
+                    os.unlink(path)
+                    cnt += 1
+        return cnt
+
+
+class ArchiveCache(object):
+    """ Size-bounded cache of the extracted input archives.
+
+    Each entry is a folder named after the SHA-256 of the archive and
+    containing the extracted ``data`` as well as an ``archive.json``
+    file with the name of the plugin and the list of sessions. Entries
+    are evicted in the least recently used order.
+
+    An entry is pinned by a shared lock, in the ``.locks`` folder, while
+    it is extracted or copied; the eviction, which runs under its own
+    lock, skips the entries pinned so that none is removed while in use.
+    """
+
+    def __init__(self, folder, max_size):
+        """ Constructor.
+
+        @param folder the folder in which the archives are extracted.
+        @param max_size the maximum size (in bytes) of the cache.
+        """
+        self.folder = folder
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self.locks = os.path.join(self.folder, '.locks')
+        if not os.path.exists(self.locks):
+            os.makedirs(self.locks)
+
+    def pin(self, digest):
+        """ Return the lock to hold for the entry of an archive not to
+        be evicted, e.g.::
+
+            with cache.pin(digest):
+                ...
+
+        @param digest the SHA-256 of the archive.
+        """
+        return FileLock(os.path.join(self.locks, '%s.lock' % digest),
+                        shared=True)
+
+    def stats(self):
+        """ Return the number of hits and misses of the cache. """
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def get(self, inputzip, digest=None):
+        """ Return the cache entry of the specified archive, extracting
+        it if it is not already in the cache.
+
+        @param inputzip the path to the archive.
+        @param digest the SHA-256 of the archive if it is already known.
+        @return a tuple containing the folder of the extracted archive
+            and a dictionary with the `plugin` name, the `sessions` and
+            the `digest` of the archive.
+        """
+        if digest is None:
+            digest = archive_digest(inputzip)
+        with self.pin(digest):
+            result = self._get(inputzip, digest)
+        self.evict(keep=(digest,))
+        return result
+
+    def _get(self, inputzip, digest):
+        """ Return the cache entry of an archive as `get` does, the entry
+        being pinned by the caller.
+
+        @param inputzip the path to the archive.
+        @param digest the SHA-256 of the archive.
+        """
+        entry = os.path.join(self.folder, digest)
+        infos = self._read_entry(entry)
+        if infos is not None:
+            with self._lock:
+                self.hits += 1
+            CACHE_REQUESTS.inc(result='hit')
+            # Mark the entry as recently used
+            os.utime(entry, None)
+            return (os.path.join(entry, 'data'), infos)
+
+        with self._lock:
+            self.misses += 1
+        CACHE_REQUESTS.inc(result='miss')
+        tmp_entry = tempfile.mkdtemp(prefix='.tmp-%s-' % digest,
+                                     dir=self.folder)
+        try:
+            data = os.path.join(tmp_entry, 'data')
+            with EXTRACTION_TIME.time():
+                extract_zip(inputzip, data)
+            plugin = get_plugin_and_folder(inputdir=data)[0]
+            sessions = []
+            if plugin.session_name:
+                sessions = sorted(plugin.get_session_identifiers(data))
+            size = 0
+            for root, dirs, files in os.walk(data):
+                for filename in files:
+                    size += os.path.getsize(os.path.join(root, filename))
+            infos = {'digest': digest,
+                     'plugin': plugin.name,
+                     'sessions': sessions,
+                     'size': size}
+            stream = open(os.path.join(tmp_entry, 'archive.json'), 'w')
+            try:
+                json.dump(infos, stream)
+            finally:
+                stream.close()
+            try:
+                os.rename(tmp_entry, entry)
+            except OSError:
+                # The archive was extracted concurrently, use that one
+                pass
+        finally:
+            if os.path.exists(tmp_entry):
+                shutil.rmtree(tmp_entry)
+        return (os.path.join(entry, 'data'), infos)
+
+    def describe(self, inputzip, digest=None):
+        """ Return the information about an archive: the name of the
+        plugin able to process it and the sessions it contains.
+        The archive is only extracted if this cannot be found from the
+        name of its files and it is not already in the cache.
+
+        @param inputzip the path to the archive.
+        @param digest the SHA-256 of the archive if it is already known.
+        @return a dictionary with the `plugin` name, the `sessions` and
+            the `digest` of the archive.
+        """
+        if digest is None:
+            digest = archive_digest(inputzip)
+        entry = os.path.join(self.folder, digest)
+        infos = self._read_entry(entry)
+        if infos is not None:
+            with self._lock:
+                self.hits += 1
+            CACHE_REQUESTS.inc(result='hit')
+            return infos
+        try:
+            infos = describe_archive(inputzip)
+        except zipfile.BadZipfile:
+            infos = None
+        if infos is None:
+            return self.get(inputzip, digest=digest)[1]
+        infos['digest'] = digest
+        return infos
+
+    def checkout(self, inputzip, digest=None):
+        """ Return a copy of the extracted archive that the caller owns
+        and may remove, as `run_mq2` does once it is done.
+        The copy is made of hard links to the cached files when
+        possible so that it is cheap and survives the eviction of the
+        entry.
+
+        @param inputzip the path to the archive.
+        @param digest the SHA-256 of the archive if it is already known.
+        @return a tuple containing the folder of the copy and the
+            information about the archive as returned by `get`.
+        """
+        if digest is None:
+            digest = archive_digest(inputzip)
+        with self.pin(digest):
+            data, infos = self._get(inputzip, digest)
+            folder = tempfile.mkdtemp(prefix='.checkout-', dir=self.folder)
+            link_tree(data, folder)
+        self.evict(keep=(digest,))
+        return (folder, infos)
+
+    def evict(self, keep=()):
+        """ Remove the least recently used entries until the cache is
+        smaller than its maximum size.
+        The entries pinned, being used by another request, are kept.
+
+        @param keep the SHA-256 of the archives whose entry must be kept,
+            such as the one just returned.
+        """
+        with FileLock(os.path.join(self.locks, '.evict.lock')):
+            entries = []
+            total = 0
+            for name in os.listdir(self.folder):
+                if name.startswith('.'):
+                    continue
+                entry = os.path.join(self.folder, name)
+                infos = self._read_entry(entry)
+                if infos is None:
+                    continue
+                total += infos['size']
+                if name not in keep:
+                    entries.append(
+                        (os.path.getmtime(entry), infos['size'], name))
+            entries.sort()
+            while total > self.max_size and entries:
+                mtime, size, name = entries.pop(0)
+                lock = FileLock(os.path.join(self.locks, '%s.lock' % name))
+                if not lock.acquire(blocking=False):
+                    # The entry is in use
+                    continue
+                try:
+                    # Hide the entry before removing it so that it is
+                    # never found partially removed
+                    removed = tempfile.mkdtemp(prefix='.evicted-',
+                                               dir=self.folder)
+                    os.rename(os.path.join(self.folder, name),
+                              os.path.join(removed, name))
+                finally:
+                    lock.release()
+                shutil.rmtree(removed, ignore_errors=True)
+                total -= size
+
+    def _read_entry(self, entry):
+        """ Return the information stored about an entry of the cache or
+        None if there is no such entry.
+
+        @param entry the folder of the entry in the cache.
+        """
+        try:
+            stream = open(os.path.join(entry, 'archive.json'))
+        except IOError:
+            return None
+        try:
+            return json.load(stream)
+        except ValueError:
+            return None
+        finally:
+            stream.close()
@@ -0,0 +1,321 @@
+#!/usr/bin/python
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+
+Catalog of the sessions and experiments of MQ².
+
+The catalog is a SQLite database indexing the sessions and the
+parameters of their experiments, so that the web-application does not
+have to browse the upload folder and read every ``exp.cfg`` file.
+
+Run this script to import in the catalog the sessions and experiments
+created before it existed.
+"""
+
+import datetime
+import sqlite3
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    created TIMESTAMP,
+    last_access TIMESTAMP,
+    archive TEXT
+);
+CREATE TABLE IF NOT EXISTS experiments (
+    session_id TEXT NOT NULL,
+    exp_id TEXT NOT NULL,
+    lod_threshold REAL,
+    session TEXT,
+    plugin TEXT,
+    n_markers INTEGER,
+    n_traits INTEGER,
+    created TIMESTAMP,
+    last_access TIMESTAMP,
+    PRIMARY KEY (session_id, exp_id)
+);
+CREATE INDEX IF NOT EXISTS experiments_parameters
+    ON experiments (session_id, session, lod_threshold);
+"""
+
+# Indexes on the columns added to the catalog after its creation
+INDEXES = """
+CREATE INDEX IF NOT EXISTS sessions_archive ON sessions (archive);
+"""
+
+
+def normalize_session(session):
+    """ Return the representation of a MapQTL session as stored in the
+    catalog, `2` and `'2'` being the same session.
+
+    @param session the MapQTL session/run or Excel sheet.
+    """
+    try:
+        session = int(session)
+    except (ValueError, TypeError):
+        pass
+    return u'%s' % session
+
+
+class Catalog(object):
+    """ SQLite catalog of the sessions and experiments. """
+
+    def __init__(self, path):
+        """ Constructor.
+
+        @param path the path to the SQLite database.
+        """
+        self.path = path
+        conn = self.connect()
+        try:
+            conn.executescript(SCHEMA)
+            columns = [row['name'] for row in
+                       conn.execute('PRAGMA table_info(sessions)')]
+            if 'archive' not in columns:
+                conn.execute('ALTER TABLE sessions ADD COLUMN archive TEXT')
+            conn.executescript(INDEXES)
+        finally:
+            conn.close()
+
+    def connect(self):
+        """ Return a new connection to the database.
+        Connections are not shared so that the catalog can be used from
+        several threads and processes.
+        """
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _execute(self, query, args=()):
+        """ Run a query modifying the catalog.
+
+        @param query the SQL query to run.
+        @param args the arguments of the query.
+        """
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute(query, args)
+        finally:
+            conn.close()
+
+    def _fetch(self, query, args=()):
+        """ Run a query and return all the rows it returned.
+
+        @param query the SQL query to run.
+        @param args the arguments of the query.
+        """
+        conn = self.connect()
+        try:
+            return conn.execute(query, args).fetchall()
+        finally:
+            conn.close()
+
+    def add_session(self, session_id, created=None, archive=None):
+        """ Add a session to the catalog.
+
+        @param session_id the session identifier.
+        @param created when the session was created, defaults to now.
+        @param archive the SHA-256 of the archive uploaded in this
+            session, if known.
+        """
+        created = created or datetime.datetime.now()
+        self._execute(
+            'INSERT OR IGNORE INTO sessions (session_id, created, '
+            'last_access, archive) VALUES (?, ?, ?, ?)',
+            (session_id, created, created, archive))
+
+    def set_archive(self, session_id, archive):
+        """ Record the SHA-256 of the archive uploaded in a session.
+
+        @param session_id the session identifier.
+        @param archive the SHA-256 of the archive.
+        """
+        self._execute(
+            'UPDATE sessions SET archive = ? WHERE session_id = ? '
+            'AND archive IS NULL', (archive, session_id))
+
+    def has_session(self, session_id):
+        """ Return whether the session is in the catalog.
+
+        @param session_id the session identifier.
+        """
+        return bool(self._fetch(
+            'SELECT 1 FROM sessions WHERE session_id = ?', (session_id,)))
+
+    def get_last_accesses(self):
+        """ Return when each session of the catalog was last accessed.
+
+        @return a dictionary of the date of the last access, as stored in
+            the catalog, by session identifier.
+        """
+        return dict((row['session_id'], row['last_access'])
+                    for row in self._fetch(
+                        'SELECT session_id, last_access FROM sessions'))
+
+    def remove_session(self, session_id):
+        """ Remove a session and its experiments from the catalog.
+
+        @param session_id the session identifier.
+        """
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute('DELETE FROM experiments WHERE session_id = ?',
+                             (session_id,))
+                conn.execute('DELETE FROM sessions WHERE session_id = ?',
+                             (session_id,))
+        finally:
+            conn.close()
+
+    def touch(self, session_id, exp_id=None):
+        """ Record an access to a session or to one of its experiments.
+
+        @param session_id the session identifier.
+        @param exp_id the experiment identifier, if an experiment was
+            accessed.
+        """
+        now = datetime.datetime.now()
+        conn = self.connect()
+        try:
+            with conn:
+                conn.execute('UPDATE sessions SET last_access = ? '
+                             'WHERE session_id = ?', (now, session_id))
+                if exp_id is not None:
+                    conn.execute('UPDATE experiments SET last_access = ? '
+                                 'WHERE session_id = ? AND exp_id = ?',
+                                 (now, session_id, exp_id))
+        finally:
+            conn.close()
+
+    def add_experiment(self, session_id, exp_id, lod_threshold, session,
+                       plugin, n_markers, n_traits, created=None):
+        """ Add an experiment to the catalog.
+
+        @param session_id the session identifier.
+        @param exp_id the experiment identifier.
+        @param lod_threshold the LOD threshold used in this experiment.
+        @param session the MapQTL session/run used in this experiment.
+        @param plugin the name of the plugin used in this experiment.
+        @param n_markers the number of markers present in the dataset.
+        @param n_traits the number of traits present in the dataset.
+        @param created when the experiment was run, defaults to now.
+        """
+        created = created or datetime.datetime.now()
+        self.add_session(session_id, created=created)
+        self._execute(
+            'INSERT OR REPLACE INTO experiments (session_id, exp_id, '
+            'lod_threshold, session, plugin, n_markers, n_traits, '
+            'created, last_access) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (session_id, exp_id, lod_threshold, normalize_session(session),
+             plugin, n_markers, n_traits, created, created))
+
+    def get_experiment(self, session_id, exp_id):
+        """ Return the parameters of an experiment or None if there is no
+        such experiment in the catalog.
+        The parameters are returned in the same form as
+        `retrieve_exp_info`.
+
+        @param session_id the session identifier.
+        @param exp_id the experiment identifier.
+        """
+        rows = self._fetch(
+            'SELECT * FROM experiments WHERE session_id = ? AND exp_id = ?',
+            (session_id, exp_id))
+        if not rows:
+            return None
+        return {'lod_threshold': rows[0]['lod_threshold'],
+                'session': rows[0]['session'],
+                'experiment_id': rows[0]['exp_id'],
+                'n_markers': rows[0]['n_markers'],
+                'n_traits': rows[0]['n_traits'],
+                'plugin': rows[0]['plugin']}
+
+    def get_experiment_ids(self, session_id):
+        """ Return the identifiers of the experiments of a session.
+
+        @param session_id the session identifier.
+        """
+        return [row['exp_id'] for row in self._fetch(
+            'SELECT exp_id FROM experiments WHERE session_id = ?',
+            (session_id,))]
+
+    def find_experiment(self, session_id, lod_threshold, session):
+        """ Return the identifier of the experiment of a session which
+        used the provided parameters or None if there is none.
+
+        @param session_id the session identifier.
+        @param lod_threshold the LOD threshold of the experiment.
+        @param session the MapQTL session/run of the experiment.
+        """
+        rows = self._fetch(
+            'SELECT exp_id FROM experiments WHERE session_id = ? '
+            'AND session = ? AND lod_threshold = ?',
+            (session_id, normalize_session(session), float(lod_threshold)))
+        if rows:
+            return rows[0]['exp_id']
+        return None
+
+    def find_base_experiments(self, session_id, lod_threshold, session):
+        """ Return the experiments of a session run on the same
+        MapQTL session/run with a lower LOD threshold, from which an
+        experiment with the provided parameters can be derived.
+
+        @param session_id the session identifier.
+        @param lod_threshold the LOD threshold of the experiment.
+        @param session the MapQTL session/run of the experiment.
+        @return the list of experiment identifiers, the one with the
+            highest LOD threshold first.
+        """
+        return [row['exp_id'] for row in self._fetch(
+            'SELECT exp_id FROM experiments WHERE session_id = ? '
+            'AND session = ? AND lod_threshold < ? '
+            'ORDER BY lod_threshold DESC',
+            (session_id, normalize_session(session), float(lod_threshold)))]
+
+    def find_shared_experiments(self, archive, lod_threshold, session):
+        """ Return the experiments run, in any session, on the same
+        archive with the provided parameters.
+
+        @param archive the SHA-256 of the archive.
+        @param lod_threshold the LOD threshold of the experiment.
+        @param session the MapQTL session/run of the experiment.
+        @return a list of (session_id, exp_id) tuples, the most recent
+            experiment first.
+        """
+        return [(row['session_id'], row['exp_id']) for row in self._fetch(
+            'SELECT experiments.session_id, experiments.exp_id '
+            'FROM experiments JOIN sessions '
+            'ON experiments.session_id = sessions.session_id '
+            'WHERE sessions.archive = ? AND experiments.session = ? '
+            'AND experiments.lod_threshold = ? '
+            'ORDER BY experiments.created DESC',
+            (archive, normalize_session(session), float(lod_threshold)))]
+
+
+if __name__ == '__main__':
+    import mq2_web
+    print '%s sessions imported in the catalog' % (
+        mq2_web.import_catalog())
@@ -0,0 +1,600 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+
+Background execution of the MQ² experiments.
+
+Jobs are run by a pool of worker processes, their status is kept in a
+small ``<job_id>.job`` file stored in the session folder so that any
+process of the web-application can report on it. The processes
+coordinate using locks held on files, see `FileLock`.
+While it runs, a job appends the stages it goes through to a
+``<job_id>.progress`` file, see `JobProgress`.
+The processing of the input files is run in a child process of the
+worker, limited in CPU time, wall-clock time and memory, which is
+killed if it exceeds them or if the job is cancelled, see
+`run_sandboxed`. Outside of the workers, this child process is a new
+interpreter running this module.
+"""
+
+import ConfigParser
+import datetime
+import errno
+import fcntl
+import json
+import logging
+import multiprocessing
+import os
+import cPickle as pickle
+import resource
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+from mq2_metrics import METRICS
+
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+LOG = logging.getLogger('mq2_jobs')
+
+# Metrics of the jobs run by the workers
+JOB_TIME = METRICS.histogram(
+    'mq2_job_duration_seconds',
+    'Time spent running the jobs in the workers, done or failed',
+    ('status',))
+FAILED_JOBS = METRICS.counter(
+    'mq2_jobs_failed_total', 'Jobs which raised an exception in the workers')
+
+# Time (in seconds) between two checks of the limits of a sandboxed job
+SANDBOX_INTERVAL = 0.2
+
+
+class JobAborted(Exception):
+    """ Raised when a job is stopped before it finished because it
+    exceeded one of its limits.
+    """
+    pass
+
+
+class JobCancelled(JobAborted):
+    """ Raised when a job is stopped because it was cancelled. """
+    pass
+
+
+def get_job_file(folder, job_id):
+    """ Return the path to the file containing the status of a job.
+
+    @param folder the session folder in which the job is run.
+    @param job_id the identifier of the job.
+    """
+    return os.path.join(folder, '%s.job' % job_id)
+
+
+def write_job_status(folder, job_id, status, **kwargs):
+    """ Write down the status of a job, the file is written in a
+    temporary file and then moved in place so that it is never read
+    half-written.
+
+    @param folder the session folder in which the job is run.
+    @param job_id the identifier of the job.
+    @param status the new status of the job.
+    @param kwargs any other information to store about the job.
+    """
+    config = ConfigParser.RawConfigParser()
+    config.read(get_job_file(folder, job_id))
+    if not config.has_section('Job'):
+        config.add_section('Job')
+    config.set('Job', 'job_id', job_id)
+    config.set('Job', 'status', status)
+    config.set('Job', status, datetime.datetime.now())
+    for key in kwargs:
+        config.set('Job', key, kwargs[key])
+
+    tmp_file = '%s.%s' % (get_job_file(folder, job_id), os.getpid())
+    stream = open(tmp_file, 'wb')
+    try:
+        config.write(stream)
+    finally:
+        stream.close()
+    os.rename(tmp_file, get_job_file(folder, job_id))
+
+
+def read_job_status(folder, job_id):
+    """ Retrieve the information about a job.
+
+    @param folder the session folder in which the job is run.
+    @param job_id the identifier of the job.
+    @return a dictionary of the information known about this job or
+        None if there is no such job.
+    """
+    config = ConfigParser.RawConfigParser()
+    if not config.read(get_job_file(folder, job_id)) \
+            or not config.has_section('Job'):
+        return None
+    return dict(config.items('Job'))
+
+
+def get_cancel_file(folder, job_id):
+    """ Return the path to the file asking a job to stop.
+
+    @param folder the session folder in which the job is run.
+    @param job_id the identifier of the job.
+    """
+    return os.path.join(folder, '%s.cancel' % job_id)
+
+
+def request_cancel(folder, job_id):
+    """ Ask a job to stop, the process running it checks for it while it
+    runs, see `JobProgress.cancelled`.
+
+    @param folder the session folder in which the job is run.
+    @param job_id the identifier of the job.
+    """
+    open(get_cancel_file(folder, job_id), 'w').close()
+
+
+def get_progress_file(folder, job_id):
+    """ Return the path to the file containing the progress events of a
+    job.
+
+    @param folder the session folder in which the job is run.
+    @param job_id the identifier of the job.
+    """
+    return os.path.join(folder, '%s.progress' % job_id)
+
+
+class JobProgress(object):
+    """ Progress of a running job: each stage it goes through is
+    appended, as a line of JSON, to its ``<job_id>.progress`` file
+    together with the time elapsed since the job started.
+    """
+
+    def __init__(self, folder, job_id):
+        """ Constructor, the events of a previous run of the job are
+        discarded.
+
+        @param folder the session folder in which the job is run.
+        @param job_id the identifier of the job.
+        """
+        self.path = get_progress_file(folder, job_id)
+        self.cancel_file = get_cancel_file(folder, job_id)
+        self.start = time.time()
+        open(self.path, 'w').close()
+
+    def emit(self, stage, **kwargs):
+        """ Record that the job reached a stage.
+
+        @param stage the name of the stage.
+        @param kwargs any other information about the stage, it must be
+            serializable in JSON.
+        """
+        event = dict(kwargs)
+        event['stage'] = stage
+        event['elapsed'] = round(time.time() - self.start, 3)
+        # A single write to a file opened in append mode, the readers
+        # never see the events of two jobs interleaved
+        stream = open(self.path, 'a')
+        try:
+            stream.write(json.dumps(event) + '\n')
+        finally:
+            stream.close()
+
+    def cancelled(self):
+        """ Return whether the job was asked to stop, see
+        `request_cancel`.
+        """
+        return os.path.exists(self.cancel_file)
+
+    def close(self):
+        """ Forget the request to stop the job, once it is finished. """
+        if os.path.exists(self.cancel_file):
+            os.unlink(self.cancel_file)
+
+
+class NoProgress(object):
+    """ Progress of an experiment not run as a job, nothing is recorded.
+    """
+
+    def emit(self, stage, **kwargs):
+        """ See `JobProgress.emit`. """
+        pass
+
+    def cancelled(self):
+        """ See `JobProgress.cancelled`. """
+        return False
+
+
+def read_progress(folder, job_id, offset=0):
+    """ Retrieve the progress events of a job recorded after a given
+    position of its progress file.
+    A line not completely written yet is left for the next call.
+
+    @param folder the session folder in which the job is run.
+    @param job_id the identifier of the job.
+    @param offset the position in the file from which to read, the
+        position returned with the last event previously read.
+    @return the list of (position after the event, event) read.
+    """
+    try:
+        stream = open(get_progress_file(folder, job_id))
+    except IOError:
+        return []
+    try:
+        stream.seek(0, os.SEEK_END)
+        if offset > stream.tell():
+            # The job was run again since the last read
+            offset = 0
+        stream.seek(offset)
+        events = []
+        for line in iter(stream.readline, ''):
+            if not line.endswith('\n'):
+                break
+            offset += len(line)
+            try:
+                events.append((offset, json.loads(line)))
+            except ValueError:
+                continue
+    finally:
+        stream.close()
+    return events
+
+
+class FileLock(object):
+    """ Lock held on a file, shared by all the processes (and threads) of
+    the web-application. The lock is released by the system if the
+    process holding it stops.
+    The lock is exclusive unless it is a shared lock: any number of
+    shared locks may be held at once, but not together with the
+    exclusive lock.
+    """
+
+    def __init__(self, path, shared=False):
+        """ Constructor.
+
+        @param path the path to the file to lock, it is created if it
+            does not exist.
+        @param shared whether the lock is a shared lock.
+        """
+        self.path = path
+        self.shared = shared
+        self._stream = None
+
+    def acquire(self, blocking=True):
+        """ Acquire the lock, waiting for it to be released if another
+        process holds it.
+        Returns whether the lock was acquired.
+
+        @param blocking whether to wait for the lock, if False the lock
+            is only acquired if no other process holds it.
+        """
+        stream = open(self.path, 'a')
+        flags = fcntl.LOCK_SH if self.shared else fcntl.LOCK_EX
+        if not blocking:
+            flags |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(stream.fileno(), flags)
+        except IOError, err:
+            stream.close()
+            if err.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self._stream = stream
+        return True
+
+    def release(self):
+        """ Release the lock. """
+        if self._stream is not None:
+            fcntl.flock(self._stream.fileno(), fcntl.LOCK_UN)
+            self._stream.close()
+            self._stream = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def _set_limit(limit, value):
+    """ Set a resource limit of the current process, without going over
+    the limit set for the web-application itself.
+
+    @param limit the resource, ie: `resource.RLIMIT_CPU`.
+    @param value the soft limit to set, the hard limit is one more so
+        that the process is told before being killed.
+    """
+    hard = resource.getrlimit(limit)[1]
+    if hard != resource.RLIM_INFINITY:
+        value = min(value, hard - 1)
+        resource.setrlimit(limit, (value, hard))
+    else:
+        resource.setrlimit(limit, (value, value + 1))
+
+
+def _run_child(output, function, args, cpu_time, memory):
+    """ Run the function of `run_sandboxed` in the child process and
+    send back its result, or the exception it raised, never returns.
+    """
+    try:
+        try:
+            if cpu_time:
+                _set_limit(resource.RLIMIT_CPU, cpu_time)
+            if memory:
+                _set_limit(resource.RLIMIT_AS, memory * 1024 * 1024)
+            result = (True, function(*args))
+        # Whatever went wrong is reported to the parent process
+        except BaseException, err:
+            result = (False, err)
+        try:
+            data = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+        except (pickle.PicklingError, TypeError):
+            data = pickle.dumps((False, JobAborted(str(result[1]))),
+                                pickle.HIGHEST_PROTOCOL)
+        while data:
+            data = data[os.write(output, data):]
+    finally:
+        os._exit(0)
+
+
+def _call(module, name, args):
+    """ Run a function given by its name, in the interpreter started by
+    `run_sandboxed`.
+
+    @param module the name of the module of the function.
+    @param name the name of the function.
+    @param args the arguments to give to the function.
+    """
+    __import__(module)
+    return getattr(sys.modules[module], name)(*args)
+
+
+def _start_child(function, args, cpu_time, memory, fork):
+    """ Start the child process of `run_sandboxed`.
+    Returns its pid and the descriptor from which to read its result.
+    """
+    if fork:
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            _run_child(write_fd, function, args, cpu_time, memory)
+        os.close(write_fd)
+        return (pid, read_fd)
+
+    module = function.__module__
+    if module == '__main__':
+        module = os.path.splitext(os.path.basename(
+            sys.modules['__main__'].__file__))[0]
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        os.path.abspath(path) for path in sys.path)
+    child = subprocess.Popen([sys.executable, '-m', 'mq2_jobs'],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             close_fds=True, env=env)
+    read_fd = os.dup(child.stdout.fileno())
+    child.stdout.close()
+    try:
+        pickle.dump((module, function.__name__, args, cpu_time, memory),
+                    child.stdin, pickle.HIGHEST_PROTOCOL)
+        child.stdin.close()
+    except IOError:
+        # The child process stopped, it is reported as such
+        pass
+    return (child.pid, read_fd)
+
+
+def run_sandboxed(function, args=(), cpu_time=0, wall_time=0, memory=0,
+                  cancelled=None, fork=None):
+    """ Run a function in a child process limited in CPU time, wall-clock
+    time and memory, and return its result.
+    The child process is killed if it exceeds its limits or if the job
+    is cancelled, a `JobAborted` exception giving the cause is then
+    raised. The exceptions raised by the function are raised again.
+
+    @param function the function to run.
+    @param args the arguments to give to the function.
+    @param cpu_time the CPU time (in seconds) the function may use, 0
+        for no limit.
+    @param wall_time the time (in seconds) the function may run, 0 for
+        no limit.
+    @param memory the memory (in MB) the child process may use, 0 for no
+        limit.
+    @param cancelled a function returning whether the job was cancelled.
+    @param fork whether to fork the current process rather than to start
+        a new interpreter, the function then has to be defined at the top
+        level of a module. By default, only the workers of the
+        `JobQueue`, which run a single thread, are forked: the child of a
+        process running several threads may wait forever for a lock held
+        by one of them.
+    """
+    if cancelled is not None and cancelled():
+        raise JobCancelled('The job was cancelled')
+    if fork is None:
+        fork = multiprocessing.current_process().name != 'MainProcess'
+    pid, read_fd = _start_child(function, args, cpu_time, memory, fork)
+    end = time.time() + wall_time if wall_time else None
+    chunks = []
+    finished = False
+    reason = None
+    try:
+        while reason is None:
+            if select.select([read_fd], [], [], SANDBOX_INTERVAL)[0]:
+                chunk = os.read(read_fd, 65536)
+                if not chunk:
+                    finished = True
+                    break
+                chunks.append(chunk)
+            elif end is not None and time.time() >= end:
+                reason = JobAborted('The job exceeded its wall-clock '
+                                    'limit of %s seconds' % wall_time)
+            elif cancelled is not None and cancelled():
+                reason = JobCancelled('The job was cancelled')
+    finally:
+        os.close(read_fd)
+        if not finished:
+            os.kill(pid, signal.SIGKILL)
+        status = os.waitpid(pid, 0)[1]
+    if reason is not None:
+        raise reason
+    if os.WIFSIGNALED(status):
+        if os.WTERMSIG(status) == signal.SIGXCPU and cpu_time:
+            raise JobAborted('The job exceeded its CPU time limit of %s '
+                             'seconds' % cpu_time)
+        raise JobAborted('The job was killed by the signal %s'
+                         % os.WTERMSIG(status))
+    try:
+        success, value = pickle.loads(''.join(chunks))
+    except (pickle.UnpicklingError, EOFError, ValueError):
+        raise JobAborted('The job stopped without result')
+    if success:
+        return value
+    if isinstance(value, MemoryError) and memory:
+        raise JobAborted('The job exceeded its memory limit of %s MB'
+                         % memory)
+    raise value
+
+
+def _run_measured(folder, job_id, function, args):
+    """ Run a job in a worker process and return what was measured
+    while running it, to be merged in the metrics of the web-application.
+    The job is measured whether it is done or failed, the exception it
+    raised is logged rather than raised again so that what was measured
+    is sent back as well. A job which failed without writing down its
+    status is marked as failed, so that it is never left queued or
+    running.
+
+    @param folder the session folder in which the job is run.
+    @param job_id the identifier of the job.
+    @param function the function to run.
+    @param args the arguments to give to the function.
+    """
+    start = time.time()
+    status = FAILED
+    try:
+        function(*args)
+        status = DONE
+    # Whatever went wrong, the metrics have to be sent back
+    except Exception, err:
+        FAILED_JOBS.inc()
+        LOG.exception('The job %s failed', job_id)
+        try:
+            infos = read_job_status(folder, job_id)
+            if infos is None or infos['status'] in (QUEUED, RUNNING):
+                write_job_status(folder, job_id, FAILED, error=err)
+        except (IOError, OSError), err:
+            LOG.error('Could not write down the status of the job %s: %s',
+                      job_id, err)
+    finally:
+        JOB_TIME.observe(time.time() - start, status=status)
+        values = METRICS.drain()
+    return values
+
+
+def get_job_ids(folder):
+    """ Retrieve the identifiers of all the jobs of a session.
+
+    @param folder the session folder in which the jobs are run.
+    """
+    return [filename.rsplit('.', 1)[0]
+            for filename in os.listdir(folder)
+            if filename.endswith('.job') and not filename.startswith('.')]
+
+
+class JobQueue(object):
+    """ Queue running the experiments in a pool of worker processes.
+
+    If the number of workers is 0, jobs are run directly in the
+    calling process.
+    """
+
+    def __init__(self, workers=0):
+        """ Constructor.
+
+        @param workers the number of processes to run the jobs in.
+        """
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def get_pool(self):
+        """ Return the pool of workers, creating it on first use so
+        that it is created in the process actually serving the requests.
+        """
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(
+                    self.workers, initializer=METRICS.reset)
+        return self._pool
+
+    def submit(self, folder, job_id, function, args=(), **kwargs):
+        """ Add a job to the queue.
+
+        @param folder the session folder in which the job is run.
+        @param job_id the identifier of the job.
+        @param function the function to run, it must be importable to be
+            sent to the workers.
+        @param args the arguments to give to the function.
+        @param kwargs any other information to store about the job.
+        """
+        write_job_status(folder, job_id, QUEUED, **kwargs)
+        if self.workers <= 0:
+            return function(*args)
+        self.get_pool().apply_async(
+            _run_measured, (folder, job_id, function, args),
+            callback=METRICS.merge)
+
+    def close(self):
+        """ Stop the pool of workers once all the queued jobs are
+        finished.
+        """
+        with self._lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
+
+
+def main():
+    """ Run the function of a sandboxed job, given on the standard input
+    by `run_sandboxed`, and write its result on the standard output.
+    """
+    # What the function prints goes to the standard error
+    output = os.dup(1)
+    os.dup2(2, 1)
+    module, name, args, cpu_time, memory = pickle.load(sys.stdin)
+    _run_child(output, _call, (module, name, args), cpu_time, memory)
+
+
+if __name__ == '__main__':
+    # Run from the module imported under its own name, for the
+    # exceptions sent back to be found by the parent process
+    from mq2_jobs import main
+    main()
@@ -0,0 +1,198 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+
+Layout of the session folders in the upload folder.
+
+The sessions are spread over two levels of shard folders named after the
+first characters of the MD5 of their identifier, ie: the session
+``20130520143012ABCD`` is in the ``3f/a2/20130520143012ABCD`` folder of
+the upload folder, so that no folder holds more than a few hundred
+entries.
+Sessions created before the sharding are directly in the upload folder,
+they are still found there until they are moved by ``migrate_uploads.py``.
+"""
+
+import hashlib
+import os
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+
+# Number of levels of shard folders and length of their name
+SHARD_DEPTH = 2
+SHARD_WIDTH = 2
+
+
+class _Entry(object):
+    """ Entry of a folder, with the interface of the entries returned by
+    `scandir` when it is not available.
+    """
+
+    def __init__(self, folder, name):
+        self.name = name
+        self.path = os.path.join(folder, name)
+        self._stat = None
+
+    def stat(self):
+        if self._stat is None:
+            self._stat = os.lstat(self.path)
+        return self._stat
+
+    def is_dir(self):
+        return os.path.isdir(self.path) and not os.path.islink(self.path)
+
+
+def list_folder(folder):
+    """ Return the entries of a folder, using `scandir` when it is
+    installed so that the type of the entries does not require reading
+    their inode.
+
+    @param folder the folder to list.
+    """
+    if scandir is not None:
+        return scandir(folder)
+    return [_Entry(folder, name) for name in os.listdir(folder)]
+
+
+def is_valid_session_id(session_id):
+    """ Return whether a session identifier may name a session folder: it
+    is not empty, not hidden and not a path, so that its folder is always
+    within the upload folder.
+
+    @param session_id the session identifier.
+    """
+    return bool(session_id) and not session_id.startswith('.') \
+        and '..' not in session_id and '/' not in session_id \
+        and os.sep not in session_id
+
+
+def get_shards(session_id):
+    """ Return the names of the shard folders of a session.
+
+    @param session_id the session identifier.
+    """
+    if isinstance(session_id, unicode):
+        session_id = session_id.encode('utf-8')
+    digest = hashlib.md5(session_id).hexdigest()
+    return [digest[cnt * SHARD_WIDTH:(cnt + 1) * SHARD_WIDTH]
+            for cnt in range(SHARD_DEPTH)]
+
+
+def is_shard(name):
+    """ Return whether a name is the one of a shard folder.
+
+    @param name the name of the folder.
+    """
+    return len(name) == SHARD_WIDTH \
+        and not name.strip('0123456789abcdef')
+
+
+def get_sharded_folder(upload_folder, session_id):
+    """ Return the folder of a session in the sharded layout.
+
+    @param upload_folder the upload folder.
+    @param session_id the session identifier.
+    """
+    return os.path.join(upload_folder, *(get_shards(session_id)
+                                         + [session_id]))
+
+
+def get_legacy_folder(upload_folder, session_id):
+    """ Return the folder of a session created before the sharding.
+
+    @param upload_folder the upload folder.
+    @param session_id the session identifier.
+    """
+    return os.path.join(upload_folder, session_id)
+
+
+def resolve_session_folder(upload_folder, session_id):
+    """ Return the folder of a session: its folder in the sharded layout
+    unless it is still in the upload folder itself.
+    New sessions are therefore always created in the sharded layout.
+    Raises a ValueError if the identifier is not valid, see
+    `is_valid_session_id`.
+
+    @param upload_folder the upload folder.
+    @param session_id the session identifier.
+    """
+    if not is_valid_session_id(session_id):
+        raise ValueError('Invalid session identifier: %r' % session_id)
+    folder = get_sharded_folder(upload_folder, session_id)
+    if not os.path.isdir(folder) and not is_shard(session_id):
+        legacy = get_legacy_folder(upload_folder, session_id)
+        if os.path.isdir(legacy):
+            return legacy
+    return folder
+
+
+def list_sessions(upload_folder):
+    """ Return the entries of the session folders of the upload folder,
+    in both layouts.
+    The hidden folders, used by the application itself (ie: the blob
+    store), are skipped.
+
+    @param upload_folder the upload folder.
+    """
+    output = []
+    folders = [(upload_folder, 0)]
+    while folders:
+        folder, depth = folders.pop()
+        for entry in list_folder(folder):
+            if entry.name.startswith('.') or not entry.is_dir():
+                continue
+            if depth < SHARD_DEPTH and is_shard(entry.name):
+                folders.append((entry.path, depth + 1))
+            elif depth in (0, SHARD_DEPTH):
+                output.append(entry)
+    return output
+
+
+def migrate_session(upload_folder, session_id):
+    """ Move a session from the upload folder itself to its folder in the
+    sharded layout.
+    The folder is renamed, which is atomic, so that the session is found
+    at one place or the other while it is being served.
+    Returns the new folder of the session, None if it was not in the
+    upload folder itself.
+
+    @param upload_folder the upload folder.
+    @param session_id the session identifier.
+    """
+    legacy = get_legacy_folder(upload_folder, session_id)
+    if is_shard(session_id) or not os.path.isdir(legacy):
+        return None
+    folder = get_sharded_folder(upload_folder, session_id)
+    parent = os.path.dirname(folder)
+    if not os.path.exists(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            # Created concurrently
+            pass
+    os.rename(legacy, folder)
+    return folder
@@ -0,0 +1,295 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+
+Metrics of the MQ² web-application.
+
+Counters and histograms are kept in memory by each process and rendered
+in the text format of Prometheus. The worker processes running the jobs
+send what they measured back to the web-application at the end of each
+job, see `Registry.drain` and `Registry.merge`.
+"""
+
+import threading
+import time
+
+
+# Upper bounds (in seconds) of the buckets of the histograms
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                   10, 30, 60, 120, 300)
+
+
+def _format_value(value):
+    """ Return the representation of a value in the Prometheus format.
+
+    @param value the number to represent.
+    """
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(names, values):
+    """ Return the representation of the labels of a sample.
+
+    @param names the names of the labels.
+    @param values the values of the labels.
+    """
+    if not names:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, unicode(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in zip(names, values))
+
+
+class Counter(object):
+    """ Value which can only increase, per set of labels. """
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        """ Constructor.
+
+        @param name the name of the counter.
+        @param description the description of the counter.
+        @param labels the names of the labels of the counter.
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _get_key(self, labels):
+        """ Return the values of the labels, in the order of their names.
+
+        @param labels a dictionary of the value of each label.
+        """
+        return tuple(labels.get(name, '') for name in self.labels)
+
+    def inc(self, value=1, **labels):
+        """ Increase the counter.
+
+        @param value the amount by which to increase the counter.
+        @param labels the value of each label.
+        """
+        key = self._get_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, **labels):
+        """ Return the value of the counter.
+
+        @param labels the value of each label.
+        """
+        return self._values.get(self._get_key(labels), 0)
+
+    def samples(self):
+        """ Return the samples of the counter, as a list of (name, label
+        names, label values, value) tuples.
+        """
+        with self._lock:
+            return [(self.name, self.labels, key, value)
+                    for key, value in sorted(self._values.items())]
+
+    def drain(self):
+        """ Return the values of the counter and reset it. """
+        with self._lock:
+            values, self._values = self._values, {}
+        return values
+
+    def merge(self, values):
+        """ Add values returned by `drain` to the counter.
+
+        @param values the values to add.
+        """
+        with self._lock:
+            for key, value in values.items():
+                self._values[key] = self._values.get(key, 0) + value
+
+
+class Histogram(Counter):
+    """ Distribution of observed values, per set of labels. """
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        """ Constructor.
+
+        @param name the name of the histogram.
+        @param description the description of the histogram.
+        @param labels the names of the labels of the histogram.
+        @param buckets the upper bounds of the buckets of the histogram.
+        """
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        """ Record a value.
+
+        @param value the value observed.
+        @param labels the value of each label.
+        """
+        key = self._get_key(labels)
+        with self._lock:
+            # The count of each bucket followed by the sum of the values,
+            # the count of the last bucket being the number of values
+            counts = self._values.setdefault(
+                key, [0] * len(self.buckets) + [0])
+            for cnt, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[cnt] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """ Return a context manager recording the time spent in it.
+
+        @param labels the value of each label.
+        """
+        return _Timer(self, labels)
+
+    def get(self, **labels):
+        """ Return the number of values recorded.
+
+        @param labels the value of each label.
+        """
+        counts = self._values.get(self._get_key(labels))
+        return counts[-2] if counts else 0
+
+    def samples(self):
+        """ Return the samples of the histogram: the cumulated count of
+        each bucket, the sum and the count of the values.
+        """
+        output = []
+        with self._lock:
+            for key, counts in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, counts):
+                    output.append(('%s_bucket' % self.name,
+                                   self.labels + ('le',),
+                                   key + (_format_value(bound),), count))
+                output.append(('%s_sum' % self.name, self.labels, key,
+                               counts[-1]))
+                output.append(('%s_count' % self.name, self.labels, key,
+                               counts[-2]))
+        return output
+
+    def merge(self, values):
+        """ Add values returned by `drain` to the histogram.
+
+        @param values the values to add.
+        """
+        with self._lock:
+            for key, counts in values.items():
+                current = self._values.setdefault(
+                    key, [0] * len(self.buckets) + [0])
+                for cnt, count in enumerate(counts):
+                    current[cnt] += count
+
+
+class _Timer(object):
+    """ Context manager recording in a histogram the time spent in it. """
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.time() - self.start, **self.labels)
+
+
+class Registry(object):
+    """ Set of the metrics of a process. """
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, *args, **kwargs):
+        """ Return the metric with the specified name, creating it if
+        needed.
+        """
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, *args, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, description, labels=()):
+        """ Return the counter with the specified name, creating it if
+        needed, see `Counter`.
+        """
+        return self._register(Counter, name, description, labels)
+
+    def histogram(self, name, description, labels=(),
+                  buckets=DEFAULT_BUCKETS):
+        """ Return the histogram with the specified name, creating it if
+        needed, see `Histogram`.
+        """
+        return self._register(Histogram, name, description, labels,
+                              buckets=buckets)
+
+    def drain(self):
+        """ Return the values of all the metrics and reset them, to send
+        them to another process.
+        """
+        return dict((name, metric.drain())
+                    for name, metric in self.metrics.items())
+
+    def reset(self):
+        """ Reset all the metrics, in a newly started worker process. """
+        self.drain()
+
+    def merge(self, values):
+        """ Add to the metrics the values returned by `drain` in another
+        process.
+
+        @param values the values of the metrics, by name.
+        """
+        if not values:
+            return
+        for name, metric_values in values.items():
+            if name in self.metrics:
+                self.metrics[name].merge(metric_values)
+
+    def render(self):
+        """ Return the metrics in the text format of Prometheus. """
+        lines = []
+        for name in sorted(self.metrics):
+            metric = self.metrics[name]
+            lines.append('# HELP %s %s' % (name, metric.description))
+            lines.append('# TYPE %s %s' % (name, metric.kind))
+            for sample, names, values, value in metric.samples():
+                lines.append('%s%s %s' % (
+                    sample, _format_labels(names, values),
+                    _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics of this process
+METRICS = Registry()
@@ -0,0 +1,112 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+
+Profiling of the requests served by the MQ² web-application.
+
+The middleware is only installed when a ``profile_folder`` is set in the
+configuration file. The requests selected are run under `cProfile` and
+their profile is written in this folder, it can then be read using the
+`pstats` module.
+"""
+
+import cProfile
+import os
+import random
+import re
+import time
+
+from werkzeug.exceptions import HTTPException
+
+
+class ProfilingMiddleware(object):
+    """ WSGI middleware profiling some of the requests served by an
+    application.
+    """
+
+    def __init__(self, app, url_map, folder, rate=1.0, sessions=None,
+                 endpoints=None):
+        """ Constructor.
+
+        @param app the WSGI application to profile.
+        @param url_map the URL map of the application, to find the
+            endpoint and the session of the requests.
+        @param folder the folder in which to write the profiles.
+        @param rate the fraction of the requests selected to profile.
+        @param sessions the sessions whose requests are profiled, all by
+            default.
+        @param endpoints the endpoints whose requests are profiled, all
+            by default.
+        """
+        self.app = app
+        self.url_map = url_map
+        self.folder = folder
+        self.rate = rate
+        self.sessions = set(sessions or [])
+        self.endpoints = set(endpoints or [])
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def match(self, environ):
+        """ Return the endpoint and the session of a request if it is to
+        be profiled, None otherwise.
+
+        @param environ the WSGI environment of the request.
+        """
+        try:
+            endpoint, args = self.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            return None
+        session_id = args.get('session_id', '')
+        if self.endpoints and endpoint not in self.endpoints:
+            return None
+        if self.sessions and session_id not in self.sessions:
+            return None
+        if self.rate < 1 and random.random() >= self.rate:
+            return None
+        return (endpoint, session_id)
+
+    def get_profile_file(self, endpoint, session_id, duration):
+        """ Return the path to the file in which to write the profile of
+        a request.
+
+        @param endpoint the endpoint of the request.
+        @param session_id the session of the request.
+        @param duration the time spent serving the request, in seconds.
+        """
+        name = '%s.%s.%dms.%s.%s.prof' % (
+            endpoint, session_id or '-', duration * 1000,
+            time.strftime('%Y%m%d%H%M%S'), os.getpid())
+        return os.path.join(self.folder, re.sub(r'[^\w.-]', '_', name))
+
+    def __call__(self, environ, start_response):
+        selected = self.match(environ)
+        if selected is None:
+            return self.app(environ, start_response)
+        profile = cProfile.Profile()
+        start = time.time()
+        try:
+            return profile.runcall(self.app, environ, start_response)
+        finally:
+            profile.dump_stats(self.get_profile_file(
+                selected[0], selected[1], time.time() - start))
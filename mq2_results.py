@@ -0,0 +1,517 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+
+Access to the output of the MQ² experiments.
+
+When an experiment is finished, the columnar store of `mq2_store` and the
+data of its plot are built from its output files so that the
+web-application only reads what it needs to display. They are stored in
+the ``.index`` folder of the experiment.
+
+The QTLs found at a given LOD threshold being a subset of those found at
+a lower threshold, the output of an experiment can also be derived from
+the output of an experiment run at a lower threshold, without parsing
+the input files again.
+"""
+
+import binascii
+import csv
+import json
+import os
+import struct
+import time
+import zipfile
+
+try:
+    import zlib
+    ZCOMPRESSION = zipfile.ZIP_DEFLATED
+except:
+    ZCOMPRESSION = zipfile.ZIP_STORED
+
+from MQ2 import read_input_file, write_matrix
+from MQ2.add_qtl_to_map import add_qtl_to_map
+from MQ2.mapchart import generate_map_chart_file, append_flanking_markers
+
+from mq2_store import open_store
+
+
+INDEX_FOLDER = '.index'
+# Columns of the table summarizing the hotspots found in a LOD sweep
+SWEEP_HEADERS = ['LOD threshold', 'Experiment', '# QTLs',
+                 '# markers with QTLs', 'Max QTLs on a marker']
+# Columns of the table listing the experiments of a batch, ie: all the
+# MapQTL sessions of an archive run at once, and of its summary
+BATCH_HEADERS = ['MapQTL session', 'LOD threshold', 'Job']
+BATCH_SUMMARY_HEADERS = ['MapQTL session', 'Status', 'Experiment',
+                         '# QTLs', '# markers with QTLs',
+                         'Max QTLs on a marker']
+# Size of the blocks in which the files are read when zipping them
+CHUNK_SIZE = 64 * 1024
+
+
+def get_index_folder(exp_folder):
+    """ Return the folder containing the indexes of an experiment,
+    creating it if needed.
+
+    @param exp_folder the folder of the experiment.
+    """
+    folder = os.path.join(exp_folder, INDEX_FOLDER)
+    if not os.path.exists(folder):
+        try:
+            os.mkdir(folder)
+        except OSError:
+            # Created concurrently
+            pass
+    return folder
+
+
+def read_marker_rows(exp_folder, marker_id):
+    """ Return the header and the rows of ``qtls_with_mk.csv`` whose
+    closest marker is the specified marker.
+    Only the rows of this marker are read from the columnar store.
+
+    @param exp_folder the folder of the experiment.
+    @param marker_id the name of the marker.
+    """
+    return open_store(exp_folder).get_marker_qtls(marker_id)
+
+
+def read_map(exp_folder):
+    """ Return the markers of the map of an experiment, as
+    `read_hotspots` does, read from its ``map_with_qtls.csv`` file rather
+    than from its columnar store.
+
+    @param exp_folder the folder of the experiment.
+    """
+    output = []
+    stream = open(os.path.join(exp_folder, 'map_with_qtls.csv'))
+    try:
+        for row in stream:
+            row = row.strip().split(',')
+            if not row[3].startswith('#'):
+                output.append((row[0], row[1], float(row[2]), int(row[3])))
+    finally:
+        stream.close()
+    return output
+
+
+def compute_plot_payload(hotspots):
+    """ Return the data plotted on the result page of an experiment,
+    computed from the number of QTLs found on the markers of its map.
+    The payload contains the two series of the plot (the number of QTLs
+    per marker and the limits of the linkage groups), the list of
+    linkage groups, the position at which they start and the maximum
+    number of QTLs found on a marker.
+
+    @param hotspots the markers of the map, as returned by
+        `read_hotspots`.
+    """
+    data_qtls = []
+    data_lg = []
+    qtls_lg = []
+    lg_index = []
+    max_lod = 0
+    seen = set()
+    previous = None
+    for cnt, (marker, group, _, count) in enumerate(hotspots):
+        if group != previous:
+            lg_index.append(cnt)
+            data_qtls.append([group, 0])
+            data_lg.append(group)
+            previous = group
+        if group not in seen:
+            seen.add(group)
+            qtls_lg.append(group)
+        value = float(count)
+        data_qtls.append([marker, value])
+        if value > max_lod:
+            max_lod = value
+
+    payload = {
+        'data': [
+            {"label": "QTLs found",
+             "color": "#1F77B4",
+             "data": data_qtls,
+             "bars": {"show": 1,
+                      "barWidth": 0.8,
+                      "order": 1,
+                      },
+             },
+            {"label": "Chr",
+             "color": "#CDCDCD",
+             "data": [[lg, max_lod + 2] for lg in data_lg],
+             "bars": {"show": 1,
+                      "barWidth": 0.4,
+                      "order": 2,
+                      },
+             },
+        ],
+        'qtls_lg': qtls_lg,
+        'lg_index': lg_index,
+        'max_lod': max_lod,
+    }
+    return payload
+
+
+def build_plot_payload(exp_folder):
+    """ Build the data plotted on the result page of an experiment, see
+    `compute_plot_payload`, and store it as JSON in the index folder.
+
+    @param exp_folder the folder of the experiment.
+    """
+    payload = compute_plot_payload(read_hotspots(exp_folder))
+    folder = get_index_folder(exp_folder)
+    tmp_file = os.path.join(folder, 'plot.json.%s' % os.getpid())
+    output = open(tmp_file, 'w')
+    try:
+        json.dump(payload, output, separators=(',', ':'))
+    finally:
+        output.close()
+    os.rename(tmp_file, os.path.join(folder, 'plot.json'))
+
+
+def read_hotspots(exp_folder, groups=None, start=None, end=None,
+                  min_qtls=0):
+    """ Return the number of QTLs found on the markers of the map, in
+    the order of the map, as a list of (marker, linkage group, position,
+    number of QTLs) tuples.
+
+    @param exp_folder the folder of the experiment.
+    @param groups the linkage groups to return, all by default.
+    @param start the position (in cM) from which to return the markers
+        of the linkage groups.
+    @param end the position (in cM) up to which to return the markers of
+        the linkage groups.
+    @param min_qtls the minimum number of QTLs of the markers returned.
+    """
+    return open_store(exp_folder).get_hotspots(
+        groups=groups, start=start, end=end, min_qtls=min_qtls)
+
+
+def get_plot_payload_file(exp_folder):
+    """ Return the path to the JSON file containing the data plotted on
+    the result page of an experiment, building it if needed.
+
+    @param exp_folder the folder of the experiment.
+    """
+    payload_file = os.path.join(exp_folder, INDEX_FOLDER, 'plot.json')
+    if not os.path.exists(payload_file):
+        build_plot_payload(exp_folder)
+    return payload_file
+
+
+def get_output_files(exp_folder):
+    """ Return the name of the output files of an experiment, ie: the
+    files to put in its zip archive.
+
+    @param exp_folder the folder of the experiment.
+    """
+    return sorted(
+        filename for filename in os.listdir(exp_folder)
+        if not filename.startswith('.')
+        and not filename.endswith('.zip')
+        and os.path.isfile(os.path.join(exp_folder, filename)))
+
+
+def build_zip(exp_folder, exp_id):
+    """ Create the zip archive containing all the output files of an
+    experiment.
+    The archive is written under a temporary name and then renamed so
+    that it is never served half-written.
+
+    @param exp_folder the folder of the experiment.
+    @param exp_id the experiment identifier, used to name the archive.
+    """
+    tmp_file = os.path.join(exp_folder, '.%s.zip.%s' % (exp_id, os.getpid()))
+    zfile = zipfile.ZipFile(tmp_file, mode='w')
+    try:
+        for filename in get_output_files(exp_folder):
+            zfile.write(os.path.join(exp_folder, filename),
+                        arcname=os.path.join(exp_id, filename),
+                        compress_type=ZCOMPRESSION)
+    finally:
+        zfile.close()
+    os.rename(tmp_file, os.path.join(exp_folder, '%s.zip' % exp_id))
+
+
+def stream_zip(exp_folder, exp_id):
+    """ Generate on the fly the zip archive containing all the output
+    files of an experiment, without writing it on the disk.
+    The size and CRC of each file are given in a data descriptor after
+    its content so that the archive can be sent while it is built.
+
+    @param exp_folder the folder of the experiment.
+    @param exp_id the experiment identifier, used to name the archive.
+    """
+    entries = []
+    offset = 0
+    for filename in get_output_files(exp_folder):
+        path = os.path.join(exp_folder, filename)
+        arcname = u'%s/%s' % (exp_id, filename)
+        flags = 0x08
+        try:
+            arcname = arcname.encode('ascii')
+        except UnicodeError:
+            arcname = arcname.encode('utf-8')
+            flags |= 0x800
+        mtime = time.localtime(os.path.getmtime(path))
+        dostime = mtime[3] << 11 | mtime[4] << 5 | mtime[5] // 2
+        dosdate = (mtime[0] - 1980) << 9 | mtime[1] << 5 | mtime[2]
+
+        header = struct.pack(
+            '<4sHHHHHLLLHH', 'PK\x03\x04', 20, flags, ZCOMPRESSION,
+            dostime, dosdate, 0, 0, 0, len(arcname), 0) + arcname
+        yield header
+
+        crc = 0
+        size = 0
+        compressed_size = 0
+        compressor = None
+        if ZCOMPRESSION == zipfile.ZIP_DEFLATED:
+            compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+        stream = open(path, 'rb')
+        try:
+            chunk = stream.read(CHUNK_SIZE)
+            while chunk:
+                crc = binascii.crc32(chunk, crc)
+                size += len(chunk)
+                if compressor:
+                    chunk = compressor.compress(chunk)
+                compressed_size += len(chunk)
+                if chunk:
+                    yield chunk
+                chunk = stream.read(CHUNK_SIZE)
+        finally:
+            stream.close()
+        if compressor:
+            chunk = compressor.flush()
+            compressed_size += len(chunk)
+            yield chunk
+        crc = crc & 0xffffffff
+
+        descriptor = struct.pack('<4sLLL', 'PK\x07\x08', crc,
+                                 compressed_size, size)
+        yield descriptor
+
+        entries.append((arcname, flags, dostime, dosdate, crc,
+                        compressed_size, size, offset))
+        offset += len(header) + compressed_size + len(descriptor)
+
+    central_directory = []
+    for (arcname, flags, dostime, dosdate, crc, compressed_size, size,
+            header_offset) in entries:
+        central_directory.append(struct.pack(
+            '<4sHHHHHHLLLHHHHHLL', 'PK\x01\x02', 20, 20, flags,
+            ZCOMPRESSION, dostime, dosdate, crc, compressed_size, size,
+            len(arcname), 0, 0, 0, 0, 0o644 << 16, header_offset))
+        central_directory.append(arcname)
+    central_directory = ''.join(central_directory)
+    yield central_directory
+    yield struct.pack('<4sHHHHLLH', 'PK\x05\x06', 0, 0, len(entries),
+                      len(entries), len(central_directory), offset, 0)
+
+
+def derive_experiment(base_folder, exp_folder, lod_threshold):
+    """ Generate the output of an experiment from the output of an
+    experiment run on the same dataset and session but with a lower LOD
+    threshold.
+    A QTL being the peak of a trait on a linkage group, the QTLs found
+    at the higher threshold are those of the base experiment whose LOD
+    is above this threshold. Only the QTLs are filtered, the map, the
+    MapChart file and the counts are then generated by MQ² as in a
+    normal run.
+
+    @param base_folder the folder of the experiment run at a lower LOD
+        threshold.
+    @param exp_folder the folder in which to write the output of the
+        experiment.
+    @param lod_threshold the LOD threshold of the experiment.
+    """
+    lod_threshold = float(lod_threshold)
+    if not os.path.exists(exp_folder):
+        os.mkdir(exp_folder)
+
+    qtls = read_input_file(os.path.join(base_folder, 'qtls.csv'), sep=',')
+    write_matrix(os.path.join(exp_folder, 'qtls.csv'),
+                 qtls[:1] + [row for row in qtls[1:]
+                             if float(row[4]) > lod_threshold])
+
+    # Remove the flanking markers, they are computed again below
+    qtls_mk = read_input_file(os.path.join(base_folder, 'qtls_with_mk.csv'),
+                              sep=',')
+    qtls_mk_file = os.path.join(exp_folder, 'qtls_with_mk.csv')
+    write_matrix(qtls_mk_file,
+                 [qtls_mk[0][:-2]] + [row[:-2] for row in qtls_mk[1:]
+                                      if float(row[4]) > lod_threshold])
+
+    # Count again the LOD values above the threshold
+    matrix = read_input_file(os.path.join(base_folder, 'qtls_matrix.csv'),
+                             sep=',')
+    matrix_file = os.path.join(exp_folder, 'qtls_matrix.csv')
+    for row in matrix[1:]:
+        row[-1] = str(len([cel for cel in row[3:-1]
+                           if cel and float(cel) > lod_threshold]))
+    write_matrix(matrix_file, matrix)
+
+    map_file = os.path.join(exp_folder, 'map.csv')
+    try:
+        os.link(os.path.join(base_folder, 'map.csv'), map_file)
+    except OSError:
+        write_matrix(map_file, read_input_file(
+            os.path.join(base_folder, 'map.csv'), sep=','))
+
+    add_qtl_to_map(qtls_mk_file, map_file,
+                   outputfile=os.path.join(exp_folder, 'map_with_qtls.csv'))
+    flanking_markers = generate_map_chart_file(
+        matrix_file, lod_threshold,
+        map_chart_file=os.path.join(exp_folder, 'MapChart.map'))
+    append_flanking_markers(qtls_mk_file, flanking_markers)
+
+
+def get_hotspot_summary(exp_folder):
+    """ Return the number of QTLs found in an experiment, the number of
+    markers on which QTLs were found and the maximum number of QTLs
+    found on a single marker.
+
+    @param exp_folder the folder of the experiment.
+    """
+    counts = open_store(exp_folder).marker_qtls
+    counts = counts[:len(counts)]
+    return (sum(counts), len([cnt for cnt in counts if cnt]),
+            max(counts or [0]))
+
+
+def get_sweep_file(folder, sweep_id):
+    """ Return the path to the table summarizing the hotspots found in a
+    LOD sweep.
+
+    @param folder the session folder in which the sweep was run.
+    @param sweep_id the identifier of the sweep.
+    """
+    return os.path.join(folder, '%s.sweep.csv' % sweep_id)
+
+
+def get_sweep_ids(folder):
+    """ Retrieve the identifiers of the LOD sweeps run in a session.
+
+    @param folder the session folder.
+    """
+    return sorted(filename.rsplit('.', 2)[0]
+                  for filename in os.listdir(folder)
+                  if filename.endswith('.sweep.csv'))
+
+
+def write_sweep_table(folder, sweep_id, experiments):
+    """ Write down the table summarizing, for each LOD threshold of a
+    sweep, the hotspots found.
+
+    @param folder the session folder in which the sweep was run.
+    @param sweep_id the identifier of the sweep.
+    @param experiments a list of (LOD threshold, experiment identifier)
+        tuples, the experiments being in the session folder.
+    """
+    filename = get_sweep_file(folder, sweep_id)
+    tmp_file = '%s.%s' % (filename, os.getpid())
+    stream = open(tmp_file, 'wb')
+    try:
+        writer = csv.writer(stream)
+        writer.writerow(SWEEP_HEADERS)
+        for lod_threshold, exp_id in experiments:
+            writer.writerow([lod_threshold, exp_id] + list(
+                get_hotspot_summary(os.path.join(folder, exp_id))))
+    finally:
+        stream.close()
+    os.rename(tmp_file, filename)
+
+
+def read_sweep_table(folder, sweep_id):
+    """ Return the rows of the table summarizing the hotspots found in a
+    LOD sweep, without its header.
+
+    @param folder the session folder in which the sweep was run.
+    @param sweep_id the identifier of the sweep.
+    """
+    stream = open(get_sweep_file(folder, sweep_id), 'rb')
+    try:
+        return list(csv.reader(stream))[1:]
+    finally:
+        stream.close()
+
+
+def get_batch_file(folder, batch_id):
+    """ Return the path to the table listing the experiments of a batch.
+
+    @param folder the session folder in which the batch was run.
+    @param batch_id the identifier of the batch.
+    """
+    return os.path.join(folder, '%s.batch.csv' % batch_id)
+
+
+def get_batch_ids(folder):
+    """ Retrieve the identifiers of the batches run in a session.
+
+    @param folder the session folder.
+    """
+    return sorted(filename.rsplit('.', 2)[0]
+                  for filename in os.listdir(folder)
+                  if filename.endswith('.batch.csv'))
+
+
+def write_batch_table(folder, batch_id, jobs):
+    """ Write down the table listing the experiments of a batch, the
+    table is written before the jobs run, their status and output are
+    read when the batch is shown.
+
+    @param folder the session folder in which the batch is run.
+    @param batch_id the identifier of the batch.
+    @param jobs a list of (MapQTL session, LOD threshold, job
+        identifier) tuples, the job identifier being the one of the
+        experiment if it was already run.
+    """
+    filename = get_batch_file(folder, batch_id)
+    tmp_file = '%s.%s' % (filename, os.getpid())
+    stream = open(tmp_file, 'wb')
+    try:
+        writer = csv.writer(stream)
+        writer.writerow(BATCH_HEADERS)
+        for row in jobs:
+            writer.writerow(row)
+    finally:
+        stream.close()
+    os.rename(tmp_file, filename)
+
+
+def read_batch_table(folder, batch_id):
+    """ Return the rows of the table listing the experiments of a batch,
+    without its header.
+
+    @param folder the session folder in which the batch was run.
+    @param batch_id the identifier of the batch.
+    """
+    stream = open(get_batch_file(folder, batch_id), 'rb')
+    try:
+        return list(csv.reader(stream))[1:]
+    finally:
+        stream.close()
@@ -0,0 +1,163 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+
+In-memory copy of the sample session presented on the front page.
+
+The sample session is read once, by the first request using it, and
+then served from memory: the information about its archive, the
+parameters of its experiments, the data of their plot and the QTLs of
+each marker. It is read-only, no experiment can be run on it, and nothing is written
+in its folder.
+"""
+
+import json
+import os
+
+from mq2_results import compute_plot_payload, read_map, INDEX_FOLDER
+
+
+class SampleExperiment(object):
+    """ Output of an experiment of the sample session. """
+
+    def __init__(self, exp_id, infos, files, plot, headers, markers,
+                 validators):
+        """ Constructor.
+
+        @param exp_id the experiment identifier.
+        @param infos the parameters of the experiment, as returned by
+            `retrieve_exp_info`.
+        @param files the name of the files in the folder of the
+            experiment.
+        @param plot the data plotted on the result page, as JSON.
+        @param headers the header of ``qtls_with_mk.csv``.
+        @param markers the rows of ``qtls_with_mk.csv`` per closest
+            marker.
+        @param validators the ETag and last modification date of the
+            responses built from the experiment.
+        """
+        self.exp_id = exp_id
+        self.infos = infos
+        self.files = files
+        self.plot = plot
+        self.headers = headers
+        self.markers = markers
+        self.validators = validators
+
+    def get_marker(self, marker_id):
+        """ Return the header and the QTLs whose closest marker is the
+        specified marker, as `retrieve_marker_info` does.
+
+        @param marker_id the name of the marker.
+        """
+        return (self.headers, self.markers.get(marker_id, []))
+
+
+class SampleSession(object):
+    """ Archive information and experiments of the sample session. """
+
+    def __init__(self, session_id, folder, infos):
+        """ Constructor.
+
+        @param session_id the identifier of the sample session.
+        @param folder the folder of the sample session.
+        @param infos the information about the archive of the session,
+            as returned by `ArchiveCache.describe`.
+        """
+        self.session_id = session_id
+        self.folder = folder
+        self.infos = infos
+        self.experiments = {}
+
+    def add_experiment(self, experiment):
+        """ Add an experiment to the session.
+
+        @param experiment the `SampleExperiment` to add.
+        """
+        self.experiments[experiment.exp_id] = experiment
+
+    def get_experiment(self, exp_id):
+        """ Return an experiment of the session or None if there is no
+        such experiment.
+
+        @param exp_id the experiment identifier.
+        """
+        return self.experiments.get(exp_id)
+
+    def get_experiment_ids(self):
+        """ Return the identifiers of the experiments of the session. """
+        return sorted(self.experiments)
+
+
+def read_marker_table(exp_folder, hidden_columns=()):
+    """ Return the header and the rows of ``qtls_with_mk.csv`` grouped
+    per closest marker.
+
+    @param exp_folder the folder of the experiment.
+    @param hidden_columns the index of the columns to leave out.
+    """
+    stream = open(os.path.join(exp_folder, 'qtls_with_mk.csv'))
+    try:
+        headers = stream.readline().strip().split(',')
+        markers = {}
+        for row in stream:
+            row = row.strip().split(',')
+            markers.setdefault(row[-3], []).append(row)
+    finally:
+        stream.close()
+    if hidden_columns:
+        keep = [cnt for cnt in range(len(headers))
+                if cnt not in hidden_columns]
+        headers = [headers[cnt] for cnt in keep]
+        for marker, rows in markers.items():
+            markers[marker] = [[row[cnt] for cnt in keep] for row in rows]
+    return (headers, markers)
+
+
+def load_experiment(exp_folder, exp_id, infos, validators,
+                    hidden_columns=()):
+    """ Read the output of an experiment of the sample session.
+
+    @param exp_folder the folder of the experiment.
+    @param exp_id the experiment identifier.
+    @param infos the parameters of the experiment.
+    @param validators the ETag and last modification date of the
+        responses built from the experiment.
+    @param hidden_columns the index of the columns of
+        ``qtls_with_mk.csv`` not shown.
+    """
+    payload_file = os.path.join(exp_folder, INDEX_FOLDER, 'plot.json')
+    if os.path.exists(payload_file):
+        stream = open(payload_file)
+        try:
+            plot = stream.read()
+        finally:
+            stream.close()
+    else:
+        # Nothing is written in the folder of the sample session, the
+        # data is only kept in memory
+        plot = json.dumps(compute_plot_payload(read_map(exp_folder)),
+                          separators=(',', ':'))
+    headers, markers = read_marker_table(exp_folder, hidden_columns)
+    return SampleExperiment(exp_id, infos, os.listdir(exp_folder), plot,
+                            headers, markers, validators)
@@ -0,0 +1,471 @@
+#-*- coding: UTF-8 -*-
+
+"""
+ (c) 2011-2013 - Copyright Pierre-Yves Chibon
+
+ Distributed under License GPLv3 or later
+ You can find a copy of this license on the website
+ http://www.gnu.org/licenses/gpl.html
+
+ This program is free software; you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation; either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program; if not, write to the Free Software
+ Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+ MA 02110-1301, USA.
+
+Binary columnar store of the output of the MQ² experiments.
+
+When an experiment is finished, its map and the number of QTLs found on
+each marker are written as columns of fixed-size binary values, the names
+of the markers and linkage groups being kept in string tables, together
+with the dimensions of its LOD matrix. The QTLs of ``qtls_with_mk.csv``
+are written as a string table of their cells, grouped per closest marker.
+These columns are mapped in memory when read, so that only the values
+actually used are read from the disk and the pages are shared between the
+processes.
+An experiment derived from another one shares the map of its base
+experiment, only the number of QTLs per marker and its QTLs are written
+again.
+"""
+
+import array
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+
+
+STORE_FOLDER = os.path.join('.index', 'columns')
+# Number of stores kept open
+MAX_OPEN_STORES = 64
+
+_OPEN_STORES = {}
+_LOCK = threading.Lock()
+
+
+class Column(object):
+    """ Read-only column of fixed-size values, stored little-endian in
+    a file mapped in memory.
+    """
+
+    def __init__(self, path, typecode):
+        """ Constructor.
+
+        @param path the path to the file of the column.
+        @param typecode the `array` type code of the values.
+        """
+        self.typecode = typecode
+        self.itemsize = struct.calcsize('<%s' % typecode)
+        stream = open(path, 'rb')
+        try:
+            size = os.fstat(stream.fileno()).st_size
+            self._map = ''
+            if size:
+                self._map = mmap.mmap(stream.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+        finally:
+            stream.close()
+        self.length = size // self.itemsize
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        """ Return a value, or a tuple of values for a slice, read
+        directly from the mapped file.
+        """
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self.length)
+            if step != 1:
+                return tuple(self[cnt] for cnt in range(start, stop, step))
+            if stop <= start:
+                return ()
+            return struct.unpack_from(
+                '<%s%s' % (stop - start, self.typecode), self._map,
+                start * self.itemsize)
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('Column index out of range')
+        return struct.unpack_from('<%s' % self.typecode, self._map,
+                                  index * self.itemsize)[0]
+
+
+class StringTable(object):
+    """ Read-only list of strings, stored as UTF-8 one after the other
+    with a column giving the offset at which each of them starts.
+    """
+
+    def __init__(self, path):
+        """ Constructor.
+
+        @param path the path to the file of the strings, the offsets are
+            in the file with the same name and the `.offsets` extension.
+        """
+        self.offsets = Column('%s.offsets' % path, 'I')
+        stream = open(path, 'rb')
+        try:
+            self._map = ''
+            if os.fstat(stream.fileno()).st_size:
+                self._map = mmap.mmap(stream.fileno(), 0,
+                                      access=mmap.ACCESS_READ)
+        finally:
+            stream.close()
+
+    def __len__(self):
+        return max(len(self.offsets) - 1, 0)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[cnt] for cnt in range(start, stop, step)]
+            if stop <= start:
+                return []
+            offsets = self.offsets[start:stop + 1]
+            return [self._map[offsets[cnt]:offsets[cnt + 1]].decode('utf-8')
+                    for cnt in range(stop - start)]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('String table index out of range')
+        start, end = self.offsets[index:index + 2]
+        return self._map[start:end].decode('utf-8')
+
+    def find(self, string):
+        """ Return the index of a string in the table, whose strings are
+        sorted, or None if it is not in the table.
+
+        @param string the string to look for.
+        """
+        if isinstance(string, unicode):
+            string = string.encode('utf-8')
+        offsets = self.offsets
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._map[offsets[middle]:offsets[middle + 1]] < string:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) \
+                and self._map[offsets[low]:offsets[low + 1]] == string:
+            return low
+        return None
+
+
+def _write_column(folder, name, typecode, values):
+    """ Write down a column of fixed-size values.
+
+    @param folder the folder of the store.
+    @param name the name of the column.
+    @param typecode the `array` type code of the values.
+    @param values the values of the column.
+    """
+    values = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    stream = open(os.path.join(folder, name), 'wb')
+    try:
+        values.tofile(stream)
+    finally:
+        stream.close()
+
+
+def _write_strings(folder, name, strings):
+    """ Write down a string table.
+
+    @param folder the folder of the store.
+    @param name the name of the string table.
+    @param strings the list of strings.
+    """
+    offsets = [0]
+    stream = open(os.path.join(folder, name), 'wb')
+    try:
+        for string in strings:
+            if isinstance(string, unicode):
+                string = string.encode('utf-8')
+            stream.write(string)
+            offsets.append(offsets[-1] + len(string))
+    finally:
+        stream.close()
+    _write_column(folder, '%s.offsets' % name, 'I', offsets)
+
+
+# Files of the store which only depend on the map and the LOD matrix, not
+# on the LOD threshold of the experiment
+MAP_FILES = ('markers', 'markers.offsets', 'groups', 'groups.offsets',
+             'group_offsets', 'marker_position', 'store.json')
+
+
+def _read_qtls(exp_folder):
+    """ Return the columns and string tables of the store holding the
+    QTLs of ``qtls_with_mk.csv``: the header, the cells of the rows
+    grouped per closest marker, the offset of each row in these cells,
+    the closest markers, sorted, and the offset of the rows of each of
+    them.
+
+    @param exp_folder the folder of the experiment.
+    """
+    stream = open(os.path.join(exp_folder, 'qtls_with_mk.csv'), 'rb')
+    try:
+        headers = stream.readline().strip().split(',')
+        qtls = {}
+        for row in stream:
+            row = row.strip().split(',')
+            qtls.setdefault(row[-3], []).append(row)
+    finally:
+        stream.close()
+
+    cells = []
+    row_offsets = [0]
+    marker_rows = [0]
+    qtl_markers = sorted(qtls)
+    for marker in qtl_markers:
+        for row in qtls[marker]:
+            cells.extend(row)
+            row_offsets.append(len(cells))
+        marker_rows.append(len(row_offsets) - 1)
+    return ([('qtl_row_offsets', 'I', row_offsets),
+             ('qtl_marker_rows', 'I', marker_rows)],
+            [('qtl_headers', headers), ('qtl_cells', cells),
+             ('qtl_markers', qtl_markers)])
+
+
+def build_store(exp_folder, base_folder=None):
+    """ Build the columnar store of an experiment from its
+    ``map_with_qtls.csv``, ``qtls_with_mk.csv`` and ``qtls_matrix.csv``
+    files.
+    The store is written in a temporary folder which is then moved in
+    place, so that it is never read half-written.
+
+    @param exp_folder the folder of the experiment.
+    @param base_folder the folder of the experiment it is derived from,
+        if any, the files of its store not depending on the LOD threshold
+        are then linked rather than written again.
+    """
+    base_store = None
+    if base_folder is not None:
+        base_store = os.path.join(base_folder, STORE_FOLDER)
+        if not os.path.exists(os.path.join(base_store, 'store.json')):
+            base_store = None
+    qtl_columns, qtl_strings = _read_qtls(exp_folder)
+    if base_store is not None:
+        marker_qtls = []
+        stream = open(os.path.join(exp_folder, 'map_with_qtls.csv'))
+        try:
+            for row in stream:
+                row = row.strip().split(',')
+                if not row[3].startswith('#'):
+                    marker_qtls.append(int(row[3]))
+        finally:
+            stream.close()
+        _move_store(exp_folder,
+                    [('marker_qtls', 'I', marker_qtls)] + qtl_columns,
+                    strings=qtl_strings, base_store=base_store)
+        return
+
+    markers = []
+    groups = []
+    group_offsets = []
+    marker_position = []
+    marker_qtls = []
+    stream = open(os.path.join(exp_folder, 'map_with_qtls.csv'))
+    try:
+        for row in stream:
+            row = row.strip().split(',')
+            if row[3].startswith('#'):
+                continue
+            if not groups or groups[-1] != row[1]:
+                groups.append(row[1])
+                group_offsets.append(len(markers))
+            markers.append(row[0])
+            marker_position.append(float(row[2]))
+            marker_qtls.append(int(row[3]))
+    finally:
+        stream.close()
+    group_offsets.append(len(markers))
+
+    n_rows = 0
+    stream = open(os.path.join(exp_folder, 'qtls_matrix.csv'))
+    try:
+        n_traits = len(stream.readline().strip().split(',')[3:-1])
+        for row in stream:
+            n_rows += 1
+    finally:
+        stream.close()
+
+    _move_store(exp_folder, [
+        ('group_offsets', 'I', group_offsets),
+        ('marker_position', 'd', marker_position),
+        ('marker_qtls', 'I', marker_qtls)] + qtl_columns,
+        strings=[('markers', markers), ('groups', groups)] + qtl_strings,
+        infos={'markers': len(markers), 'traits': n_traits,
+               'rows': n_rows})
+
+
+def _move_store(exp_folder, columns, strings=(), infos=None,
+                base_store=None):
+    """ Write down the files of the store of an experiment in a temporary
+    folder and move it in place.
+
+    @param exp_folder the folder of the experiment.
+    @param columns a list of (name, type code, values) of the columns.
+    @param strings a list of (name, strings) of the string tables.
+    @param infos the number of markers, of traits and of rows of the LOD
+        matrix, written in ``store.json``.
+    @param base_store the store whose files not depending on the LOD
+        threshold are linked.
+    """
+    parent = os.path.dirname(os.path.join(exp_folder, STORE_FOLDER))
+    if not os.path.exists(parent):
+        try:
+            os.mkdir(parent)
+        except OSError:
+            # Created concurrently
+            pass
+    folder = tempfile.mkdtemp(prefix='.tmp-', dir=parent)
+    try:
+        if base_store is not None:
+            for name in MAP_FILES:
+                try:
+                    os.link(os.path.join(base_store, name),
+                            os.path.join(folder, name))
+                except OSError:
+                    shutil.copy(os.path.join(base_store, name),
+                                os.path.join(folder, name))
+        for name, values in strings:
+            _write_strings(folder, name, values)
+        for name, typecode, values in columns:
+            _write_column(folder, name, typecode, values)
+        if infos is not None:
+            stream = open(os.path.join(folder, 'store.json'), 'w')
+            try:
+                json.dump(infos, stream)
+            finally:
+                stream.close()
+
+        target = os.path.join(exp_folder, STORE_FOLDER)
+        if os.path.exists(target):
+            shutil.rmtree(target, ignore_errors=True)
+        os.rename(folder, target)
+    finally:
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+
+
+class Store(object):
+    """ Columnar store of the output of an experiment. """
+
+    def __init__(self, folder):
+        """ Constructor.
+
+        @param folder the folder of the store.
+        """
+        stream = open(os.path.join(folder, 'store.json'))
+        try:
+            self.infos = json.load(stream)
+        finally:
+            stream.close()
+        self.markers = StringTable(os.path.join(folder, 'markers'))
+        self.groups = StringTable(os.path.join(folder, 'groups'))
+        self.group_offsets = Column(
+            os.path.join(folder, 'group_offsets'), 'I')
+        self.marker_position = Column(
+            os.path.join(folder, 'marker_position'), 'd')
+        self.marker_qtls = Column(os.path.join(folder, 'marker_qtls'), 'I')
+        self.qtl_headers = StringTable(os.path.join(folder, 'qtl_headers'))
+        self.qtl_cells = StringTable(os.path.join(folder, 'qtl_cells'))
+        self.qtl_row_offsets = Column(
+            os.path.join(folder, 'qtl_row_offsets'), 'I')
+        self.qtl_markers = StringTable(os.path.join(folder, 'qtl_markers'))
+        self.qtl_marker_rows = Column(
+            os.path.join(folder, 'qtl_marker_rows'), 'I')
+
+    def get_matrix_dimensions(self):
+        """ Return the number of lines and columns of the
+        ``qtls_matrix.csv`` file, as `get_matrix_dimensions` does.
+        """
+        return (self.infos['rows'] + 1, self.infos['traits'] + 4)
+
+    def get_hotspots(self, groups=None, start=None, end=None, min_qtls=0):
+        """ Return the number of QTLs found on the markers of the map, in
+        the order of the map, as a list of (marker, linkage group,
+        position, number of QTLs) tuples.
+
+        @param groups the linkage groups to return, all by default.
+        @param start the position (in cM) from which to return the
+            markers of the linkage groups.
+        @param end the position (in cM) up to which to return the markers
+            of the linkage groups.
+        @param min_qtls the minimum number of QTLs of the markers
+            returned.
+        """
+        output = []
+        for cnt in range(len(self.groups)):
+            group = self.groups[cnt]
+            if groups and group not in groups:
+                continue
+            first, last = self.group_offsets[cnt:cnt + 2]
+            positions = self.marker_position[first:last]
+            counts = self.marker_qtls[first:last]
+            for index in range(last - first):
+                if (start is None or positions[index] >= start) \
+                        and (end is None or positions[index] <= end) \
+                        and counts[index] >= min_qtls:
+                    output.append((self.markers[first + index], group,
+                                   positions[index], counts[index]))
+        return output
+
+    def get_marker_qtls(self, marker_id):
+        """ Return the header of ``qtls_with_mk.csv`` and its rows whose
+        closest marker is the specified marker, only the cells of these
+        rows are read.
+
+        @param marker_id the name of the marker.
+        """
+        headers = self.qtl_headers[:len(self.qtl_headers)]
+        index = self.qtl_markers.find(marker_id)
+        if index is None:
+            return (headers, [])
+        first, last = self.qtl_marker_rows[index:index + 2]
+        offsets = self.qtl_row_offsets[first:last + 1]
+        cells = self.qtl_cells[offsets[0]:offsets[-1]]
+        return (headers, [cells[start - offsets[0]:end - offsets[0]]
+                          for start, end in zip(offsets, offsets[1:])])
+
+
+def open_store(exp_folder):
+    """ Return the columnar store of an experiment, building it if it
+    does not exist yet. The stores are kept open, their columns being
+    mapped in memory.
+
+    @param exp_folder the folder of the experiment.
+    """
+    folder = os.path.join(exp_folder, STORE_FOLDER)
+    # The stores written before the QTLs were stored are built again
+    if not os.path.exists(os.path.join(folder, 'qtl_marker_rows')):
+        build_store(exp_folder)
+    key = (folder, os.path.getmtime(os.path.join(folder, 'store.json')))
+    with _LOCK:
+        if key in _OPEN_STORES:
+            return _OPEN_STORES[key]
+    store = Store(folder)
+    with _LOCK:
+        if len(_OPEN_STORES) >= MAX_OPEN_STORES:
+            _OPEN_STORES.clear()
+        _OPEN_STORES[key] = store
+    return store
@@ -31,8 +31,9 @@ set a number of parameter and retrieve basic information regarding QTL
 hotspots.
 """
 
-from flask import (Flask, render_template, request, redirect, url_for,
-                   flash, send_from_directory)
+from flask import (Flask, Request, Response, render_template, request,
+                   redirect, url_for, flash, send_from_directory, jsonify, g,
+                   stream_with_context)
 from wtforms.validators import StopValidation
 try:
     from flask.ext.wtf import (Form, FileField, file_required, TextField,
@@ -43,24 +44,49 @@ except ImportError:  # New version has a different namespace
 
 import ConfigParser
 import datetime
+import json
+import logging
 import os
 import random
+import re
 import shutil
 import string
+import sys
 import tempfile
+import threading
+import time
 import zipfile
 from ConfigParser import NoSectionError, NoOptionError
+from optparse import OptionParser
+from werkzeug.http import is_resource_modified
 
-try:
-    import zlib
-    ZCOMPRESSION = zipfile.ZIP_DEFLATED
-except:
-    ZCOMPRESSION = zipfile.ZIP_STORED
-
-from MQ2 import (set_tmp_folder, extract_zip, get_matrix_dimensions,
-                 MQ2Exception, MQ2NoMatrixException,
+from MQ2 import (MQ2Exception, MQ2NoMatrixException,
                  MQ2NoSuchSessionException)
-from MQ2.mq2 import get_plugin_and_folder, run_mq2
+from MQ2.mq2 import run_mq2
+
+from mq2_archive import (ArchiveCache, BlobStore, InvalidArchive,
+                         archive_digest, get_plugin, link_tree,
+                         list_archive, get_mapqtl_sessions)
+from mq2_catalog import Catalog
+from mq2_results import (read_marker_rows, build_plot_payload,
+                         get_plot_payload_file, build_zip, stream_zip,
+                         derive_experiment,
+                         get_sweep_file, get_sweep_ids, write_sweep_table,
+                         read_sweep_table, SWEEP_HEADERS, read_hotspots,
+                         get_hotspot_summary, get_batch_file, get_batch_ids,
+                         write_batch_table, read_batch_table,
+                         BATCH_SUMMARY_HEADERS)
+from mq2_store import build_store, open_store
+from mq2_sample import SampleSession, load_experiment
+from mq2_layout import (is_valid_session_id, list_sessions,
+                        resolve_session_folder)
+from mq2_metrics import METRICS
+from mq2_profile import ProfilingMiddleware
+from mq2_jobs import (JobQueue, JobProgress, NoProgress, FileLock,
+                      JobAborted, read_job_status, write_job_status,
+                      read_progress, request_cancel, run_sandboxed,
+                      get_cancel_file, get_job_ids, QUEUED, RUNNING, DONE,
+                      FAILED)
 
 
 CONFIG = ConfigParser.ConfigParser()
@@ -75,13 +101,151 @@ ALLOWED_EXTENSIONS = set(item.strip() for item in CONFIG.get('mq2',
 ALLOWED_MIMETYPES = set(item.strip() for item in CONFIG.get('mq2',
                         'allows_mimetypes').split(','))
 
+
+def _get_config(option, default=None):
+    """ Return the value of an option of the mq2 section of the
+    configuration file or the provided default if it is not set.
+
+    @param option the name of the option to retrieve.
+    @param default the value to return if the option is not set.
+    """
+    try:
+        return CONFIG.get('mq2', option)
+    except (NoSectionError, NoOptionError):
+        return default
+
+logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s %(message)s')
+LOG = logging.getLogger('mq2_web')
+LOG.setLevel(_get_config('log_level', 'INFO').upper())
+
+# Number of processes running the experiments in the background
+JOBS = JobQueue(workers=int(_get_config('workers', 2)))
+# Whether the web-application, when run by this script, recovers the
+# experiments left unfinished by a previous run
+RECOVER_ON_STARTUP = _get_config('recover_on_startup', 'true').lower() in (
+    '1', 'yes', 'true', 'on')
+# Cache of the extracted input archives, its size is given in MB
+ARCHIVES = ArchiveCache(
+    _get_config('cache_folder',
+                os.path.join(tempfile.gettempdir(), 'mq2_cache')),
+    int(_get_config('cache_size', 1024)) * 1024 * 1024)
+
+# Output files of an experiment from which an experiment with a higher
+# LOD threshold can be derived
+DERIVED_FROM = ('qtls.csv', 'qtls_with_mk.csv', 'qtls_matrix.csv',
+                'map.csv')
+# Default and maximum number of items returned by a page of the API
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+# Maximum number of LOD thresholds in a sweep
+MAX_SWEEP_SIZE = int(_get_config('max_sweep_size', 50))
+# Maximum size (in MB) of the archives uploaded and of their content
+MAX_UPLOAD_SIZE = int(_get_config('max_upload_size', 100)) * 1024 * 1024
+MAX_CONTENT_SIZE = int(_get_config('max_content_size', 1024)) * 1024 * 1024
+# Time (in seconds) during which the results of an experiment, which
+# never change once written, may be cached by the browsers
+CACHE_TIMEOUT = int(_get_config('cache_timeout', 365 * 24 * 3600))
+# Minimum time (in seconds) between two records of the accesses to a
+# session or an experiment in the catalog, and when they were last recorded
+TOUCH_INTERVAL = int(_get_config('touch_interval', 300))
+_LAST_TOUCHES = {}
+_TOUCH_LOCK = threading.Lock()
+# Identifier of the session presented as example on the front page, its
+# folder is in the static folder
+SAMPLE_SESSION = _get_config('sample_session', '').decode('utf-8')
+# Prefix of the folders in which the experiments are generated and
+# folder of the locks, in the session folders
+BUILD_PREFIX = '.tmp-'
+LOCK_FOLDER = '.locks'
+# Time (in seconds) during which the progress of a job is streamed to a
+# browser before it has to reconnect, and between two reads of the progress
+EVENTS_TIMEOUT = int(_get_config('events_timeout', 60))
+EVENTS_INTERVAL = 1
+# Limits of the process parsing the input files of an experiment: CPU
+# time and wall-clock time (in seconds) and memory (in MB), 0 for no limit
+JOB_CPU_TIME = int(_get_config('job_cpu_time', 600))
+JOB_WALL_TIME = int(_get_config('job_wall_time', 1800))
+JOB_MEMORY = int(_get_config('job_memory', 2048))
+CANCELLED = 'The job was cancelled'
+# Value of the MapQTL session field running the experiment for all of them
+ALL_SESSIONS = '*'
+# Columns of ``qtls_with_mk.csv`` not shown for the MapQTL plugin: the
+# '# Iter.', 'mu_A', 'mu_H', 'mu_B' and 'GIC' columns
+MAPQTL_HIDDEN_COLUMNS = (5, 6, 7, 8, 13)
+
+
+class UploadRequest(Request):
+    """ Request writing the files uploaded directly in the blob store,
+    checking them as they arrive, instead of buffering them.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        """ Return the file-like object in which to write the file
+        uploaded, files which are not zip archives are rejected before
+        reading their content.
+        """
+        if not filename or '.' not in filename \
+                or filename.rsplit('.', 1)[1] not in ALLOWED_EXTENSIONS \
+                or content_type.split(';')[0].strip() \
+                not in ALLOWED_MIMETYPES:
+            raise InvalidArchive('Wrong file type or name.')
+        return BLOBS.get_writer(max_size=MAX_UPLOAD_SIZE,
+                                max_content_size=MAX_CONTENT_SIZE)
+
+
+REQUEST_TIME = METRICS.histogram(
+    'mq2_request_duration_seconds', 'Time spent serving the requests',
+    ('endpoint', 'method'))
+REQUESTS = METRICS.counter(
+    'mq2_requests_total', 'Requests served', ('endpoint', 'status'))
+BYTES_SERVED = METRICS.counter(
+    'mq2_response_bytes_total',
+    'Size of the responses whose length is known when they are sent',
+    ('endpoint',))
+EXPERIMENT_TIME = METRICS.histogram(
+    'mq2_experiment_duration_seconds',
+    'Time spent generating the experiments, copied from another session, '
+    'derived from an experiment with a lower LOD threshold or run on the '
+    'input files', ('method',))
+
+
 # Create the application.
 APP = Flask(__name__)
 APP.secret_key = CONFIG.get('mq2', 'secret_key')
+APP.request_class = UploadRequest
+# Leave some room for the other fields of the form
+APP.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_SIZE + 1024 * 1024
+
+# Profile some of the requests, the application is left untouched unless
+# a folder is set for the profiles
+if _get_config('profile_folder'):
+    APP.wsgi_app = ProfilingMiddleware(
+        APP.wsgi_app, APP.url_map, _get_config('profile_folder'),
+        rate=float(_get_config('profile_rate', 1)),
+        sessions=[item.strip() for item in
+                  _get_config('profile_sessions', '').split(',')
+                  if item.strip()],
+        endpoints=[item.strip() for item in
+                   _get_config('profile_endpoints', '').split(',')
+                   if item.strip()])
 
 if not os.path.exists(UPLOAD_FOLDER):
     os.mkdir(UPLOAD_FOLDER)
 
+# Catalog of the sessions and experiments
+CATALOG = Catalog(_get_config('catalog',
+                              os.path.join(UPLOAD_FOLDER, 'catalog.sqlite')))
+# Store of the uploaded archives, it has to be on the same file system
+# as the upload folder for the sessions to share their archive
+BLOBS = BlobStore(_get_config('blob_folder',
+                              os.path.join(UPLOAD_FOLDER, '.blobs')))
+# In-memory copy of the sample session, loaded on first use, see
+# `get_sample`
+SAMPLE = None
+_SAMPLE_LOADED = False
+_SAMPLE_LOCK = threading.RLock()
+
 
 ## I wonder if these two class could be removed by using the NumberRange
 ## object from wtforms. But it seems to not validate correctly.
@@ -133,6 +297,33 @@ class ValidateInt(object):
             raise StopValidation(self.message)
 
 
+class ValidateThresholds(object):
+    """
+    Validates that the field contains a list of LOD thresholds, see
+    `parse_thresholds`. This validator will stop the validation chain on
+    error.
+
+    @param message Error message to raise in case of a validation error.
+    """
+    field_flags = ('required', )
+
+    def __init__(self, message=None):
+        self.message = message
+
+    def __call__(self, form, field):
+        try:
+            parse_thresholds(field.data)
+        except ValueError:
+            if self.message is None:
+                self.message = field.gettext(
+                    u'This field should contain up to %s LOD thresholds '
+                    u'separated by commas or a range (start:stop:step).'
+                    % MAX_SWEEP_SIZE)
+
+            field.errors[:] = []
+            raise StopValidation(self.message)
+
+
 class UploadForm(Form):
     """ Form used to upload the MapQTL output file and the JoinMap map
     file.
@@ -174,6 +365,8 @@ class InputFormSession(InputForm):
             tmp = []
             for session in kwargs['sessions']:
                 tmp.append((session, session))
+            if len(tmp) > 1:
+                tmp.append((ALL_SESSIONS, 'All sessions'))
 
             self.session.choices = tmp
 
@@ -182,6 +375,36 @@ class InputFormSession(InputForm):
                 self.session.label = kwargs['sessions_label']
 
 
+class SweepForm(Form):
+    """ Form used to specify the LOD thresholds of a sweep, ie: a series
+    of experiments only differing by their LOD threshold.
+    """
+    lod_thresholds = TextField("LOD thresholds",
+                               validators=[Required(), ValidateThresholds()])
+
+
+class SweepFormSession(SweepForm):
+    """ Form used to specify the LOD thresholds of a sweep and the
+    session to use.
+    """
+    session = SelectField("MapQTL session",
+                          validators=[Required()], choices=[])
+
+    def __init__(self, *args, **kwargs):
+        """ Calls the default constructor with the normal arguments.
+        If sessions are provided as kwargs, use it to fill in the
+        choices of the select field.
+        """
+        super(SweepFormSession, self).__init__(*args, **kwargs)
+        if 'sessions' in kwargs and kwargs['sessions']:
+            self.session.choices = [(session, session)
+                                    for session in kwargs['sessions']]
+
+        if 'sessions_label' in kwargs:
+            if kwargs['sessions_label']:
+                self.session.label = kwargs['sessions_label']
+
+
 ## Functions
 
 def allowed_file(input_file):
@@ -197,7 +420,7 @@ def allowed_file(input_file):
         filename.rsplit('.', 1)[1] in ALLOWED_EXTENSIONS \
         and input_file.mimetype in ALLOWED_MIMETYPES
     if not output:
-        print "Wrong file: %s - %s" % (filename, input_file.mimetype)
+        LOG.warning('Wrong file: %s - %s', filename, input_file.mimetype)
     return output
 
 
@@ -214,16 +437,41 @@ def experiment_done(session_id, lod_threshold, session):
     @param mapqtl_session the MapQTL session/run from which to retrieve
         the QTLs.
     """
-    try:
-        session = int(session)
-    except (ValueError, TypeError):
-        pass
-    for exp in get_experiment_ids(session_id):
-        infos = retrieve_exp_info(session_id, exp)
-        if str(infos['session']) == str(session) and \
-                float(infos['lod_threshold']) == float(lod_threshold):
-            return exp
-    return False
+    exp_id = CATALOG.find_experiment(session_id, lod_threshold, session)
+    if exp_id is None:
+        return False
+    return exp_id
+
+
+def parse_thresholds(text):
+    """ Return the sorted list of the LOD thresholds given in a text.
+    Thresholds are separated by commas and may be given as a range
+    `start:stop:step`, the stop being included, ie: `2:4:0.5, 5`.
+    Raises a ValueError if the text is not valid or contains more than
+    `MAX_SWEEP_SIZE` thresholds.
+
+    @param text the text containing the thresholds.
+    """
+    thresholds = set()
+    for item in text.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if ':' in item:
+            start, stop, step = [float(value) for value in item.split(':')]
+            if step <= 0 or stop < start:
+                raise ValueError('Invalid range: %s' % item)
+            cnt = 0
+            while start + cnt * step <= stop + 1e-9:
+                thresholds.add(round(start + cnt * step, 6))
+                cnt += 1
+                if len(thresholds) > MAX_SWEEP_SIZE:
+                    raise ValueError('Too many thresholds')
+        else:
+            thresholds.add(float(item))
+    if not thresholds or len(thresholds) > MAX_SWEEP_SIZE:
+        raise ValueError('Invalid number of thresholds')
+    return sorted(thresholds)
 
 
 def generate_exp_id():
@@ -251,19 +499,184 @@ def generate_session_id(size=15):
     return output.strip()
 
 
+def is_sample_session(session_id):
+    """ Return whether a session is the sample session presented on
+    the front page.
+
+    @param session_id the session identifier.
+    """
+    return bool(SAMPLE_SESSION) and session_id == SAMPLE_SESSION
+
+
+def get_session_folder(session_id):
+    """ Return the folder of a session, see `resolve_session_folder`,
+    the folder of the sample session being in the static folder.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    """
+    if is_sample_session(session_id):
+        return get_sample_folder()
+    return resolve_session_folder(UPLOAD_FOLDER, session_id)
+
+
+def get_sample_folder():
+    """ Return the folder of the sample session, in the static folder,
+    None if there is no sample session or its name cannot be written
+    with the encoding of the file system.
+    """
+    if not SAMPLE_SESSION:
+        return None
+    try:
+        name = SAMPLE_SESSION.encode(sys.getfilesystemencoding() or 'utf-8')
+    except UnicodeError:
+        return None
+    return os.path.join(APP.static_folder, name)
+
+
+def get_sample():
+    """ Return the in-memory copy of the sample session, see
+    `load_sample_session`, it is loaded by the first request using it.
+    """
+    global SAMPLE, _SAMPLE_LOADED
+    with _SAMPLE_LOCK:
+        if SAMPLE is None and not _SAMPLE_LOADED:
+            # While it is loaded, the sample session is read from its
+            # files
+            _SAMPLE_LOADED = True
+            SAMPLE = load_sample_session()
+    return SAMPLE
+
+
+def get_sample_experiment(session_id, exp_id):
+    """ Return the in-memory copy of an experiment of the sample
+    session, None if the session is not the sample session or it has no
+    such experiment.
+
+    @param session_id the session identifier.
+    @param exp_id the experiment identifier.
+    """
+    if not is_sample_session(session_id) or get_sample() is None:
+        return None
+    return SAMPLE.get_experiment(exp_id)
+
+
+def describe_session(session_id):
+    """ Return the information about the archive of a session, see
+    `ArchiveCache.describe`.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    """
+    if is_sample_session(session_id) and get_sample() is not None:
+        return SAMPLE.infos
+    return ARCHIVES.describe(
+        os.path.join(get_session_folder(session_id), 'input.zip'))
+
+
+def touch_session(session_id, exp_id=None):
+    """ Record an access to a session or to one of its experiments,
+    the sample session is not in the catalog.
+    An access is only written down in the catalog if the previous one
+    was recorded, by this process, more than `touch_interval` seconds
+    ago: the cleaning of the sessions is counted in days.
+
+    @param session_id the session identifier.
+    @param exp_id the experiment identifier, if an experiment was
+        accessed.
+    """
+    if is_sample_session(session_id):
+        return
+    now = time.time()
+    key = (session_id, exp_id)
+    with _TOUCH_LOCK:
+        if now - _LAST_TOUCHES.get(key, 0) < TOUCH_INTERVAL:
+            return
+        if len(_LAST_TOUCHES) >= 10000:
+            for old_key, last in _LAST_TOUCHES.items():
+                if now - last >= TOUCH_INTERVAL:
+                    del _LAST_TOUCHES[old_key]
+        _LAST_TOUCHES[key] = now
+    CATALOG.touch(session_id, exp_id)
+
+
+def experiment_exists(session_id, exp_id):
+    """ Return whether the session has such an experiment.
+
+    @param session_id the session identifier.
+    @param exp_id the experiment identifier.
+    """
+    if is_sample_session(session_id):
+        return get_sample_experiment(session_id, exp_id) is not None
+    return CATALOG.get_experiment(session_id, exp_id) is not None
+
+
 def get_experiment_ids(session_id):
     """ Retrieve the experiment already run within this session.
     @param session_id the session identifier uniquely identifying the
     MapQTL zip file and the JoinMap map file. This is also the name of
     the folder in which are the different experiment
     """
-    folder = os.path.join(UPLOAD_FOLDER, session_id)
-    exp_ids = []
+    if is_sample_session(session_id):
+        return SAMPLE.get_experiment_ids() if get_sample() else []
+    return CATALOG.get_experiment_ids(session_id)
+
+
+def session_exists(session_id):
+    """ Check if the specified session exists.
+    Sessions created before the catalog are imported in it the first
+    time they are checked.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    """
+    if is_sample_session(session_id):
+        return get_sample() is not None
+    if not is_valid_session_id(session_id):
+        return False
+    if CATALOG.has_session(session_id):
+        return True
+    if os.path.isdir(get_session_folder(session_id)):
+        import_session(session_id)
+        return True
+    return False
+
+
+def import_session(session_id):
+    """ Import in the catalog a session and its experiments from their
+    folder and `exp.cfg` files.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    """
+    folder = get_session_folder(session_id)
+    CATALOG.add_session(session_id, created=datetime.datetime.fromtimestamp(
+        os.path.getmtime(folder)))
     for filename in os.listdir(folder):
-        if os.path.isdir(os.path.join(folder, filename)) \
-                and filename.startswith('20'):
-            exp_ids.append(filename)
-    return exp_ids
+        exp_cfg = os.path.join(folder, filename, 'exp.cfg')
+        if filename.startswith('20') and os.path.exists(exp_cfg):
+            infos = read_exp_config(session_id, filename)
+            CATALOG.add_experiment(
+                session_id, filename,
+                lod_threshold=infos['lod_threshold'],
+                session=infos['session'],
+                plugin=infos['plugin'],
+                n_markers=infos['n_markers'],
+                n_traits=infos['n_traits'],
+                created=datetime.datetime.fromtimestamp(
+                    os.path.getmtime(exp_cfg)))
+
+
+def import_catalog():
+    """ Import in the catalog all the sessions present in the upload
+    folder.
+    Returns the number of sessions imported.
+    """
+    cnt = 0
+    for entry in list_sessions(UPLOAD_FOLDER):
+        import_session(entry.name)
+        cnt += 1
+    return cnt
 
 
 def retrieve_exp_info(session_id, exp_id):
@@ -274,7 +687,25 @@ def retrieve_exp_info(session_id, exp_id):
     @param exp_id the experiment identifier used to uniquely identify a
     run which may have specific parameters.
     """
-    folder = os.path.join(UPLOAD_FOLDER, session_id, exp_id)
+    experiment = get_sample_experiment(session_id, exp_id)
+    if experiment is not None:
+        return dict(experiment.infos)
+    infos = CATALOG.get_experiment(session_id, exp_id)
+    if infos is None:
+        infos = read_exp_config(session_id, exp_id)
+    return infos
+
+
+def read_exp_config(session_id, exp_id):
+    """ Read the parameters used in the specified experiment from its
+    `exp.cfg` file.
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file. This is also the name of
+    the folder in which are the different experiment
+    @param exp_id the experiment identifier used to uniquely identify a
+    run which may have specific parameters.
+    """
+    folder = os.path.join(get_session_folder(session_id), exp_id)
     config = ConfigParser.RawConfigParser()
     config.read('%s/exp.cfg' % folder)
     try:
@@ -363,114 +794,670 @@ def retrieve_marker_info(session_id, exp_id, marker_id):
     The second element is a list of all the QTLs found associated with
     the specified marker.
     """
-    folder = os.path.join(UPLOAD_FOLDER, session_id, exp_id)
+    experiment = get_sample_experiment(session_id, exp_id)
+    if experiment is not None:
+        return experiment.get_marker(marker_id)
+    folder = os.path.join(get_session_folder(session_id), exp_id)
     infos = retrieve_exp_info(session_id, exp_id)
-    qtls = []
-    headers = []
-    cnt = 0
-    to_remove = []
+    try:
+        headers, qtls = read_marker_rows(folder, marker_id)
+    except (IOError, OSError):
+        LOG.warning('No output in folder %s', folder)
+        return ([], [])
     if 'plugin' in infos and infos['plugin'] == 'MapQTL plugin':
-        to_remove = [5, 5, 5, 5, 9]
+        keep = [cnt for cnt in range(len(headers))
+                if cnt not in MAPQTL_HIDDEN_COLUMNS]
+        headers = [headers[cnt] for cnt in keep]
+        qtls = [[row[cnt] for cnt in keep] for row in qtls]
+    return (headers, qtls)
+
+
+def get_mapqtl_session(session_id):
+    """ Retrieve the list of MapQTL session available.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file. The session identifier
+    also uniquely identifies the folder in which are the files uploaded.
+    """
+    folder = get_session_folder(session_id)
+    try:
+        filenames = [info.filename for info in
+                     list_archive(os.path.join(folder, 'input.zip'))]
+    except (IOError, zipfile.BadZipfile), err:
+        raise MQ2NoSuchSessionException(err)
+    return get_mapqtl_sessions(filenames)
+
+
+def get_pending_jobs(session_id):
+    """ Retrieve the jobs of this session which are still queued or
+    running.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    """
+    if is_sample_session(session_id):
+        return []
+    folder = get_session_folder(session_id)
+    jobs = []
+    for job_id in sorted(get_job_ids(folder)):
+        infos = read_job_status(folder, job_id)
+        if infos and infos['status'] in (QUEUED, RUNNING):
+            jobs.append(infos)
+    return jobs
+
+
+def describe_job(session_id, infos):
+    """ Return the information about a job given to the browser: once
+    done, the url of the result page of the experiment, or of the sweep,
+    is added.
+
+    @param session_id the session identifier uniquely identifying the
+        MapQTL zip file and the JoinMap map file.
+    @param infos the information about the job, see `read_job_status`.
+    """
+    infos = dict(infos)
+    if infos['status'] == DONE and 'lod_thresholds' in infos:
+        infos['url'] = url_for('sweep_results', session_id=session_id,
+                               sweep_id=infos['job_id'])
+    elif infos['status'] == DONE:
+        infos['url'] = url_for('results', session_id=session_id,
+                               exp_id=infos['exp_id'])
+    return infos
+
+
+def find_pending_job(session_id, lod_threshold, session):
+    """ Return the identifier of a job of this session still queued or
+    running with the same parameters, None if there is none.
+
+    @param session_id the session identifier uniquely identifying the
+        MapQTL zip file and the JoinMap map file.
+    @param lod_threshold the LOD threshold of the experiment.
+    @param session the MapQTL session/run of the experiment.
+    """
+    for infos in get_pending_jobs(session_id):
+        if 'lod_threshold' not in infos:
+            continue
+        if float(infos['lod_threshold']) == float(lod_threshold) \
+                and infos.get('session') == str(session):
+            return infos['job_id']
+    return None
+
+
+def parse_exp_id(exp_id):
+    """ Return the MapQTL session and the LOD threshold of an experiment
+    from its identifier, None if it is not an experiment identifier.
+
+    @param exp_id the experiment identifier, ie: `<date>_s<session>_t<LOD
+        threshold>`.
+    """
+    match = re.match(r'^\d{14}\d*_s(.*)_t([^_]+)$', exp_id)
+    if match is None:
+        return None
+    session, lod_threshold = match.groups()
     try:
-        stream = open('%s/qtls_with_mk.csv' % folder, 'r')
-        for row in stream.readlines():
-            row = row.strip().split(',')
-            if cnt == 0:
-                for ind in to_remove:
-                    row.remove(row[ind])
-                headers = row
-                cnt = cnt + 1
+        float(lod_threshold)
+    except ValueError:
+        return None
+    return (None if session == 'None' else session, lod_threshold)
+
+
+def get_lock_folder(session_id):
+    """ Return the folder of the locks of a session, creating it if
+    needed.
+
+    @param session_id the session identifier uniquely identifying the
+        MapQTL zip file and the JoinMap map file.
+    """
+    folder = os.path.join(get_session_folder(session_id), LOCK_FOLDER)
+    if not os.path.exists(folder):
+        try:
+            os.mkdir(folder)
+        except OSError:
+            # Created concurrently
+            pass
+    return folder
+
+
+def get_experiment_lock(session_id, lod_threshold, session):
+    """ Return the lock held while an experiment is generated, there is
+    one per session and parameters.
+
+    @param session_id the session identifier uniquely identifying the
+        MapQTL zip file and the JoinMap map file.
+    @param lod_threshold the LOD threshold of the experiment.
+    @param session the MapQTL session/run of the experiment.
+    """
+    name = re.sub(r'[^\w.-]', '_', 's%s_t%g.lock' % (
+        session, float(lod_threshold)))
+    return FileLock(os.path.join(get_lock_folder(session_id), name))
+
+
+def get_job_lock(session_id, job_id):
+    """ Return the lock held by the process running a job.
+
+    @param session_id the session identifier uniquely identifying the
+        MapQTL zip file and the JoinMap map file.
+    @param job_id the identifier of the job.
+    """
+    return FileLock(os.path.join(get_lock_folder(session_id),
+                                 '%s.job.lock' % job_id))
+
+
+def claim_job(session_id, job_id):
+    """ Return the lock of a job, acquired, or None if the job must not
+    be run: another process is running it or it is already finished, as
+    a job submitted again by `recover_experiments` may also still be
+    queued in the process which submitted it first.
+
+    @param session_id the session identifier uniquely identifying the
+        MapQTL zip file and the JoinMap map file.
+    @param job_id the identifier of the job.
+    """
+    lock = get_job_lock(session_id, job_id)
+    if not lock.acquire(blocking=False):
+        return None
+    upload_folder = get_session_folder(session_id)
+    infos = read_job_status(upload_folder, job_id)
+    if infos is not None and infos['status'] not in (QUEUED, RUNNING):
+        lock.release()
+        # The job was cancelled while queued, or is finished
+        cancel_file = get_cancel_file(upload_folder, job_id)
+        if os.path.exists(cancel_file):
+            os.unlink(cancel_file)
+        return None
+    return lock
+
+
+def get_build_folder(upload_folder, exp_id):
+    """ Return an empty folder in which to generate an experiment, it is
+    moved in place once complete by `write_down_config`.
+
+    @param upload_folder the folder of the session.
+    @param exp_id the experiment identifier.
+    """
+    folder = os.path.join(upload_folder, '%s%s' % (BUILD_PREFIX, exp_id))
+    if os.path.exists(folder):
+        # Left by a process which stopped while building it
+        shutil.rmtree(folder)
+    os.mkdir(folder)
+    return folder
+
+
+def find_job(session_id, job_id):
+    """ Return the information about a job of a session, see
+    `read_job_status`, or None if there is no such session or job.
+
+    @param session_id the session identifier uniquely identifying the
+        MapQTL zip file and the JoinMap map file.
+    @param job_id the identifier of the job.
+    """
+    if job_id.startswith('.') or not session_exists(session_id):
+        return None
+    return read_job_status(get_session_folder(session_id), job_id)
+
+
+def resubmit_job(session_id, infos):
+    """ Submit again a job which was queued or running in a process
+    which stopped.
+
+    @param session_id the session identifier uniquely identifying the
+        MapQTL zip file and the JoinMap map file.
+    @param infos the information about the job, see `read_job_status`.
+    """
+    upload_folder = get_session_folder(session_id)
+    job_id = infos['job_id']
+    session = infos.get('session')
+    if session == 'None':
+        session = None
+    if 'lod_thresholds' in infos:
+        JOBS.submit(upload_folder, job_id, run_sweep,
+                    (session_id, job_id,
+                     parse_thresholds(infos['lod_thresholds']), session),
+                    lod_thresholds=infos['lod_thresholds'],
+                    session=session)
+    else:
+        JOBS.submit(upload_folder, job_id, run_job,
+                    (session_id, job_id, infos['lod_threshold'], session),
+                    lod_threshold=infos['lod_threshold'], session=session)
+
+
+def recover_experiments():
+    """ Clean up after the processes which stopped while generating
+    experiments: the folders of the experiments left without their
+    `exp.cfg` file are removed and the jobs which were not finished are
+    submitted again.
+    The experiments still being generated and the jobs still being run
+    by another process are left untouched, their lock being held.
+    It is run by `main`, not when the module is imported, for the other
+    scripts importing it not to submit jobs.
+    Returns the number of folders removed and of jobs submitted again.
+    """
+    removed = 0
+    resubmitted = 0
+    for entry in list_sessions(UPLOAD_FOLDER):
+        session_id = entry.name
+        for name in os.listdir(entry.path):
+            exp_id = name
+            if name.startswith(BUILD_PREFIX):
+                exp_id = name[len(BUILD_PREFIX):]
+            params = parse_exp_id(exp_id)
+            folder = os.path.join(entry.path, name)
+            if params is None or not os.path.isdir(folder) \
+                    or os.path.exists(os.path.join(folder, 'exp.cfg')):
                 continue
-            if row[-3] == marker_id:
-                for ind in to_remove:
-                    row.remove(row[ind])
-                qtls.append(row)
-        stream.close()
-    except IOError:
-        print 'No output in folder %s' % folder
-    return (headers, qtls)
+            lock = get_experiment_lock(session_id, params[1], params[0])
+            if not lock.acquire(blocking=False):
+                continue
+            try:
+                LOG.warning('Removing the unfinished experiment %s', folder)
+                shutil.rmtree(folder, ignore_errors=True)
+                removed += 1
+            finally:
+                lock.release()
+        for job_id in get_job_ids(entry.path):
+            infos = read_job_status(entry.path, job_id)
+            if not infos or infos['status'] not in (QUEUED, RUNNING):
+                continue
+            # The job is still being run by another process
+            lock = get_job_lock(session_id, job_id)
+            if not lock.acquire(blocking=False):
+                continue
+            lock.release()
+            LOG.warning('Submitting again the job %s of session %s',
+                        job_id, session_id)
+            try:
+                resubmit_job(session_id, infos)
+                resubmitted += 1
+            except (KeyError, ValueError, MQ2Exception), err:
+                write_job_status(entry.path, job_id, FAILED, error=err)
+    if removed or resubmitted:
+        LOG.info('%s unfinished experiments removed, %s jobs submitted '
+                 'again', removed, resubmitted)
+    return (removed, resubmitted)
+
+
+def submit_batch(session_id, lod_threshold, sessions):
+    """ Submit, as a batch, the experiments of all the MapQTL sessions of
+    an archive for a LOD threshold. There is one job per MapQTL session,
+    run in parallel by the workers, the experiments already run or
+    running are not submitted again.
+    Returns the identifier of the batch.
+
+    @param session_id the session identifier uniquely identifying the
+        MapQTL zip file and the JoinMap map file.
+    @param lod_threshold the LOD threshold to use to consider a value
+        significant for a QTL.
+    @param sessions the MapQTL sessions/runs from which to retrieve
+        the QTLs.
+    """
+    upload_folder = get_session_folder(session_id)
+    prefix = generate_exp_id()
+    batch_id = '%s_t%s_batch' % (prefix, lod_threshold)
+    jobs = []
+    submit = []
+    for session in sessions:
+        job_id = experiment_done(session_id, lod_threshold, session)
+        if job_id is False:
+            job_id = find_pending_job(session_id, lod_threshold, session)
+        if job_id is None:
+            job_id = '%s_s%s_t%s' % (prefix, session, lod_threshold)
+            submit.append((session, job_id))
+        jobs.append((session, lod_threshold, job_id))
+    # The batch is written down first for its page to list the jobs as
+    # soon as they are submitted
+    write_batch_table(upload_folder, batch_id, jobs)
+    for session, job_id in submit:
+        try:
+            JOBS.submit(upload_folder, job_id, run_job,
+                        (session_id, job_id, lod_threshold, session),
+                        lod_threshold=lod_threshold, session=session)
+        except MQ2Exception, err:
+            # The job is failed, the other ones of the batch go on
+            LOG.error('Could not run the experiment %s: %s', job_id, err)
+    return batch_id
 
 
-def retrieve_qtl_infos(session_id, exp_id):
-    """ Retrieve the evolution of the number of QTLs per marker in
-    the results of the experiment.
+def read_batch_summary(session_id, batch_id):
+    """ Return, for each experiment of a batch, its MapQTL session, the
+    status of its job, its identifier and, once done, the hotspots found.
+    Also returns whether jobs of the batch are still queued or running.
 
     @param session_id the session identifier uniquely identifying the
-        MapQTL zip file and the JoinMap map file. This is also the name
-        of the folder in which are the different experiment
-    @param exp_id the experiment identifier used to uniquely identify a
-        run which may have specific parameters.
-    @return a tuple containing four elements.
-        The first element is the qtls_evo list, containing for each
-        marker the number of QTLs found.
-        The second element is the mk_list, a list of all the markers on
-        the map.
-        The third element is the qtls_lg, a list of all the different
-        linkage group available.
-        The fourth element is the lg_index, a list of the position at
-        which the linkage group change.
-    """
-    folder = os.path.join(UPLOAD_FOLDER, session_id, exp_id)
-    qtls_evo = []
-    qtls_lg = []
-    lg_index = []
-    mk_list = []
+        MapQTL zip file and the JoinMap map file.
+    @param batch_id the identifier of the batch.
+    """
+    upload_folder = get_session_folder(session_id)
+    rows = []
+    pending = False
+    for session, lod_threshold, job_id in read_batch_table(upload_folder,
+                                                           batch_id):
+        infos = read_job_status(upload_folder, job_id)
+        if infos is None:
+            # The experiment was run before the batch, not by a job
+            infos = {'status': DONE, 'exp_id': job_id}
+        if infos['status'] == DONE and not experiment_exists(
+                session_id, infos.get('exp_id', '')):
+            infos = {'status': FAILED,
+                     'error': 'This experiment does not exists'}
+        row = [session, infos['status'], infos.get('exp_id', '')]
+        if infos['status'] == DONE:
+            row.extend(get_hotspot_summary(
+                os.path.join(upload_folder, infos['exp_id'])))
+        elif infos['status'] == FAILED:
+            row.append(infos.get('error', ''))
+        else:
+            pending = True
+        rows.append(row)
+    return (rows, pending)
+
+
+def run_job(session_id, job_id, lod_threshold, session):
+    """ Run an experiment submitted to the job queue.
+    The status of the job is updated as it goes, the job identifier is
+    used as experiment identifier.
+
+    @param session_id the session identifier uniquely identifying the
+        MapQTL zip file and the JoinMap map file.
+    @param job_id the identifier of the job.
+    @param lod_threshold the LOD threshold to use to consider a value
+        significant for a QTL.
+    @param session the MapQTL session/run from which to retrieve
+        the QTLs.
+    """
+    upload_folder = get_session_folder(session_id)
+    lock = claim_job(session_id, job_id)
+    if lock is None:
+        return None
+    try:
+        progress = JobProgress(upload_folder, job_id)
+        if progress.cancelled():
+            write_job_status(upload_folder, job_id, FAILED, error=CANCELLED)
+            progress.close()
+            return None
+        write_job_status(upload_folder, job_id, RUNNING)
+        progress.emit('started', lod_threshold=lod_threshold, session=session)
+        try:
+            exp_id = run_experiment(session_id, job_id, lod_threshold, session,
+                                    progress=progress)
+        # The job runs in a worker, whatever went wrong has to be reported
+        except Exception, err:
+            write_job_status(upload_folder, job_id, FAILED, error=err)
+            raise
+        finally:
+            progress.close()
+        write_job_status(upload_folder, job_id, DONE, exp_id=exp_id)
+        try:
+            build_zip(os.path.join(upload_folder, exp_id), exp_id)
+        except (IOError, OSError), err:
+            # The archive will be generated on the fly when downloaded
+            LOG.error('Could not generate the zip file: %s', err)
+        return exp_id
+    finally:
+        lock.release()
+
+
+def run_sweep(session_id, sweep_id, lod_thresholds, session):
+    """ Run a LOD sweep submitted to the job queue.
+    The status of the job is updated as it goes, the job identifier is
+    used as sweep identifier.
+
+    @param session_id the session identifier uniquely identifying the
+        MapQTL zip file and the JoinMap map file.
+    @param sweep_id the identifier of the job.
+    @param lod_thresholds the list of LOD thresholds to use.
+    @param session the MapQTL session/run from which to retrieve
+        the QTLs.
+    """
+    upload_folder = get_session_folder(session_id)
+    lock = claim_job(session_id, sweep_id)
+    if lock is None:
+        return None
     try:
-        stream = open('%s/map_with_qtls.csv' % folder, 'r')
-        lg = None
-        cnt = 0
-        for row in stream.readlines():
-            row = row.split(',')
-            if not lg:
-                lg = row[1]
-            if row[3].startswith('#'):
+        progress = JobProgress(upload_folder, sweep_id)
+        if progress.cancelled():
+            write_job_status(upload_folder, sweep_id, FAILED, error=CANCELLED)
+            progress.close()
+            return None
+        write_job_status(upload_folder, sweep_id, RUNNING)
+        progress.emit('started', lod_thresholds=len(lod_thresholds),
+                      session=session)
+        try:
+            experiments = mq2_sweep(session_id, lod_thresholds, session,
+                                    sweep_id, progress=progress)
+            write_sweep_table(upload_folder, sweep_id, experiments)
+        # The job runs in a worker, whatever went wrong has to be reported
+        except Exception, err:
+            write_job_status(upload_folder, sweep_id, FAILED, error=err)
+            raise
+        finally:
+            progress.close()
+        write_job_status(upload_folder, sweep_id, DONE)
+        for lod_threshold, exp_id in experiments:
+            exp_folder = os.path.join(upload_folder, exp_id)
+            if os.path.exists(os.path.join(exp_folder, '%s.zip' % exp_id)):
                 continue
-            else:
-                qtls_evo.append(row[3].strip())
-            if lg != row[1]:
-                lg_index.append(cnt)
-                lg = None
-            if row[1] not in qtls_lg:
-                qtls_lg.append(row[1])
-            mk_list.append(row[0])
-            cnt = cnt + 1
-        stream.close()
-    except IOError:
-        print 'No output in folder %s' % folder
-    return (qtls_evo, mk_list, qtls_lg, lg_index)
+            try:
+                build_zip(exp_folder, exp_id)
+            except (IOError, OSError), err:
+                # The archive will be generated on the fly when downloaded
+                LOG.error('Could not generate the zip file: %s', err)
+        return sweep_id
+    finally:
+        lock.release()
 
 
-def get_mapqtl_session(session_id):
-    """ Retrieve the list of MapQTL session available.
+def mq2_sweep(session_id, lod_thresholds, session, sweep_id,
+              progress=None):
+    """ Run the experiments of a LOD sweep.
+    The experiments are run by increasing threshold so that only the
+    first one has to parse the input files, the output of the others is
+    derived from it.
 
     @param session_id the session identifier uniquely identifying the
-    MapQTL zip file and the JoinMap map file. The session identifier
-    also uniquely identifies the folder in which are the files uploaded.
+        MapQTL zip file and the JoinMap map file.
+    @param lod_thresholds the list of LOD thresholds to use.
+    @param session the MapQTL session/run from which to retrieve
+        the QTLs.
+    @param sweep_id the identifier of the sweep, used to name the
+        experiments.
+    @param progress the `JobProgress` of the sweep.
+    @return the list of (LOD threshold, experiment identifier) of the
+        sweep.
+    """
+    upload_folder = get_session_folder(session_id)
+    prefix = sweep_id.split('_', 1)[0]
+    lod_thresholds = ['%g' % lod for lod in sorted(lod_thresholds)]
+    if progress is None:
+        progress = NoProgress()
+    experiments = []
+    for cnt, lod_threshold in enumerate(lod_thresholds):
+        if progress.cancelled():
+            raise MQ2Exception(CANCELLED)
+        progress.emit('experiment', lod_threshold=lod_threshold,
+                      position=cnt + 1, total=len(lod_thresholds))
+        exp_id = experiment_done(session_id, lod_threshold, session)
+        if exp_id is False:
+            exp_id = run_experiment(
+                session_id, '%s_s%s_t%s' % (prefix, session, lod_threshold),
+                lod_threshold, session, progress=progress)
+        experiments.append((lod_threshold, exp_id))
+    return experiments
+
+
+def run_experiment(session_id, exp_id, lod_threshold, session,
+                   progress=None):
+    """ Run an experiment, reusing the one of another session with the
+    same archive and parameters if there is one, or deriving it from an
+    experiment of this session run with a lower LOD threshold. The input
+    files are only processed if neither is possible.
+
+    @param session_id the session identifier uniquely identifying the
+        MapQTL zip file and the JoinMap map file.
+    @param exp_id the identifier to give to the experiment.
+    @param lod_threshold the LOD threshold to use to consider a value
+        significant for a QTL.
+    @param session the MapQTL session/run from which to retrieve
+        the QTLs.
+    @param progress the `JobProgress` of the job running the experiment.
+    @return the experiment identifier.
+    """
+    if progress is None:
+        progress = NoProgress()
+    # Identical experiments submitted concurrently wait for the first
+    # one and then use its output
+    with get_experiment_lock(session_id, lod_threshold, session):
+        output = experiment_done(session_id, lod_threshold, session)
+        if output is not False:
+            return output
+        return _run_experiment(session_id, exp_id, lod_threshold, session,
+                               progress)
+
+
+def _run_experiment(session_id, exp_id, lod_threshold, session, progress):
+    """ Run an experiment, see `run_experiment`, once the lock on its
+    parameters is held.
     """
-    folder = os.path.join(UPLOAD_FOLDER, session_id)
-    tmp_folder = None
-    sessions = []
+    start = time.time()
+    if reuse_experiment(session_id, exp_id, lod_threshold, session,
+                        progress=progress):
+        EXPERIMENT_TIME.observe(time.time() - start, method='copy')
+        return exp_id
+    for base_id in CATALOG.find_base_experiments(session_id, lod_threshold,
+                                                 session):
+        base_folder = os.path.join(get_session_folder(session_id),
+                                   base_id)
+        if not [filename for filename in DERIVED_FROM
+                if not os.path.exists(os.path.join(base_folder, filename))]:
+            start = time.time()
+            try:
+                mq2_derive(session_id, base_id, lod_threshold, session,
+                           exp_id, progress=progress)
+                EXPERIMENT_TIME.observe(time.time() - start, method='derive')
+                return exp_id
+            except MQ2Exception, err:
+                LOG.error('Could not derive the experiment: %s', err)
+    start = time.time()
+    folder, infos = ARCHIVES.checkout(
+        os.path.join(get_session_folder(session_id), 'input.zip'))
     try:
-        tmp_folder = set_tmp_folder()
-        extract_zip(os.path.join(folder, 'input.zip'), tmp_folder)
-        filelist = []
-        for root, dirs, files in os.walk(tmp_folder):
-            for filename in files:
-                if filename.startswith('Session') \
-                        and filename.endswith('.mqo'):
-                    session = filename.split()[1].strip()
-                    if session not in sessions:
-                        sessions.append(session)
-    except IOError, err:
-        raise MQ2NoSuchSessionException(err)
+        exp_id = mq2_run(session_id, get_plugin(infos['plugin']), folder,
+                         lod_threshold=lod_threshold, session=session,
+                         exp_id=exp_id, progress=progress)
+    finally:
+        if os.path.exists(folder):
+            shutil.rmtree(folder)
+    EXPERIMENT_TIME.observe(time.time() - start, method='run')
+    return exp_id
+
+
+def mq2_derive(session_id, base_id, lod_threshold, session, exp_id,
+               progress=None):
+    """ Generate an experiment from the output of an experiment of the
+    same session run at a lower LOD threshold.
+
+    @param session_id the session identifier uniquely identifying the
+        MapQTL zip file and the JoinMap map file.
+    @param base_id the identifier of the experiment run at a lower LOD
+        threshold.
+    @param lod_threshold the LOD threshold to use to consider a value
+        significant for a QTL.
+    @param session the MapQTL session/run from which to retrieve
+        the QTLs.
+    @param exp_id the identifier to give to the experiment.
+    @param progress the `JobProgress` of the job running the experiment.
+    """
+    if progress is None:
+        progress = NoProgress()
+    upload_folder = get_session_folder(session_id)
+    infos = retrieve_exp_info(session_id, base_id)
+    build_folder = get_build_folder(upload_folder, exp_id)
+    progress.emit('deriving', base_id=base_id)
+    try:
+        derive_experiment(os.path.join(upload_folder, base_id),
+                          build_folder, lod_threshold)
+        build_store(build_folder,
+                    base_folder=os.path.join(upload_folder, base_id))
+        build_plot_payload(build_folder)
+        write_down_config(folder=build_folder,
+                          lod_threshold=lod_threshold,
+                          session=session,
+                          exp_id=exp_id,
+                          plugin=get_plugin(infos['plugin']),
+                          n_markers=infos['n_markers'],
+                          n_traits=infos['n_traits'],
+                          session_id=session_id,
+                          exp_folder=os.path.join(upload_folder, exp_id))
+        progress.emit('written', exp_id=exp_id, outputs=sorted(
+            os.listdir(os.path.join(upload_folder, exp_id))))
+    except (IOError, OSError, ValueError, IndexError), err:
+        raise MQ2Exception('Could not derive the experiment from %s: %s'
+                           % (base_id, err))
     finally:
-        if tmp_folder and os.path.exists(tmp_folder):
-            shutil.rmtree(tmp_folder)
-    sessions.sort()
-    return sessions
+        if os.path.exists(build_folder):
+            shutil.rmtree(build_folder, ignore_errors=True)
+
 
+def reuse_experiment(session_id, exp_id, lod_threshold, session,
+                     progress=None):
+    """ Copy in this session the output of an experiment run with the
+    same parameters on the same archive, uploaded in another session.
+    The output files are hard linked, only the configuration of the
+    experiment is rewritten.
 
-def mq2_run(session_id, plugin, folder, lod_threshold, session):
+    @param session_id the session identifier uniquely identifying the
+        MapQTL zip file and the JoinMap map file.
+    @param exp_id the identifier to give to the experiment.
+    @param lod_threshold the LOD threshold to use to consider a value
+        significant for a QTL.
+    @param session the MapQTL session/run from which to retrieve
+        the QTLs.
+    @param progress the `JobProgress` of the job running the experiment.
+    @return the experiment identifier or None if no experiment could be
+        reused.
+    """
+    if progress is None:
+        progress = NoProgress()
+    upload_folder = get_session_folder(session_id)
+    digest = archive_digest(os.path.join(upload_folder, 'input.zip'))
+    CATALOG.set_archive(session_id, digest)
+    for (src_session_id, src_exp_id) in CATALOG.find_shared_experiments(
+            digest, lod_threshold, session):
+        src_folder = os.path.join(get_session_folder(src_session_id),
+                                  src_exp_id)
+        if not os.path.exists(os.path.join(src_folder, 'exp.cfg')):
+            # The session was removed but is still in the catalog
+            continue
+        infos = retrieve_exp_info(src_session_id, src_exp_id)
+        build_folder = get_build_folder(upload_folder, exp_id)
+        progress.emit('copying', session_id=src_session_id,
+                      exp_id=src_exp_id)
+        try:
+            link_tree(src_folder, build_folder,
+                      ignore=lambda filename: filename.endswith('.zip'))
+            # The configuration is linked to the one of the original
+            # experiment, it must not be written through the link
+            os.unlink(os.path.join(build_folder, 'exp.cfg'))
+            write_down_config(folder=build_folder,
+                              lod_threshold=lod_threshold,
+                              session=session,
+                              exp_id=exp_id,
+                              plugin=get_plugin(infos['plugin']),
+                              n_markers=infos['n_markers'],
+                              n_traits=infos['n_traits'],
+                              session_id=session_id,
+                              exp_folder=os.path.join(upload_folder,
+                                                      exp_id))
+            progress.emit('written', exp_id=exp_id, outputs=sorted(
+                os.listdir(os.path.join(upload_folder, exp_id))))
+        finally:
+            if os.path.exists(build_folder):
+                shutil.rmtree(build_folder, ignore_errors=True)
+        return exp_id
+    return None
+
+
+def mq2_run(session_id, plugin, folder, lod_threshold, session,
+            exp_id=None, progress=None):
     """ Run the scripts to extract the QTLs.
 
     :arg session_id: the session identifier uniquely identifying the
@@ -481,39 +1468,93 @@ def mq2_run(session_id, plugin, folder, lod_threshold, session):
         significant for a QTL.
     :arg mapqtl_session: the MapQTL session/run from which to retrieve
         the QTLs.
+    :kwarg exp_id: the identifier to give to this experiment, generated
+        from the time and the parameters if not provided.
+    :kwarg progress: the `JobProgress` of the job running the experiment,
+        it is told when the input files are parsed, the traits processed
+        and the output written.
+
+    The input files are processed in a child process limited by the
+    `job_cpu_time`, `job_wall_time` and `job_memory` options, if it
+    exceeds them (or if the job is cancelled) it is killed, its partial
+    output removed and a MQ2Exception giving the cause is raised.
+    Returns the identifier of the experiment, or of the one already run
+    with the same parameters.
     """
-    upload_folder = os.path.join(UPLOAD_FOLDER, session_id)
+    if progress is None:
+        progress = NoProgress()
+    upload_folder = get_session_folder(session_id)
     already_done = experiment_done(session_id, lod_threshold, session)
     if already_done is not False:
         return already_done
-    exp_id = '%s_s%s_t%s' % (generate_exp_id(), session,
-                             lod_threshold)
-    exp_folder = os.path.join(upload_folder, exp_id)
-    if not os.path.exists(exp_folder):
-        os.mkdir(exp_folder)
-
+    if exp_id is None:
+        exp_id = '%s_s%s_t%s' % (generate_exp_id(), session,
+                                 lod_threshold)
+    build_folder = get_build_folder(upload_folder, exp_id)
+    progress.emit('parsing', n_files=sum(
+        len(filenames) for _, _, filenames in os.walk(folder)))
     try:
-        run_mq2(plugin, folder, lod_threshold=lod_threshold,
-                session=session, outputfolder=exp_folder)
-
-        (nline, ncol) = get_matrix_dimensions(os.path.join(
-            exp_folder, 'qtls_matrix.csv'))
-    except MQ2Exception, err:
-        shutil.rmtree(exp_folder)
+        (nline, ncol) = run_sandboxed(
+            build_experiment,
+            (plugin, folder, lod_threshold, session, build_folder,
+             progress),
+            cpu_time=JOB_CPU_TIME, wall_time=JOB_WALL_TIME,
+            memory=JOB_MEMORY, cancelled=progress.cancelled)
+        write_down_config(folder=build_folder,
+                          lod_threshold=lod_threshold,
+                          session=session,
+                          exp_id=exp_id,
+                          plugin=plugin,
+                          n_markers=nline - 2,
+                          n_traits=ncol - 5,
+                          session_id=session_id,
+                          exp_folder=os.path.join(upload_folder, exp_id))
+        progress.emit('written', exp_id=exp_id, outputs=sorted(
+            os.listdir(os.path.join(upload_folder, exp_id))))
+    except (MQ2Exception, JobAborted, IOError, OSError, ValueError,
+            IndexError), err:
         raise MQ2Exception(err)
+    finally:
+        if os.path.exists(build_folder):
+            shutil.rmtree(build_folder, ignore_errors=True)
+    return exp_id
+
 
-    write_down_config(folder=os.path.join(upload_folder, exp_id),
-                      lod_threshold=lod_threshold,
-                      session=session,
-                      exp_id=exp_id,
-                      plugin=plugin,
-                      n_markers=nline - 2,
-                      n_traits=ncol - 5)
+def build_experiment(plugin, folder, lod_threshold, session, build_folder,
+                     progress):
+    """ Process the input files of an experiment and write its output,
+    but its configuration, in the given folder. This is what `mq2_run`
+    runs in a child process.
+    Returns the number of rows and columns of the LOD matrix.
+
+    @param plugin the plugin reading the input files.
+    @param folder the folder in which the archive is extracted.
+    @param lod_threshold the LOD threshold to use to consider a value
+        significant for a QTL.
+    @param session the MapQTL session/run from which to retrieve
+        the QTLs.
+    @param build_folder the folder in which to write the output.
+    @param progress the `JobProgress` of the job running the experiment.
+    """
+    run_mq2(plugin, folder, lod_threshold=lod_threshold,
+            session=session, outputfolder=build_folder)
+    progress.emit('parsed', outputs=sorted(os.listdir(build_folder)))
+
+    build_store(build_folder)
+    (nline, ncol) = open_store(build_folder).get_matrix_dimensions()
+    progress.emit('processed', n_markers=nline - 2, n_traits=ncol - 5)
+    build_plot_payload(build_folder)
+    return (nline, ncol)
 
 
 def write_down_config(folder, lod_threshold, session, exp_id,
-                      plugin, n_markers, n_traits):
-    """ Write down the configuration used in an experiment.
+                      plugin, n_markers, n_traits, session_id=None,
+                      exp_folder=None):
+    """ Write down the configuration used in an experiment and record
+    it in the catalog.
+    The configuration being the last file written, an experiment
+    built in a temporary folder is moved in place at this point, so
+    that its folder never exists without it.
 
     @param folder the folder in which to write down this configuration.
     @param lod_threshold the LOD threshold to use to consider a value
@@ -522,6 +1563,10 @@ def write_down_config(folder, lod_threshold, session, exp_id,
         the QTLs.
     @param n_markers the number of markers present in the dataset
     @param n_traits the number of traits present in the dataset
+    @param session_id the session identifier, defaults to the name of
+        the parent folder of the experiment.
+    @param exp_folder the folder of the experiment when it is built in
+        another folder, see `get_build_folder`.
     """
     config = ConfigParser.RawConfigParser()
     config.add_section('Parameters')
@@ -536,39 +1581,227 @@ def write_down_config(folder, lod_threshold, session, exp_id,
     config.write(configfile)
     configfile.close()
 
+    if exp_folder is not None:
+        os.rename(folder, exp_folder)
+        folder = exp_folder
+    if session_id is None:
+        session_id = os.path.basename(os.path.dirname(
+            os.path.abspath(folder)))
+    CATALOG.add_experiment(session_id, exp_id,
+                           lod_threshold=float(lod_threshold),
+                           session=session,
+                           plugin=plugin.name,
+                           n_markers=n_markers,
+                           n_traits=n_traits)
+
+
+def get_experiment_validators(session_id, exp_id, filename='exp.cfg'):
+    """ Return the ETag and the last modification date of the
+    responses built from the output of an experiment, or (None, None)
+    if the experiment has no such file.
+    The configuration of an experiment is written down once its output
+    is complete, its modification date therefore tells when the output
+    of the experiment last changed.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    @param exp_id the experiment identifier.
+    @param filename the file of the experiment whose modification date
+    is used.
+    """
+    experiment = get_sample_experiment(session_id, exp_id)
+    if experiment is not None and filename == 'exp.cfg':
+        return experiment.validators
+    try:
+        stat = os.stat(os.path.join(get_session_folder(session_id),
+                                    exp_id, filename))
+    except OSError:
+        return (None, None)
+    etag = '%s-%x-%x' % (exp_id, int(stat.st_mtime), stat.st_size)
+    return (etag, datetime.datetime.utcfromtimestamp(int(stat.st_mtime)))
+
+
+def not_modified(etag, last_modified):
+    """ Return a `304 Not Modified` response if the client already has
+    the current version of the response, None otherwise.
+
+    @param etag the ETag of the response, see
+    `get_experiment_validators`.
+    @param last_modified the last modification date of the response.
+    """
+    if etag is None or is_resource_modified(
+            request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return set_cache_headers(APP.response_class(status=304), etag,
+                             last_modified)
+
+
+def set_cache_headers(response, etag, last_modified):
+    """ Add to a response the headers letting the browsers cache it, and
+    return it. The responses are private to the users of the session,
+    they are not kept by shared caches.
+
+    @param response the response, or anything Flask can turn into a
+    response.
+    @param etag the ETag of the response, see
+    `get_experiment_validators`.
+    @param last_modified the last modification date of the response.
+    """
+    response = APP.make_response(response)
+    if etag is None:
+        return response
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.max_age = CACHE_TIMEOUT
+    return response
+
+
+def send_session_file(folder, filename, **kwargs):
+    """ Send a file of a session as `send_from_directory` does, with the
+    same cache headers as `set_cache_headers`: the file is private to the
+    users of the session, it is not kept by shared caches.
+
+    @param folder the folder of the file.
+    @param filename the name of the file.
+    @param kwargs any other argument of `send_from_directory`.
+    """
+    response = send_from_directory(folder, filename, conditional=True,
+                                   cache_timeout=CACHE_TIMEOUT, **kwargs)
+    response.cache_control.public = False
+    response.cache_control.private = True
+    return response
+
+
+def load_sample_session():
+    """ Load in memory the sample session presented on the front page,
+    so that it is served without reading its files nor extracting its
+    archive.
+    Returns None if there is no sample session or it could not be read.
+    """
+    if not SAMPLE_SESSION:
+        return None
+    folder = get_sample_folder()
+    if folder is None:
+        LOG.error('The name of the sample session cannot be used as a '
+                  'folder name: %r', SAMPLE_SESSION)
+        return None
+    if not os.path.exists(os.path.join(folder, 'input.zip')):
+        return None
+    inputzip = os.path.join(folder, 'input.zip')
+    try:
+        # The sample session may be in the static folder, its digest is
+        # only kept in memory
+        sample = SampleSession(
+            SAMPLE_SESSION, folder,
+            ARCHIVES.describe(inputzip,
+                              digest=archive_digest(inputzip, store=False)))
+        for exp_id in os.listdir(folder):
+            if not exp_id.startswith('20') or not os.path.exists(
+                    os.path.join(folder, exp_id, 'exp.cfg')):
+                continue
+            infos = read_exp_config(SAMPLE_SESSION, exp_id)
+            hidden_columns = ()
+            if infos['plugin'] == 'MapQTL plugin':
+                hidden_columns = MAPQTL_HIDDEN_COLUMNS
+            sample.add_experiment(load_experiment(
+                os.path.join(folder, exp_id), exp_id, infos,
+                get_experiment_validators(SAMPLE_SESSION, exp_id),
+                hidden_columns=hidden_columns))
+    except (IOError, OSError, UnicodeError, MQ2Exception), err:
+        LOG.error('Could not load the sample session: %s', err)
+        return None
+    LOG.info('Sample session loaded with %s experiments',
+             len(sample.experiments))
+    return sample
+
+
 
 ##  Web-app
 
 
+@APP.before_request
+def start_timer():
+    """ Record when the processing of the request started. """
+    g.start = time.time()
+
+
+@APP.after_request
+def log_request(response):
+    """ Log the request served and record how long it took.
+
+    @param response the response sent.
+    """
+    duration = time.time() - getattr(g, 'start', time.time())
+    endpoint = request.endpoint or 'unknown'
+    REQUEST_TIME.observe(duration, endpoint=endpoint, method=request.method)
+    REQUESTS.inc(endpoint=endpoint, status=response.status_code)
+    length = response.content_length
+    if length:
+        BYTES_SERVED.inc(length, endpoint=endpoint)
+    LOG.info('remote=%s method=%s url=%s endpoint=%s status=%s '
+             'duration=%.3f bytes=%s', request.remote_addr, request.method,
+             request.url, endpoint, response.status_code, duration,
+             length if length is not None else '-')
+    return response
+
+
+@APP.route('/metrics')
+def metrics():
+    """ Returns the metrics of the web-application, in the text format
+    of Prometheus.
+    """
+    return Response(METRICS.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
 @APP.route('/', methods=['GET', 'POST'])
 def index():
     """ Shows the front page.
     Fill the index.html template with the correct form to allow the user
     to upload his file and find back his session.
     """
-    print 'mq2 %s -- %s -- %s' % (datetime.datetime.now(),
-                                  request.remote_addr, request.url)
     form = UploadForm(csrf_enabled=False)
     session_form = SessionForm(csrf_enabled=False)
     if session_form.validate_on_submit()and session_form.session_id.data:
+        if not is_valid_session_id(session_form.session_id.data):
+            flash('This session does not exists')
+            return redirect(url_for('index'))
         return redirect(url_for('session',
                         session_id=session_form.session_id.data))
     if form.validate_on_submit():
         upload_file = request.files['mapqtl_input']
         if upload_file and allowed_file(upload_file):
+            digest = BLOBS.add(upload_file.stream)
             session_id = generate_session_id()
-            upload_folder = os.path.join(UPLOAD_FOLDER, session_id)
-            os.mkdir(upload_folder)
-            upload_file.save(os.path.join(upload_folder,
-                             'input.zip'))
+            upload_folder = get_session_folder(session_id)
+            os.makedirs(upload_folder)
+            BLOBS.link(digest, os.path.join(upload_folder, 'input.zip'))
+            CATALOG.add_session(session_id, archive=digest)
             return redirect(url_for('session', session_id=session_id))
         else:
+            if upload_file:
+                upload_file.stream.discard()
             flash('Wrong file type or name.')
     return render_template(
         'index.html',
         form=form,
         session_form=session_form,
-        sample_session=CONFIG.get('mq2', 'sample_session'))
+        sample_session=SAMPLE_SESSION)
+
+
+@APP.errorhandler(413)
+@APP.errorhandler(InvalidArchive)
+def invalid_upload(err):
+    """ Shows the front page with the reason why the file uploaded was
+    rejected.
+    """
+    if isinstance(err, InvalidArchive):
+        flash(str(err))
+    else:
+        flash('The file uploaded is larger than %s MB.' % (
+            MAX_UPLOAD_SIZE / (1024 * 1024)))
+    return redirect(url_for('index'))
 
 
 @APP.route('/session/<session_id>/', methods=['GET', 'POST'])
@@ -582,54 +1815,302 @@ def session(session_id):
     @param session_id the session identifier uniquely identifying the
     MapQTL zip file and the JoinMap map file.
     """
-    print 'mq2 %s -- %s -- %s' % (datetime.datetime.now(),
-                                  request.remote_addr, request.url)
-
-    if session_id == CONFIG.get('mq2', 'sample_session'):
-        global UPLOAD_FOLDER
-        UPLOAD_FOLDER = os.path.join(os.path.abspath(__file__),
-                                     APP.static_folder)
-    upload_folder = os.path.join(UPLOAD_FOLDER, session_id)
+    sample = is_sample_session(session_id)
+    # The folder of an identifier which cannot name a session is never
+    # looked up
+    if (sample or not is_valid_session_id(session_id)) \
+            and not session_exists(session_id):
+        flash('This session does not exists')
+        return redirect(url_for('index'))
+    upload_folder = get_session_folder(session_id)
 
     try:
-        plugin, folder = get_plugin_and_folder(
-            inputzip=os.path.join(upload_folder, 'input.zip'))
+        infos = describe_session(session_id)
+        plugin = get_plugin(infos['plugin'])
     except IOError:
         flash('Could not extract the zip archive.', 'errors')
         return redirect(url_for('index'))
+    except MQ2Exception, err:
+        flash(str(err), 'errors')
+        return redirect(url_for('index'))
 
     if plugin.session_name:
         form = InputFormSession(
-            sessions=sorted(plugin.get_session_identifiers(folder)),
+            sessions=infos['sessions'],
+            sessions_label=plugin.session_name)
+        sweep_form = SweepFormSession(
+            sessions=infos['sessions'],
             sessions_label=plugin.session_name)
     else:
         form = InputForm()
-    if not (session_id in os.listdir(UPLOAD_FOLDER) or
-            session_id in os.listdir(APP.static_folder)):
+        sweep_form = SweepForm()
+    if not session_exists(session_id):
         flash('This session does not exists')
         return redirect(url_for('index'))
+    touch_session(session_id)
 
-    if form.validate_on_submit():
+    if sample and request.method == 'POST':
+        flash('No experiment can be run on the sample session.')
+    elif form.validate_on_submit():
         lod_threshold = form.lod_threshold.data
         session = None
         if plugin.session_name:
             session = form.session.data
-        output = None
-        try:
-            output = mq2_run(session_id, plugin, folder,
-                             lod_threshold=lod_threshold, session=session)
-        except MQ2Exception, err:
-            form.errors['MQ2'] = err
+        if session == ALL_SESSIONS:
+            batch_id = submit_batch(session_id, lod_threshold,
+                                    infos['sessions'])
+            return redirect(url_for('batch_results', session_id=session_id,
+                                    batch_id=batch_id))
+        output = experiment_done(session_id, lod_threshold, session)
         if output:
             flash("Experiment already run in experiment: <a href='%s'>"
                   "%s</a>" % (url_for('results', session_id=session_id,
                   exp_id=output), output))
+        elif find_pending_job(session_id, lod_threshold, session):
+            flash('This experiment is already running.')
+        else:
+            job_id = '%s_s%s_t%s' % (generate_exp_id(), session,
+                                     lod_threshold)
+            try:
+                JOBS.submit(upload_folder, job_id, run_job,
+                            (session_id, job_id, lod_threshold, session),
+                            lod_threshold=lod_threshold, session=session)
+            except MQ2Exception, err:
+                form.errors['MQ2'] = err
     exp_ids = get_experiment_ids(session_id)
     return render_template('session.html', session_id=session_id,
-                           form=form, exp_ids=exp_ids,
+                           form=form, sweep_form=sweep_form,
+                           exp_ids=exp_ids,
+                           sweep_ids=[] if sample
+                           else get_sweep_ids(upload_folder),
+                           batch_ids=[] if sample
+                           else get_batch_ids(upload_folder),
+                           jobs=get_pending_jobs(session_id),
                            session=plugin.session_name)
 
 
+@APP.route('/session/<session_id>/sweep', methods=['POST'])
+def sweep(session_id):
+    """ Submit a LOD sweep: the experiments for a list of LOD thresholds
+    run in a single job.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    """
+    if not session_exists(session_id):
+        flash('This session does not exists')
+        return redirect(url_for('index'))
+    if is_sample_session(session_id):
+        flash('No experiment can be run on the sample session.')
+        return redirect(url_for('session', session_id=session_id))
+    upload_folder = get_session_folder(session_id)
+
+    try:
+        infos = describe_session(session_id)
+        plugin = get_plugin(infos['plugin'])
+    except IOError:
+        flash('Could not extract the zip archive.', 'errors')
+        return redirect(url_for('index'))
+    except MQ2Exception, err:
+        flash(str(err), 'errors')
+        return redirect(url_for('index'))
+
+    if plugin.session_name:
+        form = SweepFormSession(
+            sessions=infos['sessions'],
+            sessions_label=plugin.session_name)
+    else:
+        form = SweepForm()
+
+    if form.validate_on_submit():
+        lod_thresholds = parse_thresholds(form.lod_thresholds.data)
+        session = None
+        if plugin.session_name:
+            session = form.session.data
+        sweep_id = '%s_s%s_sweep' % (generate_exp_id(), session)
+        try:
+            JOBS.submit(upload_folder, sweep_id, run_sweep,
+                        (session_id, sweep_id, lod_thresholds, session),
+                        lod_thresholds=', '.join(
+                            '%g' % lod for lod in lod_thresholds),
+                        session=session)
+        except MQ2Exception, err:
+            flash(str(err))
+    else:
+        for field in form.errors:
+            flash('%s: %s' % (field, ' '.join(form.errors[field])))
+    return redirect(url_for('session', session_id=session_id))
+
+
+@APP.route('/session/<session_id>/sweep/<sweep_id>/')
+def sweep_results(session_id, sweep_id):
+    """ Shows the hotspots found for each LOD threshold of a sweep.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    @param sweep_id the identifier of the sweep.
+    """
+    if not session_exists(session_id):
+        flash('This session does not exists')
+        return redirect(url_for('index'))
+    upload_folder = get_session_folder(session_id)
+    if not os.path.exists(get_sweep_file(upload_folder, sweep_id)):
+        flash('This sweep does not exists')
+        return redirect(url_for('session', session_id=session_id))
+    touch_session(session_id)
+    return render_template('sweep.html', session_id=session_id,
+                           sweep_id=sweep_id, headers=SWEEP_HEADERS,
+                           rows=read_sweep_table(upload_folder, sweep_id))
+
+
+@APP.route('/session/<session_id>/sweep/<sweep_id>.csv')
+def sweep_table(session_id, sweep_id):
+    """ Returns the table of the hotspots found for each LOD threshold
+    of a sweep, as CSV.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    @param sweep_id the identifier of the sweep.
+    """
+    if not session_exists(session_id):
+        flash('This session does not exists')
+        return redirect(url_for('index'))
+    upload_folder = get_session_folder(session_id)
+    if sweep_id.startswith('.') \
+            or not os.path.exists(get_sweep_file(upload_folder, sweep_id)):
+        flash('This sweep does not exists')
+        return redirect(url_for('session', session_id=session_id))
+    return send_session_file(
+        upload_folder,
+        os.path.basename(get_sweep_file(upload_folder, sweep_id)),
+        mimetype='text/csv')
+
+
+@APP.route('/session/<session_id>/batch/<batch_id>/')
+def batch_results(session_id, batch_id):
+    """ Shows the experiments of a batch, run for all the MapQTL
+    sessions of the archive, and the hotspots they found.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    @param batch_id the identifier of the batch.
+    """
+    if not session_exists(session_id):
+        flash('This session does not exists')
+        return redirect(url_for('index'))
+    upload_folder = get_session_folder(session_id)
+    if not os.path.exists(get_batch_file(upload_folder, batch_id)):
+        flash('This batch does not exists')
+        return redirect(url_for('session', session_id=session_id))
+    touch_session(session_id)
+    rows, pending = read_batch_summary(session_id, batch_id)
+    return render_template('batch.html', session_id=session_id,
+                           batch_id=batch_id,
+                           lod_threshold=batch_id[:-len('_batch')].rsplit(
+                               '_t', 1)[-1],
+                           headers=BATCH_SUMMARY_HEADERS, rows=rows,
+                           pending=pending)
+
+
+@APP.route('/session/<session_id>/job/<job_id>')
+def job_status(session_id, job_id):
+    """ Returns the status of a job as JSON.
+    The status is one of `queued`, `running`, `done` or `failed`, once
+    done the url of the result page of the experiment, or of the sweep,
+    is provided.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    @param job_id the identifier of the job.
+    """
+    infos = find_job(session_id, job_id)
+    if infos is None:
+        output = jsonify(error='This job does not exists')
+        output.status_code = 404
+        return output
+    return jsonify(describe_job(session_id, infos))
+
+
+@APP.route('/session/<session_id>/job/<job_id>/cancel', methods=['POST'])
+def cancel_job(session_id, job_id):
+    """ Cancels a job still queued or running and returns its status as
+    JSON. A job running is stopped at the next check of its limits, a
+    job queued is stopped when it starts.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    @param job_id the identifier of the job.
+    """
+    infos = find_job(session_id, job_id)
+    if infos is None:
+        output = jsonify(error='This job does not exists')
+        output.status_code = 404
+        return output
+    upload_folder = get_session_folder(session_id)
+    if infos['status'] not in (QUEUED, RUNNING):
+        output = jsonify(error='This job is already finished')
+        output.status_code = 409
+        return output
+    request_cancel(upload_folder, job_id)
+    if infos['status'] == QUEUED:
+        write_job_status(upload_folder, job_id, FAILED, error=CANCELLED)
+        infos = read_job_status(upload_folder, job_id)
+    LOG.info('Job %s of session %s cancelled', job_id, session_id)
+    return jsonify(describe_job(session_id, infos))
+
+
+@APP.route('/session/<session_id>/job/<job_id>/events')
+def job_events(session_id, job_id):
+    """ Streams the progress of a job as Server-Sent Events.
+    A `progress` event is sent for each stage the job goes through and a
+    last `status` event, as returned by `job_status`, once it is done or
+    failed. The stream is closed after `events_timeout` seconds, the
+    browser then reconnects and the stream resumes after the last event
+    it received.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    @param job_id the identifier of the job.
+    """
+    if find_job(session_id, job_id) is None:
+        output = jsonify(error='This job does not exists')
+        output.status_code = 404
+        return output
+    upload_folder = get_session_folder(session_id)
+    try:
+        offset = int(request.headers.get('Last-Event-ID', 0))
+    except ValueError:
+        offset = 0
+
+    def stream(offset):
+        """ Yield the events of the job as they are recorded. """
+        end = time.time() + EVENTS_TIMEOUT
+        yield 'retry: %s\n\n' % (EVENTS_INTERVAL * 1000)
+        while True:
+            # The status is read first so that no event recorded before
+            # the job finished is missed
+            infos = read_job_status(upload_folder, job_id)
+            for offset, event in read_progress(upload_folder, job_id,
+                                               offset):
+                yield 'id: %s\nevent: progress\ndata: %s\n\n' % (
+                    offset, json.dumps(event))
+            if infos is None or infos['status'] in (DONE, FAILED):
+                yield 'id: %s\nevent: status\ndata: %s\n\n' % (
+                    offset, json.dumps(describe_job(session_id, infos)
+                                       if infos else {'status': FAILED}))
+                return
+            if time.time() >= end:
+                return
+            time.sleep(EVENTS_INTERVAL)
+
+    output = Response(stream_with_context(stream(offset)),
+                      mimetype='text/event-stream')
+    output.headers['Cache-Control'] = 'no-cache'
+    # Do not let a proxy buffer the stream
+    output.headers['X-Accel-Buffering'] = 'no'
+    return output
+
+
 @APP.route('/session/<session_id>/<exp_id>/')
 def results(session_id, exp_id):
     """ Show the result page of an experiment.
@@ -642,78 +2123,75 @@ def results(session_id, exp_id):
     @param exp_id the experiment identifier used to uniquely identify a
     run which may have specific parameters.
     """
-    print 'mq2 %s -- %s -- %s' % (datetime.datetime.now(),
-                                  request.remote_addr, request.url)
-    if not session_id in os.listdir(UPLOAD_FOLDER):
+    if not session_exists(session_id):
         flash('This session does not exists')
         return redirect(url_for('index'))
-    folder = os.path.join(UPLOAD_FOLDER, session_id)
-    if not exp_id in os.listdir(folder):
+    folder = get_session_folder(session_id)
+    if not experiment_exists(session_id, exp_id):
         flash('This experiment does not exists')
         return redirect(url_for('session', session_id=session_id))
+    touch_session(session_id, exp_id)
+    validators = get_experiment_validators(session_id, exp_id)
+    output = not_modified(*validators)
+    if output is not None:
+        return output
     infos = retrieve_exp_info(session_id, exp_id)
-    (qtls_evo, mk_list, qtls_lg, lg_index) = retrieve_qtl_infos(
-        session_id, exp_id)
-
-    cnt = 0
-    cnt_lg = 0
-    data_qtls = []
-    max_lod = 0
-    for entry in qtls_evo:
-        if cnt in lg_index:
-            data_qtls.append([qtls_lg[cnt_lg], 0])
-            cnt_lg += 1
-        data_qtls.append([mk_list[cnt], float(entry)])
-        if float(entry) > max_lod:
-            max_lod = float(entry)
-        cnt += 1
-
-    cnt = 0
-    cnt_lg = 0
-    data_lg = []
-    for mk in mk_list:
-        if cnt in lg_index:
-            data_lg.append([qtls_lg[cnt_lg], max_lod + 2])
-            cnt_lg += 1
-        cnt += 1
-
-    data = [
-        {"label": "QTLs found",
-         "color": "#1F77B4",
-         "data": data_qtls,
-         "bars": {"show": 1,
-                  "barWidth": 0.8,
-                  "order": 1,
-                  },
-         },
-        {"label": "Chr",
-         "color": "#CDCDCD",
-         "data": data_lg,
-         "bars": {"show": 1,
-                  "barWidth": 0.4,
-                  "order": 2,
-                  },
-         },
-    ]
 
     date = '%s-%s-%s at %s:%s:%s' % (
         exp_id[:4], exp_id[4:6], exp_id[6:8],
         exp_id[8:10], exp_id[10:12], exp_id[12:14]
     )
-    files = os.listdir(os.path.join(folder, exp_id))
+    experiment = get_sample_experiment(session_id, exp_id)
+    if experiment is not None:
+        files = experiment.files
+    else:
+        files = os.listdir(os.path.join(folder, exp_id))
     #files.remove(u'exp.cfg')
 
-    return render_template(
+    return set_cache_headers(render_template(
         'results.html',
         session_id=session_id,
         exp_id=exp_id,
         infos=infos,
         date=date,
-        data=data,
-        qtls_lg=qtls_lg,
-        lg_index=lg_index,
-        max_lod=max_lod,
-        files=files)
+        files=files), *validators)
+
+
+@APP.route('/session/<session_id>/<exp_id>/plot.json')
+def plot_data(session_id, exp_id):
+    """ Returns the data plotted on the result page of an experiment.
+    This data is computed once, when the experiment is run, and does not
+    change afterward.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    @param exp_id the experiment identifier used to uniquely identify a
+    run which may have specific parameters.
+    """
+    if not session_exists(session_id) \
+            or not experiment_exists(session_id, exp_id):
+        output = jsonify(error='This experiment does not exists')
+        output.status_code = 404
+        return output
+    experiment = get_sample_experiment(session_id, exp_id)
+    if experiment is not None:
+        output = not_modified(*experiment.validators)
+        if output is not None:
+            return output
+        return set_cache_headers(
+            Response(experiment.plot, mimetype='application/json'),
+            *experiment.validators)
+    folder = os.path.join(get_session_folder(session_id), exp_id)
+    try:
+        payload_file = get_plot_payload_file(folder)
+    except IOError:
+        LOG.warning('No output in folder %s', folder)
+        output = jsonify(error='No output for this experiment')
+        output.status_code = 404
+        return output
+    return send_session_file(os.path.dirname(payload_file),
+                             os.path.basename(payload_file),
+                             mimetype='application/json')
 
 
 @APP.route('/session/<session_id>/<exp_id>/marker/<marker_id>')
@@ -729,27 +2207,24 @@ def marker_detail(session_id, exp_id, marker_id):
     run which may have specific parameters.
     @param marker_id the name of the marker to zoom on.
     """
-    print 'mq2 %s -- %s -- %s' % (datetime.datetime.now(),
-                                  request.remote_addr, request.url)
-    if session_id == CONFIG.get('mq2', 'sample_session'):
-        global UPLOAD_FOLDER
-        UPLOAD_FOLDER = os.path.join(os.path.abspath(__file__),
-                                     APP.static_folder)
-    if not session_id in os.listdir(UPLOAD_FOLDER):
+    if not session_exists(session_id):
         flash('This session does not exists')
         return redirect(url_for('index'))
-    folder = os.path.join(UPLOAD_FOLDER, session_id)
-    if not exp_id in os.listdir(folder):
+    if not experiment_exists(session_id, exp_id):
         flash('This experiment does not exists')
         return redirect(url_for('session', session_id=session_id))
+    validators = get_experiment_validators(session_id, exp_id)
+    output = not_modified(*validators)
+    if output is not None:
+        return output
     (headers, qtls) = retrieve_marker_info(session_id, exp_id, marker_id)
-    return render_template(
+    return set_cache_headers(render_template(
         'markers.html',
         session_id=session_id,
         exp_id=exp_id,
         marker_id=marker_id,
         headers=headers,
-        qtls=qtls)
+        qtls=qtls), *validators)
 
 
 @APP.route('/retrieve/<session_id>/<exp_id>/<filename>')
@@ -764,36 +2239,273 @@ def retrieve(session_id, exp_id, filename):
     run which may have specific parameters.
     @param filename the name of the file to retrieve within this session.
     """
-    print 'mq2 %s -- %s -- %s' % (datetime.datetime.now(),
-                                  request.remote_addr, request.url)
-    if session_id == CONFIG.get('mq2', 'sample_session'):
-        global UPLOAD_FOLDER
-        UPLOAD_FOLDER = os.path.join(os.path.abspath(__file__),
-                                     APP.static_folder)
-    upload_folder = os.path.join(UPLOAD_FOLDER, session_id, exp_id)
+    if not session_exists(session_id):
+        flash('This session does not exists')
+        return redirect(url_for('index'))
+    if not experiment_exists(session_id, exp_id):
+        flash('This experiment does not exists')
+        return redirect(url_for('session', session_id=session_id))
+    upload_folder = os.path.join(get_session_folder(session_id), exp_id)
     if filename != '%s.zip' % exp_id:
-        return send_from_directory(upload_folder, filename)
+        return send_session_file(upload_folder, filename)
     else:
         if os.path.exists(os.path.join(upload_folder, '%s.zip' % exp_id)):
-            return send_from_directory(upload_folder, '%s.zip' % exp_id)
-        zf = zipfile.ZipFile(os.path.join(upload_folder, '%s.zip' % exp_id),
-                             mode='w')
-        try:
-            for filename in os.listdir(upload_folder):
-                if not filename.endswith('.zip'):
-                    zf.write(os.path.join(upload_folder, filename),
-                             arcname=os.path.join(exp_id, filename),
-                             compress_type=ZCOMPRESSION)
-        except IOError, err:
-            print 'ERROR while generating the zip file: %s' % err
-        finally:
-            zf.close()
-        return send_from_directory(upload_folder, '%s.zip' % exp_id)
+            return send_session_file(upload_folder, '%s.zip' % exp_id)
+        # The archive is not built (yet), stream it while generating it
+        if not os.path.isdir(upload_folder):
+            flash('This experiment does not exists')
+            return redirect(url_for('index'))
+        return Response(
+            stream_zip(upload_folder, exp_id),
+            mimetype='application/zip',
+            headers={'Content-Disposition':
+                     'attachment; filename=%s.zip' % exp_id})
 
 
-if __name__ == '__main__':
-    import logging
-    LOG = logging.getLogger('MQ2')
-    LOG.setLevel(logging.DEBUG)
+## JSON API
+
+
+def api_error(message, status_code=404):
+    """ Return an error of the API as JSON.
+
+    @param message the message explaining the error.
+    @param status_code the HTTP status code of the response.
+    """
+    output = jsonify(error=message)
+    output.status_code = status_code
+    return output
+
+
+def api_page(items, fields=None):
+    """ Return as JSON the page of a list requested using the `offset`
+    and `limit` arguments, with the total number of items.
+    The `fields` argument restricts the keys returned for each item.
+
+    @param items the list of items of which to return a page, either
+        dictionaries or functions returning a dictionary.
+    @param fields the keys that can be selected, all by default.
+    """
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = int(request.args.get('limit', API_PAGE_SIZE))
+    except ValueError:
+        return api_error('offset and limit should be integers', 400)
+    if offset < 0 or limit < 0 or limit > API_MAX_PAGE_SIZE:
+        return api_error('offset should be positive and limit between 0 '
+                         'and %s' % API_MAX_PAGE_SIZE, 400)
+    selected = get_api_fields(fields)
+    page = []
+    for item in items[offset:offset + limit]:
+        if callable(item):
+            item = item()
+        if selected:
+            item = dict((key, item[key]) for key in selected if key in item)
+        page.append(item)
+    return jsonify(total=len(items), offset=offset, limit=limit,
+                   items=page)
+
+
+def get_api_fields(fields=None):
+    """ Return the list of keys requested using the `fields` argument,
+    None if all keys are requested.
+
+    @param fields the keys that can be selected, all by default.
+    """
+    if not request.args.get('fields'):
+        return None
+    selected = [field.strip()
+                for field in request.args.get('fields').split(',')
+                if field.strip()]
+    if fields is not None:
+        selected = [field for field in selected if field in fields]
+    return selected
+
+
+def api_experiment_exists(session_id, exp_id):
+    """ Return whether the session and its experiment exist.
+
+    @param session_id the session identifier.
+    @param exp_id the experiment identifier.
+    """
+    return session_exists(session_id) \
+        and exp_id in get_experiment_ids(session_id) \
+        and os.path.isdir(os.path.join(get_session_folder(session_id),
+                                       exp_id))
+
+
+@APP.route('/api/v1/sessions/<session_id>')
+def api_session(session_id):
+    """ Returns the information about a session as JSON: the plugin
+    able to process its archive, its MapQTL sessions/Excel sheets, the
+    number of experiments and the jobs still running.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    """
+    if not session_exists(session_id):
+        return api_error('This session does not exists')
+    try:
+        infos = describe_session(session_id)
+    except (IOError, MQ2Exception), err:
+        return api_error('Could not extract the zip archive: %s' % err,
+                         500)
+    touch_session(session_id)
+    return jsonify(session_id=session_id,
+                   plugin=infos['plugin'],
+                   sessions=infos['sessions'],
+                   experiments=len(get_experiment_ids(session_id)),
+                   jobs=get_pending_jobs(session_id))
+
+
+@APP.route('/api/v1/sessions/<session_id>/experiments')
+def api_experiments(session_id):
+    """ Returns as JSON the parameters of the experiments of a session,
+    see `retrieve_exp_info`.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    """
+    if not session_exists(session_id):
+        return api_error('This session does not exists')
+    touch_session(session_id)
+    return api_page([
+        lambda exp_id=exp_id: retrieve_exp_info(session_id, exp_id)
+        for exp_id in sorted(get_experiment_ids(session_id))])
+
+
+@APP.route('/api/v1/sessions/<session_id>/experiments/<exp_id>')
+def api_experiment(session_id, exp_id):
+    """ Returns as JSON the parameters of an experiment, see
+    `retrieve_exp_info`.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    @param exp_id the experiment identifier.
+    """
+    if not api_experiment_exists(session_id, exp_id):
+        return api_error('This experiment does not exists')
+    touch_session(session_id, exp_id)
+    validators = get_experiment_validators(session_id, exp_id)
+    output = not_modified(*validators)
+    if output is not None:
+        return output
+    infos = retrieve_exp_info(session_id, exp_id)
+    fields = get_api_fields()
+    if fields:
+        infos = dict((key, infos[key]) for key in fields if key in infos)
+    return set_cache_headers(jsonify(infos), *validators)
+
+
+@APP.route('/api/v1/sessions/<session_id>/experiments/<exp_id>/hotspots')
+def api_hotspots(session_id, exp_id):
+    """ Returns as JSON the number of QTLs found on each marker of the
+    map, the information plotted on the result page.
+    The markers can be restricted to some linkage groups (`lg`
+    argument, separated by commas), to a range of positions on these
+    groups (`start` and `end` arguments, in cM) and to those with a
+    minimum number of QTLs (`min_qtls` argument).
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    @param exp_id the experiment identifier.
+    """
+    if not api_experiment_exists(session_id, exp_id):
+        return api_error('This experiment does not exists')
+    groups = None
+    if request.args.get('lg'):
+        groups = [group.strip() for group in request.args['lg'].split(',')]
+    try:
+        start = request.args.get('start')
+        if start is not None:
+            start = float(start)
+        end = request.args.get('end')
+        if end is not None:
+            end = float(end)
+        min_qtls = int(request.args.get('min_qtls', 0))
+    except ValueError:
+        return api_error('start and end should be numbers and min_qtls '
+                         'an integer', 400)
+    touch_session(session_id, exp_id)
+    validators = get_experiment_validators(session_id, exp_id)
+    output = not_modified(*validators)
+    if output is not None:
+        return output
+    try:
+        hotspots = read_hotspots(
+            os.path.join(get_session_folder(session_id), exp_id),
+            groups=groups, start=start, end=end, min_qtls=min_qtls)
+    except (IOError, OSError):
+        return api_error('No output for this experiment')
+    output = api_page(
+        [{'marker': marker, 'lg': group, 'position': position,
+          'qtls': cnt} for (marker, group, position, cnt) in hotspots],
+        fields=('marker', 'lg', 'position', 'qtls'))
+    if output.status_code != 200:
+        return output
+    return set_cache_headers(output, *validators)
+
+
+@APP.route('/api/v1/sessions/<session_id>/experiments/<exp_id>/markers/'
+           '<marker_id>')
+def api_marker(session_id, exp_id, marker_id):
+    """ Returns as JSON the QTLs whose closest marker is the specified
+    marker, see `retrieve_marker_info`. Each QTL is given as a
+    dictionary whose keys are the columns of ``qtls_with_mk.csv``.
+
+    @param session_id the session identifier uniquely identifying the
+    MapQTL zip file and the JoinMap map file.
+    @param exp_id the experiment identifier.
+    @param marker_id the name of the marker.
+    """
+    if not api_experiment_exists(session_id, exp_id):
+        return api_error('This experiment does not exists')
+    touch_session(session_id, exp_id)
+    validators = get_experiment_validators(session_id, exp_id)
+    output = not_modified(*validators)
+    if output is not None:
+        return output
+    headers, qtls = retrieve_marker_info(session_id, exp_id, marker_id)
+    output = api_page([dict(zip(headers, row)) for row in qtls],
+                      fields=headers)
+    if output.status_code != 200:
+        return output
+    return set_cache_headers(output, *validators)
+
+
+def parse_arguments():
+    """ Parse the command line arguments.
+    """
+    usage = "usage: %prog [options]"
+    parser = OptionParser(usage)
+    parser.add_option('--recover', action="store_true", dest="recover",
+                  default=False, help="Only remove the experiments left "
+                  "unfinished and run again the jobs not finished, then "
+                  "exit")
+    return parser.parse_args()
+
+
+def main():
+    """ Main function.
+    Run the web-application, checking in the background for what its
+    previous run left unfinished, or only recover the experiments left
+    unfinished with ``--recover``.
+    """
+    options = parse_arguments()[0]
+    logging.getLogger('MQ2').setLevel(logging.DEBUG)
+    if options.recover:
+        removed, resubmitted = recover_experiments()
+        JOBS.close()
+        print '%s unfinished experiments removed, %s jobs run again' % (
+            removed, resubmitted)
+        return
+    if RECOVER_ON_STARTUP:
+        recovery = threading.Thread(target=recover_experiments,
+                                    name='recover_experiments')
+        recovery.daemon = True
+        recovery.start()
     APP.debug = True
     APP.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -26,13 +26,45 @@
 Unit-test for the MQ2_Web.
 """
 
+import json
 import os
+import pstats
+import random
 import re
+import resource
 import shutil
 import tempfile
+import threading
+import time
 import unittest
+import zipfile
+from StringIO import StringIO
 
-from mq2_web import APP, CONFIG
+from werkzeug.test import Client
+from werkzeug.wrappers import BaseResponse
+
+import mq2_jobs
+import mq2_web
+from mq2_web import (APP, CONFIG, experiment_done, get_mapqtl_session,
+                     get_session_folder)
+from MQ2 import MQ2Exception
+from mq2_archive import (ArchiveCache, ArchiveTooLarge, BlobStore,
+                         InvalidArchive, describe_archive)
+from mq2_jobs import (write_job_status, read_progress, run_sandboxed,
+                      get_job_ids, JobAborted, JobCancelled, JobProgress,
+                      JobQueue)
+from mq2_store import open_store
+from mq2_metrics import Registry
+from mq2_profile import ProfilingMiddleware
+from benchmark import (generate_mapqtl, generate_csv, get_peak_rss,
+                       run_benchmark)
+from loadtest import InProcessClient, LoadTest
+from clean_uploads import (scan_sessions, select_sessions,
+                           remove_sessions)
+from mq2_catalog import Catalog
+from mq2_layout import (get_sharded_folder, list_sessions,
+                        resolve_session_folder)
+from migrate_uploads import list_legacy_sessions, migrate
 
 TEST_INPUT = os.path.join(os.path.dirname(
     os.path.abspath(__file__)), 'static/Demoset_mapqtl.zip')
@@ -44,6 +76,57 @@ class MQ2_WebTestCase(unittest.TestCase):
         APP.config['TESTING'] = True
         APP.config['CSRF_ENABLED'] = False
         self.app = APP.test_client()
+        # Each test has its own upload folder, catalog, blob store and
+        # archive cache, the workers are started once they are set
+        self.upload_folder = tempfile.mkdtemp()
+        self.saved = dict((name, getattr(mq2_web, name)) for name in (
+            'UPLOAD_FOLDER', 'CATALOG', 'BLOBS', 'ARCHIVES', 'JOBS'))
+        mq2_web.UPLOAD_FOLDER = self.upload_folder
+        mq2_web.CATALOG = Catalog(
+            os.path.join(self.upload_folder, 'catalog.sqlite'))
+        mq2_web.BLOBS = BlobStore(os.path.join(self.upload_folder, '.blobs'))
+        mq2_web.ARCHIVES = ArchiveCache(
+            os.path.join(self.upload_folder, '.cache'),
+            self.saved['ARCHIVES'].max_size)
+        mq2_web.JOBS = JobQueue(workers=self.saved['JOBS'].workers)
+        mq2_web._LAST_TOUCHES.clear()
+
+    def tearDown(self):
+        mq2_web.JOBS.close()
+        for name, value in self.saved.items():
+            setattr(mq2_web, name, value)
+        mq2_web._LAST_TOUCHES.clear()
+        shutil.rmtree(self.upload_folder)
+
+    def wait_for_jobs(self, data, timeout=60):
+        """ Wait for all the jobs listed in the given page to be
+        finished and return their last status. """
+        motif = re.compile('data-url="(/session/.*/job/.*)"')
+        return self.wait_for_urls(motif.findall(data), timeout=timeout)
+
+    def wait_for_new_jobs(self, session_id, job_ids, timeout=60):
+        """ Wait for the jobs of a session submitted after the given ones
+        to be finished and return their last status, whether or not
+        they were finished before the page submitting them was shown. """
+        folder = get_session_folder(session_id)
+        return self.wait_for_urls(
+            ['/session/%s/job/%s' % (session_id, job_id)
+             for job_id in sorted(get_job_ids(folder))
+             if job_id not in job_ids], timeout=timeout)
+
+    def wait_for_urls(self, urls, timeout=60):
+        """ Wait for the jobs whose status is at the given urls to be
+        finished and return their last status. """
+        output = []
+        for url in urls:
+            start = time.time()
+            status = json.loads(self.app.get(url).data)
+            while status['status'] in ('queued', 'running') \
+                    and time.time() - start < timeout:
+                time.sleep(0.1)
+                status = json.loads(self.app.get(url).data)
+            output.append(status)
+        return output
 
     def test_index_displays(self):
         """Checks that the index page displays correctly. """
@@ -61,6 +144,15 @@ class MQ2_WebTestCase(unittest.TestCase):
         self.assertTrue('<li>Could not extract the zip archive.</li>'
             in post.data)
 
+        # The identifiers which cannot name a session folder are rejected
+        for session_id in ('.hidden', 'a..b'):
+            output = self.app.get('/session/%s/' % session_id)
+            self.assertEqual(output.status_code, 302)
+            post = self.app.post('/', data=dict(session_id=session_id),
+                                 follow_redirects=True)
+            self.assertEqual(post.status_code, 200)
+            self.assertTrue('This session does not exists' in post.data)
+
     def test_sample_session(self):
         """Checks that the form works for an existing session. """
         session_id = CONFIG.get('mq2', 'sample_session')
@@ -75,6 +167,88 @@ class MQ2_WebTestCase(unittest.TestCase):
             self.assertTrue('<p> Session identifier: <span style="color:red">'
                 in post.data)
 
+    def test_sample_session_store(self):
+        """Checks that the sample session is served from memory. """
+        stream = open(TEST_INPUT)
+        post = self.app.post('/', data=dict(
+                mapqtl_input=stream),
+                follow_redirects=True)
+        stream.close()
+        motif = re.compile('\n(.*)</span>\n\s+</p>\n')
+        session_id = motif.search(post.data).group(1).strip()
+        post = self.app.post('/session/%s/' % session_id,
+                data=dict(lod_threshold=3, session=2),
+                follow_redirects=True)
+        exp_id = str(self.wait_for_jobs(post.data)[0]['exp_id'])
+
+        upload_folder = mq2_web.UPLOAD_FOLDER
+        sample_id = 'test_sample_%s' % os.getpid()
+        sample_folder = os.path.join(APP.static_folder, sample_id)
+        shutil.copytree(get_session_folder(session_id),
+                        sample_folder)
+        shutil.rmtree(get_session_folder(session_id))
+        sample_session = (mq2_web.SAMPLE_SESSION, mq2_web.SAMPLE,
+                          mq2_web._SAMPLE_LOADED)
+        payload_file = os.path.join(sample_folder, exp_id, '.index',
+                                    'plot.json')
+        os.remove(payload_file)
+        digest_file = os.path.join(sample_folder, 'input.zip.sha256')
+        if os.path.exists(digest_file):
+            os.remove(digest_file)
+        try:
+            mq2_web.SAMPLE_SESSION = sample_id
+            mq2_web.SAMPLE, mq2_web._SAMPLE_LOADED = None, False
+            # The sample session is loaded on first use, without writing
+            # in its folder
+            self.assertEqual(mq2_web.get_sample().get_experiment_ids(),
+                             [exp_id])
+            self.assertFalse(os.path.exists(payload_file))
+            self.assertFalse(os.path.exists(digest_file))
+
+            # Once loaded, the sample session is not read from the disk
+            shutil.rmtree(os.path.join(sample_folder, exp_id, '.index'))
+            os.remove(os.path.join(sample_folder, exp_id,
+                                   'qtls_with_mk.csv'))
+            output = self.app.get('/session/%s/' % sample_id)
+            self.assertEqual(output.status_code, 200)
+            self.assertTrue(exp_id in output.data)
+            output = self.app.get('/session/%s/%s/' % (sample_id, exp_id))
+            self.assertEqual(output.status_code, 200)
+            self.assertTrue('map.csv</a> -- The genetic map extracted'
+                in output.data)
+            plot = self.app.get('/session/%s/%s/plot.json' % (sample_id,
+                    exp_id))
+            self.assertEqual(plot.status_code, 200)
+            self.assertEqual(json.loads(plot.data)['max_lod'], 2)
+            output = self.app.get(
+                '/session/%s/%s/plot.json' % (sample_id, exp_id),
+                headers={'If-None-Match': plot.headers['ETag']})
+            self.assertEqual(output.status_code, 304)
+            output = self.app.get('/session/%s/%s/marker/E36M48-330' % (
+                    sample_id, exp_id))
+            self.assertTrue('2 QTLs found' in output.data)
+            self.assertFalse('mu_A' in output.data)
+            output = self.app.get('/retrieve/%s/%s/qtls.csv' % (
+                    sample_id, exp_id))
+            self.assertEqual(output.status_code, 200)
+
+            # No experiment can be run on it and it is not in the catalog
+            files = sorted(os.listdir(sample_folder))
+            output = self.app.post('/session/%s/' % sample_id,
+                    data=dict(lod_threshold=4, session=2),
+                    follow_redirects=True)
+            self.assertTrue('<li>No experiment can be run on the sample '
+                'session.</li>' in output.data)
+            self.assertEqual(sorted(os.listdir(sample_folder)), files)
+            self.assertEqual(mq2_web.get_experiment_ids(sample_id),
+                             [exp_id])
+            self.assertFalse(mq2_web.CATALOG.has_session(sample_id))
+            self.assertEqual(mq2_web.UPLOAD_FOLDER, upload_folder)
+        finally:
+            (mq2_web.SAMPLE_SESSION, mq2_web.SAMPLE,
+             mq2_web._SAMPLE_LOADED) = sample_session
+            shutil.rmtree(sample_folder)
+
     def test_sample_data(self):
         """Checks that the form works to upload the demo dataset. """
         stream = open(TEST_INPUT)
@@ -97,8 +271,7 @@ class MQ2_WebTestCase(unittest.TestCase):
             in post.data)
         self.assertTrue('%s</span></p>\n' % session_id)
 
-        upload_folder = CONFIG.get('mq2', 'upload_folder')
-        shutil.rmtree(os.path.join(upload_folder, session_id))
+        shutil.rmtree(get_session_folder(session_id))
 
     def test_experiment(self):
         """Checks that the form works for an experiment. """
@@ -121,6 +294,11 @@ class MQ2_WebTestCase(unittest.TestCase):
                 data=dict(lod_threshold=3, session=2),
                 follow_redirects=True)
         self.assertTrue(post2.status_code, 200)
+        jobs = self.wait_for_jobs(post2.data)
+        self.assertEqual([job['status'] for job in jobs], ['done'])
+        self.assertEqual(jobs[0]['url'], '/session/%s/%s/' % (
+            session_id, jobs[0]['exp_id']))
+        post2 = self.app.get('/session/%s/' % session_id)
 
         motif = re.compile('<li><a href="/session/.*>(.*)</a>')
         output = motif.search(post2.data)
@@ -140,6 +318,17 @@ class MQ2_WebTestCase(unittest.TestCase):
         self.assertTrue('map_with_qtls.csv</a> -- Representation'
             in post3.data)
 
+        plot = self.app.get('/session/%s/%s/plot.json' % (session_id,
+                exp_id))
+        self.assertEqual(plot.status_code, 200)
+        plot = json.loads(plot.data)
+        self.assertEqual(plot['max_lod'], 2)
+        self.assertEqual(plot['qtls_lg'][:2], ['P01', 'P02'])
+        self.assertEqual(plot['data'][0]['data'][:2],
+            [['P01', 0], ['E35M48-281', 0]])
+        self.assertEqual(len(plot['data'][1]['data']),
+            len(plot['lg_index']))
+
         post4 = self.app.post('/session/%s/' % session_id,
                 data=dict(lod_threshold=3, session=2),
                 follow_redirects=True)
@@ -157,9 +346,954 @@ class MQ2_WebTestCase(unittest.TestCase):
         self.assertTrue('A_trait07' in post5.data)
         self.assertTrue('A_trait11' in post5.data)
 
-        upload_folder = CONFIG.get('mq2', 'upload_folder')
+        # The results do not change, the clients may keep them
+        self.assertTrue('max-age' in post5.headers['Cache-Control'])
+        self.assertTrue('private' in post5.headers['Cache-Control'])
+        # Reading them again is not written down in the catalog
+        last_access = mq2_web.CATALOG.get_last_accesses()[session_id]
+        self.app.get('/session/%s/%s/marker/E36M48-330' % (session_id,
+                                                           exp_id))
+        self.assertEqual(mq2_web.CATALOG.get_last_accesses()[session_id],
+                         last_access)
+        for url in ('/session/%s/%s/marker/E36M48-330',
+                    '/session/%s/%s/plot.json',
+                    '/api/v1/sessions/%s/experiments/%s/hotspots',
+                    '/retrieve/%s/%s/qtls.csv'):
+            url = url % (session_id, exp_id)
+            output = self.app.get(url)
+            self.assertEqual(output.status_code, 200)
+            self.assertTrue('private' in output.headers['Cache-Control'])
+            self.assertFalse('public' in output.headers['Cache-Control'])
+            output = self.app.get(url, headers={
+                'If-None-Match': output.headers['ETag']})
+            self.assertEqual(output.status_code, 304)
+            self.assertEqual(output.data, '')
+
+        # The zip archive is built once the experiment is finished
+        exp_folder = os.path.join(get_session_folder(session_id), exp_id)
+        url = '/retrieve/%s/%s/%s.zip' % (session_id, exp_id, exp_id)
+        output = self.app.get(url)
+        self.assertEqual(output.status_code, 200)
+        archive = zipfile.ZipFile(StringIO(output.data))
+        names = sorted(archive.namelist())
+        self.assertTrue('%s/qtls_matrix.csv' % exp_id in names)
+        self.assertFalse([name for name in names if '.index' in name])
+
+        # Without it, the archive is generated on the fly
+        os.unlink(os.path.join(exp_folder, '%s.zip' % exp_id))
+        output = self.app.get(url)
+        self.assertEqual(output.status_code, 200)
+        archive = zipfile.ZipFile(StringIO(output.data))
+        self.assertEqual(archive.testzip(), None)
+        self.assertEqual(sorted(archive.namelist()), names)
+        stream = open(os.path.join(exp_folder, 'qtls_matrix.csv'))
+        self.assertEqual(
+            archive.read('%s/qtls_matrix.csv' % exp_id), stream.read())
+        stream.close()
+        self.assertFalse(os.path.exists(
+            os.path.join(exp_folder, '%s.zip' % exp_id)))
+
+        shutil.rmtree(get_session_folder(session_id))
+
+    def test_archive_cache(self):
+        """Checks that the archives are only extracted once. """
+        stream = open(TEST_INPUT)
+        post = self.app.post('/', data=dict(
+                mapqtl_input=stream),
+                follow_redirects=True)
+        stream.close()
+
+        motif = re.compile('\n(.*)</span>\n\s+</p>\n')
+        session_id = motif.search(post.data).group(1).strip()
+
+        # The sessions of a MapQTL archive are found without extracting it
+        archives = mq2_web.ARCHIVES
+        stats = archives.stats()
+        output = self.app.get('/session/%s/' % session_id)
+        self.assertTrue('<option value="2">2</option>' in output.data)
+        self.assertEqual(archives.stats()['misses'], stats['misses'])
+
+        inputzip = os.path.join(get_session_folder(session_id), 'input.zip')
+        self.assertEqual(describe_archive(inputzip),
+                         {'plugin': 'MapQTL plugin', 'sessions': ['2']})
+        self.assertEqual(get_mapqtl_session(session_id), ['2'])
+
+        archives.get(inputzip)
+        stats = archives.stats()
+        self.assertEqual(archives.get(inputzip)[1]['sessions'], ['2'])
+        self.assertEqual(archives.stats()['hits'], stats['hits'] + 1)
+        folder, infos = archives.checkout(inputzip)
+        self.assertEqual(infos['plugin'], 'MapQTL plugin')
+        self.assertEqual(infos['sessions'], ['2'])
+        self.assertTrue(os.listdir(folder))
+        shutil.rmtree(folder)
+        self.assertTrue(os.listdir(archives.get(inputzip)[0]))
+
+        # The entries returned or in use are not evicted
+        cache_folder = tempfile.mkdtemp()
+        try:
+            cache = ArchiveCache(cache_folder, 0)
+            data, infos = cache.get(inputzip)
+            self.assertTrue(os.listdir(data))
+            digest = infos['digest']
+            with cache.pin(digest):
+                cache.evict()
+                self.assertTrue(os.listdir(data))
+            cache.evict()
+            self.assertFalse(os.path.exists(data))
+            self.assertEqual([name for name in os.listdir(cache_folder)
+                              if not name.startswith('.')], [])
+        finally:
+            shutil.rmtree(cache_folder)
+
+        shutil.rmtree(get_session_folder(session_id))
+
+    def test_catalog_import(self):
+        """Checks that sessions created before the catalog are imported
+        in it. """
+        upload_folder = self.upload_folder
+        session_id = '20130101000000000000TESTCATALOG'
+        exp_id = '20130101000000_s2_t3'
+        os.makedirs(os.path.join(upload_folder, session_id, exp_id))
+        stream = open(os.path.join(upload_folder, session_id, exp_id,
+                                   'exp.cfg'), 'w')
+        stream.write('[Parameters]\nlod_threshold = 3\nsession = 2\n'
+                     'experiment_id = %s\nplugin = MapQTL plugin\n'
+                     % exp_id)
+        stream.close()
+
+        self.assertFalse(mq2_web.CATALOG.has_session(session_id))
+        output = self.app.get('/session/%s/%s/marker/E36M48-330' % (
+                session_id, exp_id))
+        self.assertTrue('MQ² results for marker E36M48-330' in output.data)
+        self.assertTrue(mq2_web.CATALOG.has_session(session_id))
+        self.assertEqual(experiment_done(session_id, '3.0', 2), exp_id)
+        self.assertFalse(experiment_done(session_id, 3.5, 2))
+
+        mq2_web.CATALOG.remove_session(session_id)
         shutil.rmtree(os.path.join(upload_folder, session_id))
 
+    def test_shared_archive(self):
+        """Checks that an archive uploaded twice is stored once and that
+        its experiments are shared. """
+        session_ids = []
+        motif = re.compile('\n(.*)</span>\n\s+</p>\n')
+        for cnt in range(2):
+            stream = open(TEST_INPUT)
+            post = self.app.post('/', data=dict(
+                    mapqtl_input=stream),
+                    follow_redirects=True)
+            stream.close()
+            session_ids.append(motif.search(post.data).group(1).strip())
+
+        folders = [get_session_folder(session_id)
+                   for session_id in session_ids]
+        self.assertEqual(
+            os.stat(os.path.join(folders[0], 'input.zip')).st_ino,
+            os.stat(os.path.join(folders[1], 'input.zip')).st_ino)
+        blobs = [filename for _, _, filenames in os.walk(
+                 mq2_web.BLOBS.folder) for filename in filenames]
+        self.assertEqual(len(blobs), 1)
+        self.assertEqual(
+            os.stat(os.path.join(folders[0], 'input.zip')).st_nlink, 3)
+
+        exp_ids = []
+        for session_id in session_ids:
+            # The experiment of the second session is a copy, it may be
+            # done before the page is shown
+            job_ids = get_job_ids(get_session_folder(session_id))
+            self.app.post('/session/%s/' % session_id,
+                    data=dict(lod_threshold=3, session=2),
+                    follow_redirects=True)
+            jobs = self.wait_for_new_jobs(session_id, job_ids)
+            self.assertEqual([job['status'] for job in jobs], ['done'])
+            exp_ids.append(jobs[0]['exp_id'])
+
+        self.assertEqual(
+            os.stat(os.path.join(folders[0], exp_ids[0],
+                                 'qtls_matrix.csv')).st_ino,
+            os.stat(os.path.join(folders[1], exp_ids[1],
+                                 'qtls_matrix.csv')).st_ino)
+        self.assertEqual(experiment_done(session_ids[1], 3, 2), exp_ids[1])
+        stream = open(os.path.join(folders[0], exp_ids[0], 'exp.cfg'))
+        self.assertTrue(exp_ids[0] in stream.read())
+        stream.close()
+
+        output = self.app.get('/session/%s/%s/marker/E36M48-330' % (
+                session_ids[1], exp_ids[1]))
+        self.assertTrue('2 QTLs found' in output.data)
+
+        for folder in folders:
+            shutil.rmtree(folder)
+
+    def test_sweep(self):
+        """Checks that a LOD sweep runs an experiment per threshold. """
+        stream = open(TEST_INPUT)
+        post = self.app.post('/', data=dict(
+                mapqtl_input=stream),
+                follow_redirects=True)
+        stream.close()
+
+        motif = re.compile('\n(.*)</span>\n\s+</p>\n')
+        session_id = motif.search(post.data).group(1).strip()
+
+        post = self.app.post('/session/%s/sweep' % session_id,
+                data=dict(lod_thresholds='2:3', session=2),
+                follow_redirects=True)
+        self.assertTrue('lod_thresholds: This field should contain'
+            in post.data)
+
+        post = self.app.post('/session/%s/sweep' % session_id,
+                data=dict(lod_thresholds='4.5, 2:3:1', session=2),
+                follow_redirects=True)
+        jobs = self.wait_for_jobs(post.data)
+        self.assertEqual([job['status'] for job in jobs], ['done'])
+        self.assertEqual(jobs[0]['lod_thresholds'], '2, 3, 4.5')
+
+        output = self.app.get(jobs[0]['url'])
+        self.assertEqual(output.status_code, 200)
+        self.assertTrue('MQ² LOD sweep %s' % str(jobs[0]['job_id'])
+            in output.data)
+
+        output = self.app.get('/session/%s/sweep/%s.csv' % (
+                session_id, jobs[0]['job_id']))
+        self.assertEqual(output.headers['Cache-Control'],
+                         'private, max-age=%s' % mq2_web.CACHE_TIMEOUT)
+        rows = [row.split(',') for row in output.data.splitlines()[1:]]
+        self.assertEqual([row[0] for row in rows], ['2', '3', '4.5'])
+        self.assertEqual([row[2] for row in rows], ['27', '9', '4'])
+        for row in rows:
+            self.assertEqual(experiment_done(session_id, row[0], 2),
+                             row[1])
+        for url in ('/session/%s/sweep/unknown.csv' % session_id,
+                    '/session/..%s/sweep/%s.csv' % (session_id,
+                                                    jobs[0]['job_id'])):
+            self.assertEqual(self.app.get(url).status_code, 302)
+
+        output = self.app.get('/session/%s/%s/marker/E36M48-330' % (
+                session_id, rows[1][1]))
+        self.assertTrue('2 QTLs found' in output.data)
+
+        # A higher threshold is derived from the experiments of the sweep
+        folder = get_session_folder(session_id)
+        job_ids = get_job_ids(folder)
+        self.app.post('/session/%s/' % session_id,
+                data=dict(lod_threshold=4, session=2),
+                follow_redirects=True)
+        jobs = self.wait_for_new_jobs(session_id, job_ids)
+        self.assertEqual([job['status'] for job in jobs], ['done'])
+        base_ids = [event['base_id'] for _, event in read_progress(
+            folder, jobs[0]['job_id']) if event['stage'] == 'deriving']
+        self.assertEqual(len(base_ids), 1)
+        self.assertTrue(base_ids[0] in [row[1] for row in rows[:2]])
+        self.assertEqual(
+            os.stat(os.path.join(folder, base_ids[0], 'map.csv')).st_ino,
+            os.stat(os.path.join(folder, jobs[0]['exp_id'],
+                                 'map.csv')).st_ino)
+        stream = open(os.path.join(folder, jobs[0]['exp_id'],
+                                   'qtls.csv'))
+        self.assertEqual(len(stream.readlines()), 5)
+        stream.close()
+        # Only the number of QTLs per marker of its store is written again
+        self.assertEqual(
+            os.stat(os.path.join(folder, base_ids[0], '.index', 'columns',
+                                 'markers')).st_ino,
+            os.stat(os.path.join(folder, jobs[0]['exp_id'], '.index',
+                                 'columns', 'markers')).st_ino)
+        store = open_store(os.path.join(folder, jobs[0]['exp_id']))
+        self.assertEqual(sum(store.marker_qtls[:len(store.marker_qtls)]), 4)
+
+        shutil.rmtree(get_session_folder(session_id))
+
+    def test_batch(self):
+        """Checks that the experiments of all the MapQTL sessions run in a
+        single submission. """
+        archive = generate_mapqtl(50, 5, 3, 3, random.Random(0))
+        post = self.app.post('/', data=dict(
+                mapqtl_input=(StringIO(archive), 'input.zip')),
+                follow_redirects=True)
+        motif = re.compile('\n(.*)</span>\n\s+</p>\n')
+        session_id = motif.search(post.data).group(1).strip()
+        self.assertTrue('<option value="*">All sessions</option>'
+                        in post.data)
+
+        post = self.app.post('/session/%s/' % session_id,
+                data=dict(lod_threshold=3, session=1),
+                follow_redirects=True)
+        jobs = self.wait_for_jobs(post.data)
+        self.assertEqual([job['status'] for job in jobs], ['done'])
+
+        post = self.app.post('/session/%s/' % session_id,
+                data=dict(lod_threshold=3, session='*'))
+        self.assertEqual(post.status_code, 302)
+        batch_id = post.headers['Location'].rstrip('/').rsplit('/', 1)[1]
+        self.assertTrue(batch_id.endswith('_t3_batch'))
+
+        start = time.time()
+        rows, pending = mq2_web.read_batch_summary(session_id, batch_id)
+        while pending and time.time() - start < 60:
+            time.sleep(0.1)
+            rows, pending = mq2_web.read_batch_summary(session_id, batch_id)
+        self.assertEqual([row[:2] for row in rows], [
+            ['1', 'done'], ['2', 'done'], ['3', 'done']])
+        # The experiment already run is not run again
+        self.assertEqual(rows[0][2], jobs[0]['exp_id'])
+        self.assertEqual(len(set(row[2] for row in rows)), 3)
+        for row in rows:
+            self.assertEqual(experiment_done(session_id, 3, row[0]),
+                             row[2])
+            self.assertEqual(len(row), 6)
+
+        output = self.app.get('/session/%s/batch/%s/' % (session_id,
+                                                         batch_id))
+        self.assertEqual(output.status_code, 200)
+        self.assertTrue('MQ² all sessions %s' % batch_id in output.data)
+        self.assertFalse('http-equiv="refresh"' in output.data)
+        for row in rows:
+            self.assertTrue('/session/%s/%s/' % (session_id, row[2])
+                            in output.data)
+
+        output = self.app.get('/session/%s/' % session_id)
+        self.assertTrue('/session/%s/batch/%s/' % (session_id, batch_id)
+                        in output.data)
+        output = self.app.get('/session/%s/batch/unknown/' % session_id,
+                              follow_redirects=True)
+        self.assertTrue('<li>This batch does not exists</li>'
+                        in output.data)
+
+        shutil.rmtree(get_session_folder(session_id))
+
+    def test_api(self):
+        """Checks the JSON API. """
+        stream = open(TEST_INPUT)
+        post = self.app.post('/', data=dict(
+                mapqtl_input=stream),
+                follow_redirects=True)
+        stream.close()
+
+        motif = re.compile('\n(.*)</span>\n\s+</p>\n')
+        session_id = motif.search(post.data).group(1).strip()
+        post = self.app.post('/session/%s/' % session_id,
+                data=dict(lod_threshold=3, session=2),
+                follow_redirects=True)
+        exp_id = str(self.wait_for_jobs(post.data)[0]['exp_id'])
+
+        output = self.app.get('/api/v1/sessions/unknown')
+        self.assertEqual(output.status_code, 404)
+        output = json.loads(self.app.get(
+            '/api/v1/sessions/%s' % session_id).data)
+        self.assertEqual(output['plugin'], 'MapQTL plugin')
+        self.assertEqual(output['sessions'], ['2'])
+        self.assertEqual(output['experiments'], 1)
+
+        url = '/api/v1/sessions/%s/experiments' % session_id
+        output = json.loads(self.app.get(url).data)
+        self.assertEqual(output['total'], 1)
+        self.assertEqual(output['items'][0]['experiment_id'], exp_id)
+        output = json.loads(self.app.get(
+            '%s/%s?fields=lod_threshold,session' % (url, exp_id)).data)
+        self.assertEqual(output, {'lod_threshold': 3, 'session': '2'})
+
+        output = json.loads(self.app.get(
+            '%s/%s/hotspots?limit=2' % (url, exp_id)).data)
+        self.assertEqual(output['items'][0], {'marker': 'E35M48-281',
+            'lg': 'P01', 'position': 0, 'qtls': 0})
+        self.assertEqual(len(output['items']), 2)
+        total = output['total']
+        output = json.loads(self.app.get(
+            '%s/%s/hotspots?lg=P02&min_qtls=1&fields=marker,qtls'
+            % (url, exp_id)).data)
+        self.assertTrue(output['total'] < total)
+        self.assertEqual(sorted(output['items'][0]), ['marker', 'qtls'])
+        self.assertEqual(self.app.get(
+            '%s/%s/hotspots?start=a' % (url, exp_id)).status_code, 400)
+
+        output = json.loads(self.app.get(
+            '%s/%s/markers/E36M48-330?offset=1' % (url, exp_id)).data)
+        self.assertEqual(output['total'], 2)
+        self.assertEqual(len(output['items']), 1)
+        self.assertEqual(output['items'][0]['Trait name'], 'A_trait11')
+
+        store = open_store(os.path.join(get_session_folder(session_id),
+                                        exp_id))
+        self.assertEqual(len(store.markers), total)
+        infos = mq2_web.CATALOG.get_experiment(session_id, exp_id)
+        (nline, ncol) = store.get_matrix_dimensions()
+        self.assertEqual((nline - 2, ncol - 5),
+                         (infos['n_markers'], infos['n_traits']))
+        # The QTLs of a marker are read from the store
+        stream = open(os.path.join(get_session_folder(session_id), exp_id,
+                                   'qtls_with_mk.csv'))
+        rows = [row.strip().split(',') for row in stream]
+        stream.close()
+        self.assertEqual(store.get_marker_qtls('E36M48-330'),
+                         (rows[0], [row for row in rows[1:]
+                                    if row[-3] == 'E36M48-330']))
+        self.assertEqual(store.get_marker_qtls('unknown'), (rows[0], []))
+        shutil.rmtree(get_session_folder(session_id))
+
+    def test_invalid_upload(self):
+        """Checks that the files which cannot be processed are rejected
+        when uploaded. """
+        blob_folder = mq2_web.BLOBS.folder
+        content = os.listdir(blob_folder)
+        post = self.app.post('/', data=dict(
+                mapqtl_input=(StringIO('not a zip archive'), 'input.zip')),
+                follow_redirects=True)
+        self.assertTrue('<li>The file uploaded is not a zip archive.</li>'
+            in post.data)
+
+        stream = StringIO()
+        archive = zipfile.ZipFile(stream, 'w')
+        archive.writestr('README.txt', 'Nothing to see')
+        archive.close()
+        post = self.app.post('/', data=dict(
+                mapqtl_input=(StringIO(stream.getvalue()), 'input.zip')),
+                follow_redirects=True)
+        self.assertTrue('<li>The archive uploaded does not contain any '
+            'MapQTL, CSV or Excel file.</li>' in post.data)
+        self.assertEqual(os.listdir(blob_folder), content)
+
+        # It is rejected once the headers of its files are uploaded,
+        # before its central directory
+        data = stream.getvalue()
+        writer = mq2_web.BLOBS.get_writer()
+        written = 0
+        try:
+            while written < len(data):
+                writer.write(data[written:written + 16])
+                written += 16
+            self.fail('The archive was not rejected')
+        except InvalidArchive, err:
+            self.assertEqual(str(err), 'The archive uploaded does not '
+                             'contain any MapQTL, CSV or Excel file.')
+        self.assertTrue(written + 16 < len(data))
+        self.assertFalse(os.path.exists(writer.name))
+
+        writer = mq2_web.BLOBS.get_writer(max_content_size=1024)
+        stream = StringIO()
+        archive = zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED)
+        archive.writestr('data.csv', '0' * 2048)
+        archive.close()
+        self.assertRaises(ArchiveTooLarge, writer.write, stream.getvalue())
+        self.assertFalse(os.path.exists(writer.name))
+
+    def test_job_status(self):
+        """Checks the status of the jobs running experiments. """
+        stream = open(TEST_INPUT)
+        post = self.app.post('/', data=dict(
+                mapqtl_input=stream),
+                follow_redirects=True)
+        stream.close()
+
+        motif = re.compile('\n(.*)</span>\n\s+</p>\n')
+        session_id = motif.search(post.data).group(1).strip()
+
+        output = self.app.get('/session/%s/job/unknown' % session_id)
+        self.assertEqual(output.status_code, 404)
+
+        # Only the jobs of existing sessions are found
+        write_job_status(get_session_folder(session_id),
+                         '.job1', 'queued', lod_threshold=3, session=2)
+        for url in ('/session/%s/job/.job1' % session_id,
+                    '/session/%s/job/.job1/events' % session_id,
+                    '/session/.locks/job/job1'):
+            self.assertEqual(self.app.get(url).status_code, 404)
+        output = self.app.post('/session/%s/job/.job1/cancel' % session_id)
+        self.assertEqual(output.status_code, 404)
+
+        write_job_status(get_session_folder(session_id),
+                         'job1', 'queued', lod_threshold=3, session=2)
+        output = self.app.get('/session/%s/job/job1' % session_id)
+        self.assertEqual(output.status_code, 200)
+        status = json.loads(output.data)
+        self.assertEqual(status['status'], 'queued')
+        self.assertEqual(status['lod_threshold'], '3')
+
+        output = self.app.get('/session/%s/' % session_id)
+        self.assertTrue('/session/%s/job/job1' % session_id in output.data)
+
+        # The same experiment is not submitted twice
+        output = self.app.post('/session/%s/' % session_id,
+                data=dict(lod_threshold=3, session=2),
+                follow_redirects=True)
+        self.assertTrue('<li>This experiment is already running.</li>'
+            in output.data)
+        self.assertEqual(len(self.wait_for_jobs(output.data, timeout=0)), 1)
+
+        # A job failing before writing down its status is marked as failed
+        folder = get_session_folder(session_id)
+        jobs = JobQueue(workers=1)
+        try:
+            jobs.submit(folder, 'job2', int, ('a',), lod_threshold=4,
+                        session=2)
+        finally:
+            jobs.close()
+        infos = mq2_web.read_job_status(folder, 'job2')
+        self.assertEqual(infos['status'], 'failed')
+        self.assertTrue('invalid literal' in infos['error'])
+
+        shutil.rmtree(get_session_folder(session_id))
+
+    def test_job_progress(self):
+        """Checks the progress events of the jobs and their stream. """
+        stream = open(TEST_INPUT)
+        post = self.app.post('/', data=dict(
+                mapqtl_input=stream),
+                follow_redirects=True)
+        stream.close()
+        motif = re.compile('\n(.*)</span>\n\s+</p>\n')
+        session_id = motif.search(post.data).group(1).strip()
+        folder = get_session_folder(session_id)
+
+        output = self.app.get('/session/%s/job/unknown/events' % session_id)
+        self.assertEqual(output.status_code, 404)
+
+        job_id = '20130101000000_s2_t3'
+        write_job_status(folder, job_id, 'queued', lod_threshold=3,
+                         session=2)
+        output = self.app.get('/session/%s/' % session_id)
+        self.assertTrue('/session/%s/job/%s/events' % (session_id, job_id)
+                        in output.data)
+        mq2_web.run_job(session_id, job_id, 3, '2')
+
+        events = read_progress(folder, job_id)
+        stages = [event['stage'] for _, event in events]
+        self.assertEqual(stages[0], 'started')
+        self.assertEqual(stages[-1], 'written')
+        self.assertEqual(events[-1][1]['exp_id'], job_id)
+        self.assertTrue('exp.cfg' in events[-1][1]['outputs'])
+        elapsed = [event['elapsed'] for _, event in events]
+        self.assertEqual(elapsed, sorted(elapsed))
+        self.assertEqual(read_progress(folder, job_id, events[-1][0]), [])
+
+        output = self.app.get('/session/%s/job/%s/events' % (session_id,
+                                                             job_id))
+        self.assertEqual(output.status_code, 200)
+        self.assertEqual(output.mimetype, 'text/event-stream')
+        self.assertEqual(output.data.count('event: progress\n'),
+                         len(events))
+        status = json.loads(output.data.rsplit('event: status\ndata: ',
+                                               1)[1])
+        self.assertEqual(status['status'], 'done')
+        self.assertEqual(status['url'], '/session/%s/%s/' % (session_id,
+                                                            job_id))
+
+        # The stream resumes after the last event received
+        output = self.app.get('/session/%s/job/%s/events' % (
+            session_id, job_id),
+            headers={'Last-Event-ID': str(events[1][0])})
+        self.assertEqual(output.data.count('event: progress\n'),
+                         len(events) - 2)
+        self.assertTrue('event: status\n' in output.data)
+
+        shutil.rmtree(folder)
+
+    def test_sandbox(self):
+        """Checks the limits of the child processes running the jobs. """
+        self.assertEqual(run_sandboxed(lambda value: value * 2, (21,),
+                                       fork=True), 42)
+        # Outside of the workers, the function is run by a new interpreter
+        self.assertEqual(run_sandboxed(int, ('42',)), 42)
+        self.assertRaises(ValueError, run_sandboxed, int, ('a',))
+        self.assertRaises(ValueError, run_sandboxed, int, ('a',), fork=True)
+
+        start = time.time()
+        self.assertRaises(JobAborted, run_sandboxed, time.sleep, (10,),
+                          wall_time=1)
+        self.assertRaises(JobCancelled, run_sandboxed, time.sleep, (10,),
+                          cancelled=lambda: True)
+        self.assertTrue(time.time() - start < 5)
+
+        def spin():
+            while True:
+                pass
+        try:
+            run_sandboxed(spin, cpu_time=1, wall_time=10, fork=True)
+            self.fail('The CPU time limit was not enforced')
+        except JobAborted, err:
+            self.assertTrue('CPU time' in str(err))
+
+        stream = open('/proc/self/status')
+        size = [int(line.split()[1]) for line in stream
+                if line.startswith('VmSize:')][0] / 1024
+        stream.close()
+        try:
+            run_sandboxed(lambda: ' ' * 1024 ** 3, memory=size + 256,
+                          fork=True)
+            self.fail('The memory limit was not enforced')
+        except JobAborted, err:
+            self.assertTrue('memory' in str(err))
+
+    def test_cancel_job(self):
+        """Checks that the jobs can be cancelled. """
+        stream = open(TEST_INPUT)
+        post = self.app.post('/', data=dict(
+                mapqtl_input=stream),
+                follow_redirects=True)
+        stream.close()
+        motif = re.compile('\n(.*)</span>\n\s+</p>\n')
+        session_id = motif.search(post.data).group(1).strip()
+        folder = get_session_folder(session_id)
+
+        output = self.app.post('/session/%s/job/unknown/cancel' % session_id)
+        self.assertEqual(output.status_code, 404)
+
+        # A job queued fails as soon as it is cancelled and does not run
+        job_id = '20130101000000_s2_t3'
+        write_job_status(folder, job_id, 'queued', lod_threshold=3,
+                         session=2)
+        output = self.app.get('/session/%s/' % session_id)
+        self.assertTrue('/session/%s/job/%s/cancel' % (session_id, job_id)
+                        in output.data)
+        output = self.app.post('/session/%s/job/%s/cancel' % (session_id,
+                                                              job_id))
+        self.assertEqual(output.status_code, 200)
+        status = json.loads(output.data)
+        self.assertEqual(status['status'], 'failed')
+        self.assertEqual(status['error'], 'The job was cancelled')
+        self.assertEqual(mq2_web.run_job(session_id, job_id, 3, '2'), None)
+        self.assertFalse(os.path.exists(os.path.join(folder, job_id)))
+        self.assertFalse(os.path.exists(os.path.join(folder,
+                                                     '%s.cancel' % job_id)))
+        output = self.app.post('/session/%s/job/%s/cancel' % (session_id,
+                                                              job_id))
+        self.assertEqual(output.status_code, 409)
+
+        # A job running is stopped and its partial output removed
+        job_id = '20130101000001_s2_t3'
+        write_job_status(folder, job_id, 'running', lod_threshold=3,
+                         session=2)
+        progress = JobProgress(folder, job_id)
+        output = self.app.post('/session/%s/job/%s/cancel' % (session_id,
+                                                              job_id))
+        self.assertEqual(output.status_code, 200)
+        self.assertTrue(progress.cancelled())
+        input_folder, infos = mq2_web.ARCHIVES.checkout(
+            os.path.join(folder, 'input.zip'))
+        try:
+            mq2_web.mq2_run(session_id,
+                            mq2_web.get_plugin(infos['plugin']),
+                            input_folder, 3, '2', exp_id=job_id,
+                            progress=progress)
+            self.fail('The job was not cancelled')
+        except MQ2Exception, err:
+            self.assertEqual(str(err), 'The job was cancelled')
+        finally:
+            shutil.rmtree(input_folder, ignore_errors=True)
+        self.assertEqual([name for name in os.listdir(folder)
+                          if job_id in name and not name.endswith(
+                              ('.job', '.progress', '.cancel'))], [])
+
+        # Once no longer cancelled, the experiment is run
+        progress.close()
+        input_folder, infos = mq2_web.ARCHIVES.checkout(
+            os.path.join(folder, 'input.zip'))
+        try:
+            self.assertEqual(mq2_web.mq2_run(
+                session_id, mq2_web.get_plugin(infos['plugin']),
+                input_folder, 3, '2', exp_id=job_id), job_id)
+        finally:
+            shutil.rmtree(input_folder, ignore_errors=True)
+
+        mq2_web.CATALOG.remove_session(session_id)
+        shutil.rmtree(folder)
+
+    def test_single_flight(self):
+        """Checks that identical experiments run concurrently are
+        generated once and that unfinished experiments are recovered. """
+        stream = open(TEST_INPUT)
+        post = self.app.post('/', data=dict(
+                mapqtl_input=stream),
+                follow_redirects=True)
+        stream.close()
+        motif = re.compile('\n(.*)</span>\n\s+</p>\n')
+        session_id = motif.search(post.data).group(1).strip()
+        folder = get_session_folder(session_id)
+
+        def count_runs():
+            return sum(mq2_web.EXPERIMENT_TIME.get(method=method)
+                       for method in ('copy', 'derive', 'run'))
+        runs = count_runs()
+        exp_ids = []
+        threads = [threading.Thread(target=lambda cnt=cnt: exp_ids.append(
+            mq2_web.run_experiment(session_id, '2013010100000%s_s2_t3' % cnt,
+                                   3, '2'))) for cnt in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(exp_ids)), 1)
+        self.assertEqual(count_runs(), runs + 1)
+        self.assertEqual(mq2_web.get_experiment_ids(session_id), exp_ids[:1])
+        self.assertEqual(
+            [name for name in os.listdir(folder) if name.startswith('20')],
+            exp_ids[:1])
+        self.assertFalse([name for name in os.listdir(folder)
+                          if name.startswith('.tmp-')])
+
+        # Left by a process which stopped while generating them
+        os.makedirs(os.path.join(folder, '.tmp-20130102000000_s2_t4', 'a'))
+        os.mkdir(os.path.join(folder, '20130102000000_s2_t5'))
+        os.mkdir(os.path.join(folder, '20130102000000_s2_t6'))
+        write_job_status(folder, 'job1', 'running', lod_threshold=4,
+                         session=2)
+        # Still run by another process
+        write_job_status(folder, 'job2', 'running', lod_threshold=7,
+                         session=2)
+        lock = mq2_web.get_experiment_lock(session_id, 6, '2')
+        job_lock = mq2_web.get_job_lock(session_id, 'job2')
+        lock.acquire()
+        job_lock.acquire()
+        try:
+            self.assertEqual(mq2_web.recover_experiments(), (2, 1))
+            self.assertEqual(mq2_web.run_job(session_id, 'job2', 7, '2'),
+                             None)
+        finally:
+            job_lock.release()
+            lock.release()
+        self.assertEqual(mq2_web.read_job_status(folder, 'job2')['status'],
+                         'running')
+        self.assertTrue(os.path.exists(
+            os.path.join(folder, '20130102000000_s2_t6')))
+        self.assertFalse(os.path.exists(
+            os.path.join(folder, '20130102000000_s2_t5')))
+        start = time.time()
+        while mq2_web.read_job_status(folder, 'job1')['status'] \
+                in ('queued', 'running') and time.time() - start < 60:
+            time.sleep(0.1)
+        self.assertEqual(mq2_web.read_job_status(folder, 'job1')['status'],
+                         'done')
+        self.assertTrue(mq2_web.experiment_done(session_id, 4, '2'))
+
+        mq2_web.CATALOG.remove_session(session_id)
+        shutil.rmtree(folder)
+
+
+    def test_metrics(self):
+        """Checks the metrics of the web-application. """
+        self.app.get('/')
+        output = self.app.get('/metrics')
+        self.assertEqual(output.status_code, 200)
+        self.assertTrue(output.headers['Content-Type'].startswith(
+            'text/plain; version=0.0.4'))
+        self.assertTrue('# TYPE mq2_request_duration_seconds histogram'
+            in output.data)
+        self.assertTrue('mq2_requests_total{endpoint="index",status="200"}'
+            in output.data)
+        self.assertTrue('mq2_request_duration_seconds_bucket{endpoint="index",'
+            'method="GET",le="+Inf"}' in output.data)
+
+        # What the workers measured is merged in the web-application
+        registry = Registry()
+        worker = Registry()
+        for metrics in (registry, worker):
+            metrics.histogram('duration', 'Duration', buckets=(1, 10))
+            metrics.counter('runs', 'Runs', ('method',))
+        worker.metrics['duration'].observe(5)
+        worker.metrics['runs'].inc(method='run')
+        registry.merge(worker.drain())
+        registry.merge(worker.drain())
+        self.assertEqual(registry.metrics['runs'].get(method='run'), 1)
+        self.assertEqual(registry.metrics['duration'].get(), 1)
+        self.assertTrue('duration_bucket{le="1.0"} 0' in registry.render())
+        self.assertTrue('duration_bucket{le="10.0"} 1' in registry.render())
+
+        # The jobs which fail are measured as well
+        failed = mq2_jobs.FAILED_JOBS.get()
+        durations = mq2_jobs.JOB_TIME.get(status='failed')
+        mq2_jobs.METRICS.merge(mq2_jobs._run_measured(
+            self.upload_folder, 'job1', int, ('a',)))
+        self.assertEqual(mq2_jobs.FAILED_JOBS.get(), failed + 1)
+        self.assertEqual(mq2_jobs.JOB_TIME.get(status='failed'),
+                         durations + 1)
+        output = self.app.get('/metrics')
+        self.assertTrue('mq2_jobs_failed_total %s' % (failed + 1)
+            in output.data)
+
+
+    def test_profiling(self):
+        """Checks that the requests selected are profiled. """
+        folder = tempfile.mkdtemp()
+        try:
+            app = ProfilingMiddleware(APP.wsgi_app, APP.url_map, folder,
+                                      endpoints=['index'])
+            client = Client(app, BaseResponse)
+            self.assertEqual(client.get('/').status_code, 200)
+            self.assertEqual(client.get('/metrics').status_code, 200)
+            profiles = os.listdir(folder)
+            self.assertEqual(len(profiles), 1)
+            self.assertTrue(profiles[0].startswith('index.-.'))
+            stats = pstats.Stats(os.path.join(folder, profiles[0]))
+            self.assertTrue(stats.total_calls > 0)
+
+            app.rate = 0
+            client.get('/')
+            self.assertEqual(len(os.listdir(folder)), 1)
+        finally:
+            shutil.rmtree(folder)
+
+
+    def test_benchmark(self):
+        """Checks the synthetic datasets of the benchmark. """
+        rand = random.Random(0)
+        stream = StringIO(generate_mapqtl(50, 5, 3, 2, rand))
+        self.assertEqual(describe_archive(stream),
+                         {'plugin': 'MapQTL plugin', 'sessions': ['1', '2']})
+        self.assertEqual(len(zipfile.ZipFile(stream).namelist()), 6)
+
+        timings = run_benchmark(generate_csv(50, 5, 3, rand), None,
+                                repeat=1, pages=2, rand=rand)
+        self.assertEqual(len(timings['marker_detail']), 2)
+        self.assertEqual(sorted(timings), ['build_zip',
+            'get_plugin_and_folder', 'marker_detail', 'mq2_run', 'results',
+            'retrieve', 'upload'])
+        # The input files are parsed in a child process
+        self.assertTrue(get_peak_rss(resource.RUSAGE_CHILDREN) > 0)
+
+
+    def test_loadtest(self):
+        """Checks the load test against the application. """
+        stream = open(TEST_INPUT)
+        dataset = stream.read()
+        stream.close()
+        test = LoadTest(InProcessClient, dataset, '2', actions=(
+            ('index', 1), ('upload', 1), ('results', 1), ('marker', 1),
+            ('download', 1)), seed=0)
+        try:
+            report = test.run(2, 0.5)
+        finally:
+            test.clean()
+        self.assertTrue(report['total']['requests'] > 0)
+        self.assertEqual(report['total']['errors'], 0)
+        self.assertFalse('submit' in report['actions'])
+        for session_id in test.session_ids:
+            self.assertFalse(os.path.exists(
+                get_session_folder(session_id)))
+
+
+    def test_clean_uploads(self):
+        """Checks the selection of the sessions to clean. """
+        folder = tempfile.mkdtemp()
+        try:
+            catalog = Catalog(os.path.join(folder, '.catalog.sqlite'))
+            now = time.time()
+            for cnt, age in enumerate((30, 3, 2, 1)):
+                session_folder = os.path.join(folder, 'session%s' % cnt)
+                os.mkdir(session_folder)
+                stream = open(os.path.join(session_folder, 'input.zip'),
+                              'w')
+                stream.write('0' * 1000)
+                stream.close()
+                os.utime(session_folder, (now - age * 24 * 3600,) * 2)
+                os.utime(os.path.join(session_folder, 'input.zip'),
+                         (now - age * 24 * 3600,) * 2)
+            # The catalog knows of a more recent access to session2
+            catalog.add_session('session2')
+            os.mkdir(os.path.join(folder, '.blobs'))
+
+            sessions = scan_sessions(folder, catalog.get_last_accesses(),
+                                     with_size=True)
+            self.assertEqual([session.session_id for session in sessions],
+                ['session0', 'session1', 'session3', 'session2'])
+            self.assertEqual(sessions[0].size, 1000)
+
+            to_clean = select_sessions(sessions, now, days=7)
+            self.assertEqual([session.session_id for session in to_clean],
+                             ['session0'])
+            to_clean = select_sessions(sessions, now, days=7, quota=2000,
+                                       keep=['session1'])
+            self.assertEqual([session.session_id for session in to_clean],
+                             ['session0', 'session3'])
+
+            remove_sessions(to_clean, catalog, jobs=2)
+            self.assertEqual(sorted(os.listdir(folder)),
+                ['.blobs', '.catalog.sqlite', 'session1', 'session2'])
+        finally:
+            shutil.rmtree(folder)
+
+        # The files shared by several sessions are counted in each of
+        # them but only freed with the last one
+        folder = tempfile.mkdtemp()
+        try:
+            now = time.time()
+            shared = os.path.join(folder, 'shared.zip')
+            stream = open(shared, 'w')
+            stream.write('0' * 3000)
+            stream.close()
+            for cnt, age in enumerate((3, 2, 1)):
+                session_folder = os.path.join(folder, 'session%s' % cnt)
+                os.mkdir(session_folder)
+                stream = open(os.path.join(session_folder, 'input.zip'),
+                              'w')
+                stream.write('0' * 1000)
+                stream.close()
+                if cnt < 2:
+                    os.link(shared, os.path.join(session_folder, 'exp.zip'))
+                os.utime(os.path.join(session_folder, 'input.zip'),
+                         (now - age * 24 * 3600,) * 2)
+                os.utime(session_folder, (now - age * 24 * 3600,) * 2)
+            os.utime(shared, (now - 3 * 24 * 3600,) * 2)
+            os.remove(shared)
+
+            sessions = scan_sessions(folder, {}, with_size=True)
+            self.assertEqual([session.size for session in sessions],
+                             [4000, 4000, 1000])
+            to_clean = select_sessions(sessions, now, quota=4000)
+            self.assertEqual([session.session_id for session in to_clean],
+                             ['session0', 'session1'])
+            to_clean = select_sessions(sessions, now, quota=6000)
+            self.assertEqual([session.session_id for session in to_clean],
+                             [])
+        finally:
+            shutil.rmtree(folder)
+
+    def test_sharded_layout(self):
+        """Checks the sharded layout of the upload folder and the
+        migration of the sessions to it. """
+        folder = tempfile.mkdtemp()
+        try:
+            for session_id in ('legacy1', 'legacy2', 'running'):
+                os.makedirs(os.path.join(folder, session_id, 'exp'))
+            write_job_status(os.path.join(folder, 'running'), 'job1',
+                             'running')
+            os.makedirs(get_sharded_folder(folder, 'sharded'))
+            os.mkdir(os.path.join(folder, '.blobs'))
+
+            self.assertEqual(resolve_session_folder(folder, 'legacy1'),
+                             os.path.join(folder, 'legacy1'))
+            # The identifiers are never resolved out of the upload folder
+            for session_id in ('../legacy1', '..', '.blobs', 'a/b', ''):
+                self.assertRaises(ValueError, resolve_session_folder,
+                                  folder, session_id)
+            self.assertEqual(resolve_session_folder(folder, 'sharded'),
+                             get_sharded_folder(folder, 'sharded'))
+            # New sessions are created in the sharded layout
+            self.assertEqual(resolve_session_folder(folder, 'new'),
+                             get_sharded_folder(folder, 'new'))
+            self.assertEqual(
+                sorted(entry.name for entry in list_sessions(folder)),
+                ['legacy1', 'legacy2', 'running', 'sharded'])
+
+            self.assertEqual(migrate(folder, test=True),
+                             ['legacy1', 'legacy2'])
+            self.assertEqual(list_legacy_sessions(folder),
+                             ['legacy1', 'legacy2', 'running'])
+            self.assertEqual(migrate(folder, batch=1, pause=0.01),
+                             ['legacy1', 'legacy2'])
+            self.assertEqual(list_legacy_sessions(folder), ['running'])
+            self.assertEqual(resolve_session_folder(folder, 'legacy1'),
+                             get_sharded_folder(folder, 'legacy1'))
+            self.assertTrue(os.path.isdir(os.path.join(
+                get_sharded_folder(folder, 'legacy1'), 'exp')))
+
+            sessions = scan_sessions(folder, {})
+            self.assertEqual(
+                sorted(session.session_id for session in sessions),
+                ['legacy1', 'legacy2', 'running', 'sharded'])
+        finally:
+            shutil.rmtree(folder)
+
 
 if __name__ == '__main__':
     SUITE = unittest.TestLoader().loadTestsFromTestCase(MQ2_WebTestCase)